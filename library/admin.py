@@ -1,7 +1,11 @@
 from django.contrib import admin
-from .models import Author, Book, Member, Loan
+from .models import Author, Book, CatalogImport, Member, Loan, OverdueSweepRun, OverdueSweepShard, OutboxEvent
 
 admin.site.register(Author)
 admin.site.register(Book)
 admin.site.register(Member)
 admin.site.register(Loan)
+admin.site.register(OverdueSweepRun)
+admin.site.register(OverdueSweepShard)
+admin.site.register(OutboxEvent)
+admin.site.register(CatalogImport)
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class LibraryConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'library'
+
+    def ready(self):
+        from library import receivers  # noqa: F401
+        from library.metrics import registry
+        from library.notifications import collect_metrics
+
+        registry.register_collector(collect_metrics)
@@ -0,0 +1,8 @@
+from django.urls import path
+from library import async_views
+
+urlpatterns = [
+    path('books/<int:pk>/', async_views.book_detail, name='async-book-detail'),
+    path('books/<int:pk>/availability/', async_views.book_availability, name='async-book-availability'),
+    path('members/top-active/', async_views.top_active_members, name='async-member-top-active'),
+]
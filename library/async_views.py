@@ -0,0 +1,87 @@
+"""
+Async read endpoints, served under ``/api/async/``.
+
+Plain Django async views over the async ORM: under ASGI a request waiting on
+the database or the cache hands the event loop to the others instead of
+holding a worker. They answer what their viewset counterparts answer, minus
+the conditional GET and response cache handling. Under WSGI they still
+work, each run to completion in its request's thread.
+"""
+from functools import wraps
+
+from django.db.models import Count, Min
+from django.http import HttpResponseNotAllowed, JsonResponse
+from rest_framework import status
+
+from library import leaderboard
+from library.models import Book, Loan
+from library.serializers import ActiveMemberSerializer, BookSerializer
+
+NOT_FOUND = {'detail': 'Not found.'}
+
+
+def json_response(data, status_code=status.HTTP_200_OK):
+    return JsonResponse(data, status=status_code, safe=False, json_dumps_params={'separators': (',', ':')})
+
+
+def read_only(view):
+    """
+    Answer anything but ``GET`` and ``HEAD`` with a 405. Django's own
+    ``require_safe`` only wraps async views from Django 5.0.
+    """
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return HttpResponseNotAllowed(['GET', 'HEAD'])
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+@read_only
+async def book_detail(request, pk):
+    """
+    A book, as ``/api/books/<pk>/`` renders it.
+    """
+    representation = BookSerializer.get_values_representation()
+    try:
+        book = await representation.apply(Book.objects.all()).aget(pk=pk)
+    except Book.DoesNotExist:
+        return json_response(NOT_FOUND, status.HTTP_404_NOT_FOUND)
+    return json_response(representation.to_representation(book))
+
+
+@read_only
+async def book_availability(request, pk):
+    """
+    A book's copies on the shelf and out on loan, and when the first loaned
+    copy is due back.
+    """
+    try:
+        book = await Book.objects.only('id', 'available_copies').aget(pk=pk)
+    except Book.DoesNotExist:
+        return json_response(NOT_FOUND, status.HTTP_404_NOT_FOUND)
+
+    loans = await Loan.objects.filter(book_id=book.id, is_returned=False).aaggregate(
+        on_loan=Count('id'), next_due_date=Min('due_date')
+    )
+    return json_response({
+        'book_id': book.id,
+        'available_copies': book.available_copies,
+        'is_available': book.available_copies > 0,
+        **loans,
+    })
+
+
+@read_only
+async def top_active_members(request):
+    """
+    The members with the most active loans, as
+    ``/api/members/top-active/`` lists them.
+    """
+    try:
+        number = min(max(int(request.GET.get('number', 5)), 1), 50)
+    except ValueError:
+        return json_response({'error': 'Number must be integer.'}, status.HTTP_400_BAD_REQUEST)
+
+    members = await leaderboard.aget_top_active(number=number)
+    return json_response(ActiveMemberSerializer(members, many=True).data)
@@ -0,0 +1,833 @@
+"""
+Benchmark scenarios, run with ``python manage.py benchmark <scenario>``.
+
+Every scenario seeds its own data and removes it when it finishes, so they can
+be pointed at a development database. Run them against PostgreSQL for numbers
+that mean anything; SQLite serializes writers.
+"""
+import asyncio
+import csv
+import os
+import queue
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection, transaction
+from django.test.utils import override_settings
+from django.utils.timezone import now
+from rest_framework.exceptions import ValidationError
+
+from library.models import Author, Book, Loan, Member, OutboxEvent
+
+SCENARIOS = {}
+
+
+def scenario(name):
+    """
+    Register a benchmark scenario under a name.
+
+    Args:
+        name (str): Name used on the command line
+    """
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+@contextmanager
+def rolled_back():
+    """
+    Run a block in a transaction that is always rolled back.
+    """
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
+
+
+@contextmanager
+def quiet_notifications():
+    """
+    Run notification tasks inline with an in-memory mail backend, so a
+    benchmark neither needs a broker nor floods the console.
+    """
+    from library_system.celery import app
+
+    always_eager = app.conf.task_always_eager
+    app.conf.task_always_eager = True
+    try:
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            yield
+    finally:
+        app.conf.task_always_eager = always_eager
+
+
+def seed_members(count:int, prefix:str='bench'):
+    """
+    Create members without paying for password hashing.
+
+    Args:
+        count (int): Number of members to create
+        prefix (str): Username prefix, used again for cleanup
+    """
+    users = User.objects.bulk_create([
+        User(username=f'{prefix}-{i}', email=f'{prefix}-{i}@example.com', first_name=prefix)
+        for i in range(count)
+    ])
+    return Member.objects.bulk_create([Member(user=user) for user in users])
+
+
+def seed_books(count:int, prefix:str='bench', title=None):
+    """
+    Create books spread over a handful of authors.
+
+    Args:
+        count (int): Number of books to create
+        prefix (str): Author first name, used again for cleanup
+        title (callable): Title of the i-th book; ``<prefix> book <i>`` by default
+    """
+    authors = Author.objects.bulk_create([
+        Author(first_name=prefix, last_name=f'Author {i}') for i in range(max(count // 100, 1))
+    ])
+    return Book.objects.bulk_create([
+        Book(
+            title=title(i) if title else f'{prefix} book {i:07d}',
+            author=authors[i % len(authors)],
+            isbn=f'{prefix[:3]}{i:010d}',
+            available_copies=5
+        )
+        for i in range(count)
+    ], batch_size=5000)
+
+
+def seed_loans(count:int, books:int=100, active:float=1.0, overdue:bool=False, prefix:str='bench'):
+    """
+    Create loans spread over books, members and loan dates.
+
+    Every member borrows each book at most once, so enough members are
+    created to respect the one-active-loan-per-book constraint. Loans are
+    dated one day apart per thousand rows, oldest first, so that date
+    orderings have realistic ties.
+
+    Args:
+        count (int): Number of loans to create
+        books (int): Number of books to spread them over
+        active (float): Fraction of loans that are not returned
+        overdue (bool): Make every loan past its due date
+        prefix (str): Seed prefix, used again for cleanup
+    """
+    book_ids = [book.id for book in seed_books(books, prefix=prefix)]
+    member_ids = [member.id for member in seed_members(-(-count // books), prefix=prefix)]
+    today = now().date()
+    batch_size = 1000
+
+    for start in range(0, count, batch_size):
+        loan_date = today - timedelta(days=(count - start) // batch_size + (30 if overdue else 0))
+        loans = Loan.objects.bulk_create([
+            Loan(
+                book_id=book_ids[i % books],
+                member_id=member_ids[i // books],
+                due_date=loan_date + timedelta(days=14),
+                is_returned=(i % 100) >= active * 100,
+            )
+            for i in range(start, min(start + batch_size, count))
+        ])
+        # loan_date is auto_now_add, so it can only be backdated after insert
+        Loan.objects.filter(id__in=[loan.id for loan in loans]).update(loan_date=loan_date)
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough SMTP to accept and discard what Django's SMTP backend sends.
+    """
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        self.reply('220 sink ESMTP')
+        for line in self.rfile:
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith('EHLO'):
+                self.reply('250-sink')
+                self.reply('250 8BITMIME')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                for data in self.rfile:
+                    if data.rstrip(b'\r\n') == b'.':
+                        break
+                self.server.received += 1
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                # HELO, MAIL, RCPT, RSET, NOOP
+                self.reply('250 OK')
+
+
+@contextmanager
+def smtp_sink():
+    """
+    Run a local SMTP server that discards mail, and point the SMTP email
+    backend at it. Yields the server, whose ``received`` counts messages.
+    """
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPSinkHandler)
+    server.daemon_threads = True
+    server.received = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1',
+            EMAIL_PORT=server.server_address[1],
+            EMAIL_USE_TLS=False,
+            EMAIL_USE_SSL=False,
+            EMAIL_HOST_USER='',
+            EMAIL_HOST_PASSWORD='',
+        ):
+            yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def analyze():
+    """
+    Refresh planner statistics after seeding, where the backend has them.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+
+def timed(func, repeat:int=5):
+    """
+    Best wall time of a callable in milliseconds and its query count.
+
+    Args:
+        func: Callable to time
+        repeat (int): Number of runs
+    """
+    best = None
+    for _ in range(repeat):
+        queries = 0
+
+        def count_query(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            started = time.perf_counter()
+            func()
+            elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, queries
+
+
+def cleanup(prefix:str='bench'):
+    """
+    Delete everything seeded under a prefix.
+
+    Args:
+        prefix (str): Prefix passed to the seed helpers
+    """
+    members = Member.objects.filter(user__username__startswith=f'{prefix}-').values_list('id', flat=True)
+    OutboxEvent.objects.filter(payload__member_id__in=list(members)).delete()
+    User.objects.filter(username__startswith=f'{prefix}-').delete()
+    Author.objects.filter(first_name=prefix).delete()
+
+
+@scenario('checkout')
+def checkout(out, size=None, workers=8, **options):
+    """
+    Hammer a single book from many threads and check nothing is oversold.
+
+    ``size`` copies are put on the shelf and twice as many checkouts are
+    attempted, so exactly half of them must be rejected.
+    """
+    from library.circulation import checkout_book
+
+    copies = size or 100
+    author = Author.objects.create(first_name='bench', last_name='checkout')
+    book = Book.objects.create(title='Launch Day', author=author, isbn='bench-0001', available_copies=copies)
+    members = queue.Queue()
+    for member in seed_members(copies * 2):
+        members.put(member.id)
+
+    counters = {'loaned': 0, 'rejected': 0, 'retries': 0}
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            while True:
+                try:
+                    member_id = members.get_nowait()
+                except queue.Empty:
+                    return
+                while True:
+                    try:
+                        checkout_book(book_id=book.id, member_id=member_id)
+                        outcome = 'loaned'
+                    except ValidationError:
+                        outcome = 'rejected'
+                    except OperationalError:
+                        with lock:
+                            counters['retries'] += 1
+                        continue
+                    break
+                with lock:
+                    counters[outcome] += 1
+        finally:
+            connection.close()
+
+    try:
+        with quiet_notifications():
+            threads = [threading.Thread(target=worker) for _ in range(workers)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+
+        book.refresh_from_db()
+        loans = book.loans.count()
+        attempts = counters['loaned'] + counters['rejected']
+
+        out.write(f'workers:        {workers}')
+        out.write(f'copies:         {copies}')
+        out.write(f'attempts:       {attempts}')
+        out.write(f'loaned:         {counters["loaned"]}')
+        out.write(f'rejected:       {counters["rejected"]}')
+        out.write(f'lock retries:   {counters["retries"]}')
+        out.write(f'final stock:    {book.available_copies}')
+        out.write(f'oversold:       {max(loans - copies, 0)}')
+        out.write(f'elapsed:        {elapsed:.3f}s')
+        out.write(f'throughput:     {attempts / elapsed:.1f} checkouts/s')
+    finally:
+        cleanup()
+
+
+@scenario('pagination')
+def pagination(out, size=None, **options):
+    """
+    Compare OFFSET and keyset pagination of the loan list at growing depths.
+
+    ``size`` loans are seeded (default 200,000) and the page at 0%, 10%, 50%
+    and 90% of the table is fetched both ways.
+    """
+    from library.pagination import LoanPagination
+
+    count = size or 200_000
+    page_size = LoanPagination.page_size
+    ordering = LoanPagination.ordering
+    paginator = LoanPagination()
+
+    with rolled_back():
+        seed_loans(count)
+        queryset = Loan.objects.select_related('book__author', 'member__user').order_by(*ordering)
+
+        out.write(f'loans: {count}, page size: {page_size}')
+        out.write(f'{"depth":>6} {"offset ms":>10} {"keyset ms":>10}')
+        for depth in (0, 0.1, 0.5, 0.9):
+            offset = int(count * depth)
+
+            def offset_page():
+                # What PageNumberPagination does: COUNT(*) and OFFSET
+                queryset.count()
+                list(queryset[offset:offset + page_size])
+
+            boundary = queryset[offset - 1] if offset else None
+
+            def keyset_page():
+                page = queryset
+                if boundary is not None:
+                    page = page.filter(paginator.get_seek_filter(paginator.get_row_key(boundary), reverse=False))
+                list(page[:page_size + 1])
+
+            offset_ms, _ = timed(offset_page)
+            keyset_ms, _ = timed(keyset_page)
+            out.write(f'{depth:>6.0%} {offset_ms:>10.2f} {keyset_ms:>10.2f}')
+
+
+@scenario('overdue-plan')
+def overdue_plan(out, size=None, **options):
+    """
+    Show the query plans of the overdue lookups over seeded loans.
+
+    ``size`` loans are seeded (default 100,000), a tenth of them still
+    active and all of them past due, so the partial indexes on active loans
+    cover a small slice of the table.
+    """
+    from library.operations import get_loan_overdue_members, get_member_overdue_book_title_values
+
+    count = size or 100_000
+
+    with rolled_back():
+        seed_loans(count, active=0.1, overdue=True)
+        analyze()
+
+        members = get_loan_overdue_members()
+        member_id = members.values_list('id', flat=True).first()
+        titles = get_member_overdue_book_title_values(member_id)
+
+        for label, queryset in (('overdue members', members), ('member overdue titles', titles)):
+            elapsed, queries = timed(lambda: list(queryset.all()))
+            out.write(f'-- {label}: {elapsed:.2f}ms')
+            out.write(queryset.explain())
+
+
+@scenario('overdue-sweep')
+def overdue_sweep(out, size=None, **options):
+    """
+    Compare building the nightly reminder payloads per member and streamed.
+
+    ``size`` overdue loans are seeded (default 100,000), five per member.
+    Only payload building is timed; no mail is sent.
+    """
+    from library.operations import (get_loan_overdue_members, get_member_overdue_book_title_values,
+                                    iter_overdue_member_digests)
+
+    count = size or 100_000
+
+    def per_member():
+        # The sweep before digests: one title query per overdue member
+        for member in get_loan_overdue_members().iterator(chunk_size=500):
+            titles = [book['book__title'] for book in get_member_overdue_book_title_values(member.id)]
+            {'id': member.id, 'name': member.user.first_name, 'email': member.user.email, 'titles': titles}
+
+    def streamed():
+        for digest in iter_overdue_member_digests():
+            pass
+
+    with rolled_back():
+        seed_loans(count, books=5, overdue=True)
+        analyze()
+
+        out.write(f'overdue loans: {count}, members: {count // 5}')
+        out.write(f'{"path":>12} {"queries":>8} {"wall ms":>10}')
+        for label, func in (('per-member', per_member), ('streamed', streamed)):
+            elapsed, queries = timed(func, repeat=1)
+            out.write(f'{label:>12} {queries:>8} {elapsed:>10.1f}')
+
+
+@scenario('mail')
+def mail_throughput(out, size=None, workers=8, **options):
+    """
+    Compare one SMTP connection per message with pooled connections.
+
+    ``size`` messages (default 5,000) are split over ``workers`` threads and
+    sent to a local SMTP sink, first with ``send_mail`` per message as the
+    tasks used to, then through ``notifications.send_messages``. A local
+    sink has no network round trips or TLS, so real servers widen the gap.
+    """
+    from django.core.mail import send_mail
+    from library.notifications import build_message, send_messages
+
+    count = size or 5_000
+    per_worker = count // workers
+
+    def per_message():
+        for i in range(per_worker):
+            send_mail('Reminder', 'Please return your books.', None, [f'bench-{i}@example.com'])
+
+    def pooled():
+        send_messages(
+            build_message('Reminder', 'Please return your books.', f'bench-{i}@example.com')
+            for i in range(per_worker)
+        )
+
+    with smtp_sink() as server:
+        out.write(f'messages: {per_worker * workers}, workers: {workers}')
+        out.write(f'{"path":>12} {"received":>9} {"wall ms":>10} {"msg/s/worker":>13}')
+        for label, func in (('per-message', per_message), ('pooled', pooled)):
+            server.received = 0
+            threads = [threading.Thread(target=func) for _ in range(workers)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            out.write(f'{label:>12} {server.received:>9} {elapsed * 1000:>10.1f} {per_worker / elapsed:>13.1f}')
+
+
+@scenario('catalog')
+def catalog(out, size=None, **options):
+    """
+    Requests per second of the book list and detail endpoints, uncached,
+    from the response cache and revalidated with ``If-None-Match``.
+
+    ``size`` books are seeded (default 10,000); detail requests cycle over
+    the first 50 of them. Requests go through the full middleware and view
+    stack in-process, without a network hop.
+    """
+    from django.test import Client
+    from django.urls import reverse
+
+    count = size or 10_000
+    requests = 500
+    client = Client(SERVER_NAME='localhost')
+
+    with rolled_back():
+        book_ids = [book.id for book in seed_books(count)][:50]
+        urls = {
+            'list': [reverse('api:book-list')],
+            'detail': [reverse('api:book-detail', kwargs={'pk': book_id}) for book_id in book_ids],
+        }
+
+        out.write(f'books: {count}, requests per run: {requests}')
+        out.write(f'{"endpoint":>8} {"uncached":>10} {"cached":>10} {"304":>10}  (req/s)')
+        for endpoint, paths in urls.items():
+            rates = []
+            for mode in ('uncached', 'cached', '304'):
+                with override_settings(CATALOG_CACHE_TIMEOUT=0 if mode == 'uncached' else 300):
+                    # Warms the cache, and collects the ETags clients would hold
+                    etags = {path: client.get(path).get('ETag', '') for path in paths}
+                    started = time.perf_counter()
+                    for i in range(requests):
+                        path = paths[i % len(paths)]
+                        client.get(path, HTTP_IF_NONE_MATCH=etags[path] if mode == '304' else '')
+                    rates.append(requests / (time.perf_counter() - started))
+            out.write(f'{endpoint:>8} {rates[0]:>10.0f} {rates[1]:>10.0f} {rates[2]:>10.0f}')
+
+
+SEARCH_WORDS = (
+    'python', 'django', 'celery', 'history', 'garden', 'ocean', 'kitchen', 'winter', 'river', 'mountain',
+    'science', 'poetry', 'travel', 'music', 'empire', 'forest', 'desert', 'harbor', 'machine', 'dragon',
+)
+
+
+@scenario('search')
+def search(out, size=None, **options):
+    """
+    Latency of book searches: a unique word, common words, an author name
+    and a typo, over ``size`` seeded books (default 1,000,000).
+
+    Titles are two words of a 20 word vocabulary and a serial number, so a
+    single word matches 5% of the books and ranking, not matching, is what
+    the common searches cost. Run it on PostgreSQL: elsewhere search is an
+    unindexed substring scan.
+    """
+    from library.search import search_books
+
+    count = size or 1_000_000
+    words = SEARCH_WORDS
+    queryset = Book.objects.defer('search_vector').select_related('author')
+    searches = (
+        ('unique', f'{count // 2:07d}'),
+        ('one word', words[0]),
+        ('two words', f'{words[0]} {words[1]}'),
+        ('author', 'Author 42'),
+        ('typo', 'pyhton'),
+    )
+
+    with rolled_back():
+        seed_books(count, title=lambda i: f'{words[i % 20].title()} {words[i // 20 % 20]} {i:07d}')
+        analyze()
+
+        out.write(f'books: {count}, backend: {connection.vendor}, best of 5, first 20 results')
+        out.write(f'{"search":>10} {"query":>20} {"found":>6} {"ms":>9}')
+        for label, query in searches:
+            elapsed, _ = timed(lambda: list(search_books(query, queryset)[:20]))
+            found = len(search_books(query, queryset)[:20])
+            out.write(f'{label:>10} {query:>20} {found:>6} {elapsed:>9.1f}')
+
+
+@scenario('import')
+def catalog_import(out, size=None, **options):
+    """
+    Books per minute of a catalog import: a fresh catalog of ``size`` books
+    (default 100,000) over ``size / 100`` authors, then the same file again,
+    which updates every book and creates no author.
+
+    The file is generated in memory, so only parsing and writing are timed.
+    The target is 100,000 books per minute.
+    """
+    import io
+
+    from library.choices import FileFormatChoices
+    from library.importers import import_catalog
+
+    count = size or 100_000
+    catalog = io.StringIO()
+    writer = csv.writer(catalog)
+    writer.writerow(('title', 'isbn', 'genre', 'available_copies', 'author_first_name', 'author_last_name'))
+    authors = max(count // 100, 1)
+    for i in range(count):
+        writer.writerow((f'Imported book {i:07d}', f'imp{i:010d}', 'dev', 2, 'bench', f'Import author {i % authors}'))
+
+    with rolled_back():
+        out.write(f'books: {count}, backend: {connection.vendor}')
+        out.write(f'{"pass":>8} {"imported":>9} {"failed":>7} {"seconds":>8} {"books/min":>10}')
+        for label in ('insert', 'upsert'):
+            catalog.seek(0)
+            started = time.perf_counter()
+            result = import_catalog(catalog, FileFormatChoices.CSV)
+            elapsed = time.perf_counter() - started
+            out.write(
+                f'{label:>8} {result["imported"]:>9} {result["failed"]:>7} {elapsed:>8.2f} {count / elapsed * 60:>10.0f}'
+            )
+
+
+def current_rss() -> int:
+    """
+    Resident set size of this process in bytes, or 0 where it cannot be read.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+@scenario('export')
+def export(out, size=None, **options):
+    """
+    Stream the loan export over ``size`` seeded loans (default 1,000,000),
+    plain and gzipped, sampling the process RSS after every chunk.
+
+    Memory should stay flat: only one chunk of rows is ever held. RSS is
+    read from ``/proc``, so it is only reported on Linux.
+    """
+    from django.test import Client
+    from django.urls import reverse
+
+    count = size or 1_000_000
+    client = Client(SERVER_NAME='localhost')
+
+    with rolled_back():
+        seed_loans(count, active=0.1)
+        analyze()
+
+        out.write(f'loans: {count}, backend: {connection.vendor}')
+        out.write(f'{"encoding":>9} {"rows":>9} {"MB":>8} {"seconds":>8} {"rows/s":>9} {"RSS start":>10} {"RSS max":>8}')
+        for encoding in ('identity', 'gzip'):
+            rss_start = rss_max = current_rss()
+            started = time.perf_counter()
+            response = client.get(reverse('api:loan-export'), HTTP_ACCEPT_ENCODING=encoding)
+            size_bytes = 0
+            for chunk in response.streaming_content:
+                size_bytes += len(chunk)
+                rss_max = max(rss_max, current_rss())
+            elapsed = time.perf_counter() - started
+            out.write(
+                f'{encoding:>9} {count:>9} {size_bytes / 2**20:>8.1f} {elapsed:>8.2f} {count / elapsed:>9.0f} '
+                f'{rss_start / 2**20:>8.1f}MB {rss_max / 2**20:>6.1f}MB'
+            )
+
+
+@scenario('serializers')
+def serializer_paths(out, size=None, **options):
+    """
+    Rendering ``size`` rows (default 10,000) of loans, books and members
+    with their DRF serializers versus their ``ValuesRepresentation``, the
+    list endpoints' fast path, and checking both give the same JSON.
+
+    ``fetch+render`` includes the query; ``render`` times the rows already
+    in memory, the part the fast path replaces.
+    """
+    from rest_framework.renderers import JSONRenderer
+
+    from library.serializers import BookSerializer, LoanSerializer, MemberSerializer
+
+    count = size or 10_000
+
+    with rolled_back():
+        seed_loans(count)
+        seed_books(count, prefix='render')
+        seed_members(count, prefix='render')
+        analyze()
+
+        out.write(f'rows: {count}, backend: {connection.vendor}, best of 5')
+        out.write(f'{"rows":>8} {"path":>11} {"fetch+render ms":>16} {"render ms":>10} {"same JSON":>10}')
+        for label, serializer_class, queryset in (
+            ('loans', LoanSerializer, Loan.objects.order_by('id')),
+            ('books', BookSerializer, Book.objects.defer('search_vector').order_by('id')),
+            ('members', MemberSerializer, Member.objects.order_by('id')),
+        ):
+            queryset = queryset[:count]
+            instances = serializer_class.setup_eager_loading(queryset)
+            representation = serializer_class.get_values_representation()
+            values = representation.apply(queryset)
+
+            def serialize(rows):
+                return serializer_class(rows, many=True).data
+
+            def from_values(rows):
+                return [representation.to_representation(row) for row in rows]
+
+            fetched_instances, fetched_values = list(instances), list(values)
+            same = JSONRenderer().render(serialize(fetched_instances)) == JSONRenderer().render(
+                from_values(fetched_values))
+
+            for path, render, rows, fetched in (
+                ('serializer', serialize, instances, fetched_instances),
+                ('values', from_values, values, fetched_values),
+            ):
+                total, _ = timed(lambda: render(list(rows.all())))
+                render_only, _ = timed(lambda: render(fetched))
+                out.write(f'{label:>8} {path:>11} {total:>16.1f} {render_only:>10.1f} {str(same):>10}')
+
+
+# Seconds each endpoint is loaded for, per deployment
+LOAD_SECONDS = 5
+
+
+@contextmanager
+def serving(app:str, workers:int, worker_class:str=None):
+    """
+    Serve the project with gunicorn in a subprocess. Yields the port.
+
+    Args:
+        app (str): WSGI or ASGI application path
+        workers (int): Worker processes
+        worker_class (str): Gunicorn worker class, its sync workers by default
+    """
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    command = [sys.executable, '-m', 'gunicorn', app, '--workers', str(workers), '--bind', f'127.0.0.1:{port}',
+               '--log-level', 'warning']
+    if worker_class:
+        command += ['--worker-class', worker_class]
+    process = subprocess.Popen(command)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f'{app} exited with status {process.returncode}.')
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        yield port
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+async def _http_get(reader, writer, path):
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length, close = 0, False
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection':
+            close = value.strip().lower() == 'close'
+    await reader.readexactly(length)
+    return status, close
+
+
+async def http_load(port:int, paths, connections:int, seconds:float):
+    """
+    Request paths in turn over concurrent keep-alive connections, reopening
+    those the server closes, for a fixed time.
+
+    Args:
+        port (int): Local server port
+        paths (list[str]): Paths to request
+        connections (int): Concurrent connections
+        seconds (float): Duration of the run
+
+    Returns:
+        tuple: Latencies of the 200 responses in milliseconds, and the
+            number of failed requests
+    """
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + seconds
+
+    async def client(index):
+        nonlocal errors
+        writer = None
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                status, close = await _http_get(reader, writer, paths[index % len(paths)])
+            except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+                status, close = None, True
+            if status == 200:
+                latencies.append((time.perf_counter() - started) * 1000)
+            else:
+                errors += 1
+            if close and writer is not None:
+                writer.close()
+                writer = None
+            index += connections
+        if writer is not None:
+            writer.close()
+
+    await asyncio.gather(*(client(index) for index in range(connections)))
+    return latencies, errors
+
+
+@scenario('asgi')
+def asgi_load(out, size=None, workers=8, **options):
+    """
+    Load the async endpoints under ``/api/async/`` over ``size`` concurrent
+    connections (default 64), served by gunicorn with ``workers`` sync WSGI
+    workers, then by as many uvicorn ASGI workers.
+
+    Needs ``gunicorn`` and ``uvicorn`` installed. The servers run in their
+    own processes, so the data is committed and removed afterwards; point
+    this at a PostgreSQL database, where queries wait on the network as they
+    do in production.
+    """
+    connections = size or 64
+    deployments = (
+        ('wsgi', 'library_system.wsgi:application', None),
+        ('asgi', 'library_system.asgi:application', 'uvicorn.workers.UvicornWorker'),
+    )
+
+    try:
+        book_ids = [book.id for book in seed_books(1000)]
+        analyze()
+        endpoints = (
+            ('book', [f'/api/async/books/{book_id}/' for book_id in book_ids]),
+            ('availability', [f'/api/async/books/{book_id}/availability/' for book_id in book_ids]),
+            ('top-active', ['/api/async/members/top-active/?number=10']),
+        )
+
+        out.write(f'connections: {connections}, workers: {workers}, {LOAD_SECONDS}s per endpoint, '
+                  f'backend: {connection.vendor}')
+        out.write(f'{"server":>6} {"endpoint":>13} {"requests":>9} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8} '
+                  f'{"errors":>7}')
+        for label, app, worker_class in deployments:
+            with serving(app, workers, worker_class) as port:
+                for endpoint, paths in endpoints:
+                    # Warm up the workers' connections and caches
+                    asyncio.run(http_load(port, paths, connections, 1))
+                    latencies, errors = asyncio.run(http_load(port, paths, connections, LOAD_SECONDS))
+                    latencies.sort()
+                    p50 = latencies[len(latencies) // 2] if latencies else 0
+                    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+                    out.write(
+                        f'{label:>6} {endpoint:>13} {len(latencies):>9} {len(latencies) / LOAD_SECONDS:>8.0f} '
+                        f'{p50:>8.1f} {p99:>8.1f} {errors:>7}'
+                    )
+    finally:
+        cleanup()
+
@@ -0,0 +1,115 @@
+"""
+Versioned cache namespaces.
+
+Entries are cached under keys that embed the versions of the namespaces they
+depend on. Bumping a version retires every entry of the namespace in one
+cache write; retired entries age out on their own.
+
+The catalog uses three kinds of namespace:
+
+* ``CATALOG``: any book or author, bumped when one is saved or deleted
+* ``CATALOG_BOOK_LISTS``: book list pages, which also show stock
+* ``catalog_book(id)``: one book's detail, which also shows its stock
+
+so a checkout only retires the book lists and that one book.
+
+``deletions(model)`` namespaces are only ever bumped, when a row of the
+model is deleted; conditional GETs of lists use them as deletion counters.
+"""
+import time
+
+from django.core.cache import cache
+
+CATALOG = 'catalog'
+CATALOG_BOOK_LISTS = 'catalog:book-lists'
+
+
+def catalog_book(book_id) -> str:
+    return f'catalog:book:{book_id}'
+
+
+def deletions(model) -> str:
+    return f'deletions:{model._meta.label_lower}'
+
+
+def _version_key(namespace):
+    return f'{namespace}:version'
+
+
+def _new_version():
+    # Never one a lost version key held, so entries built under it stay retired
+    return time.time_ns()
+
+
+def get_versions(*namespaces) -> dict:
+    """
+    Get the current version of namespaces in one cache round trip.
+
+    Args:
+        *namespaces (str): Namespaces to look up
+
+    Returns:
+        dict: Version by namespace
+    """
+    keys = {_version_key(namespace): namespace for namespace in namespaces}
+    found = cache.get_many(list(keys))
+
+    versions = {}
+    for key, namespace in keys.items():
+        if key not in found:
+            cache.add(key, _new_version(), timeout=None)
+            found[key] = cache.get(key)
+        versions[namespace] = found[key]
+    return versions
+
+
+def get_version(namespace:str):
+    return get_versions(namespace)[namespace]
+
+
+async def aget_versions(*namespaces) -> dict:
+    """
+    Async ``get_versions``.
+
+    Args:
+        *namespaces (str): Namespaces to look up
+    """
+    keys = {_version_key(namespace): namespace for namespace in namespaces}
+    found = await cache.aget_many(list(keys))
+
+    versions = {}
+    for key, namespace in keys.items():
+        if key not in found:
+            await cache.aadd(key, _new_version(), timeout=None)
+            found[key] = await cache.aget(key)
+        versions[namespace] = found[key]
+    return versions
+
+
+async def aget_version(namespace:str):
+    return (await aget_versions(namespace))[namespace]
+
+
+def invalidate(*namespaces):
+    """
+    Retire every cached entry of namespaces.
+
+    Args:
+        *namespaces (str): Namespaces to bump
+    """
+    for namespace in namespaces:
+        try:
+            cache.incr(_version_key(namespace))
+        except ValueError:
+            # The version expired or was evicted
+            cache.set(_version_key(namespace), _new_version(), timeout=None)
+
+
+def invalidate_book_stock(book_ids):
+    """
+    Retire cached catalog pages showing the stock of some books.
+
+    Args:
+        book_ids (list[int]): Books whose ``available_copies`` changed
+    """
+    invalidate(CATALOG_BOOK_LISTS, *(catalog_book(book_id) for book_id in book_ids))
@@ -8,4 +8,22 @@ class BookGenreChoices(models.TextChoices):
     SCIENCE_FICTION = 'sci-fi', 'Sci-Fi'
     PROGRAMMING = 'dev', 'Software Development'
     BIOGRAPHY = 'Biography'
-    OTHER = 'Other'
\ No newline at end of file
+    OTHER = 'Other'
+
+class SweepStatusChoices(models.TextChoices):
+    RUNNING = 'running', 'Running'
+    COMPLETED = 'completed', 'Completed'
+
+class ImportStatusChoices(models.TextChoices):
+    PENDING = 'pending', 'Pending'
+    RUNNING = 'running', 'Running'
+    COMPLETED = 'completed', 'Completed'
+    FAILED = 'failed', 'Failed'
+
+class FileFormatChoices(models.TextChoices):
+    CSV = 'csv', 'CSV'
+    NDJSON = 'ndjson', 'JSON Lines'
+
+class OutboxStatusChoices(models.TextChoices):
+    PENDING = 'pending', 'Pending'
+    DEAD = 'dead', 'Dead'
@@ -0,0 +1,266 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils.timezone import now
+from rest_framework.exceptions import NotFound, ValidationError
+
+from library import outbox
+from library.models import Book, Loan, Member, LOAN_PERIOD
+from library.signals import loans_checked_out, loans_returned
+
+LOANED = 'loaned'
+RETURNED = 'returned'
+FAILED = 'failed'
+
+ALREADY_LOANED = 'Member already has an active loan for this book.'
+
+
+def adjust_active_loan_count(member_id, delta:int, book_ids) -> int:
+    """
+    Move a member's denormalized active loan counter by ``delta``.
+
+    Must run in the same transaction as the loan change it accounts for.
+    ``loans_checked_out`` or ``loans_returned`` is sent once it commits.
+    Returns the number of members updated, zero if the member does not exist.
+    The counter stops at zero: loans created outside circulation never
+    raised it, and ``reconcile_active_loans`` puts it right.
+
+    Args:
+        member_id (int): Member ID
+        delta (int): Change in active loans
+        book_ids (list[int]): Books whose loans changed
+    """
+    updated = Member.objects.filter(
+        id=member_id
+    ).update(active_loan_count=Greatest(F('active_loan_count') + delta, 0), updated_at=now())
+
+    if updated:
+        signal = loans_checked_out if delta > 0 else loans_returned
+        transaction.on_commit(
+            lambda: signal.send(sender=Loan, member_id=member_id, book_ids=list(book_ids)),
+            robust=True
+        )
+
+    return updated
+
+
+def checkout_book(book_id, member_id) -> Loan:
+    """
+    Loan a copy of a book to a member.
+
+    Stock is decremented with a single conditional UPDATE, so concurrent
+    checkouts of the last copy can never drive ``available_copies`` below zero.
+    The member's active loan counter moves in the same transaction, and the
+    loan notification is recorded in the outbox alongside the loan.
+
+    Rows are always touched book first, then member, like every other
+    circulation path, so concurrent circulation cannot deadlock.
+
+    Args:
+        book_id (int): Book ID
+        member_id (int): Member ID
+    """
+    try:
+        with transaction.atomic():
+            try:
+                decremented = Book.objects.filter(
+                    id=book_id,
+                    available_copies__gt=0
+                ).update(available_copies=F('available_copies') - 1, updated_at=now())
+            except (TypeError, ValueError):
+                raise NotFound(detail='Book does not exist.')
+
+            if not decremented:
+                # Only the failure path pays for telling the two cases apart
+                if not Book.objects.filter(id=book_id).exists():
+                    raise NotFound(detail='Book does not exist.')
+                raise ValidationError(detail='No available copies.')
+
+            try:
+                member_exists = adjust_active_loan_count(member_id, 1, [int(book_id)])
+            except (TypeError, ValueError):
+                member_exists = False
+
+            if not member_exists:
+                raise ValidationError(detail='Member does not exist.')
+
+            loan = Loan.objects.create(book_id=book_id, member_id=member_id)
+
+            outbox.publish(outbox.LOANS_CHECKED_OUT, member_id=int(member_id), loan_ids=[loan.id])
+    except IntegrityError:
+        # The stock and counter changes are rolled back with the rejected loan
+        raise ValidationError(detail=ALREADY_LOANED)
+
+    return loan
+
+
+def return_book(book_id, member_id) -> Loan:
+    """
+    Return a member's active loan of a book and restock the copy.
+
+    The loan is closed with a conditional UPDATE on ``is_returned`` so two
+    concurrent returns of the same loan restock the book only once.
+
+    Args:
+        book_id (int): Book ID
+        member_id (int): Member ID
+    """
+    try:
+        loan = Loan.objects.filter(
+            book_id=book_id,
+            member_id=member_id,
+            is_returned=False
+        ).only('id', 'book_id', 'member_id').first()
+    except (TypeError, ValueError):
+        loan = None
+
+    if loan is None:
+        raise ValidationError(detail='Active loan does not exist.')
+
+    today = now().date()
+
+    with transaction.atomic():
+        returned = Loan.objects.filter(
+            id=loan.id,
+            is_returned=False
+        ).update(is_returned=True, return_date=today, updated_at=now())
+
+        if not returned:
+            raise ValidationError(detail='Active loan does not exist.')
+
+        Book.objects.filter(id=book_id).update(available_copies=F('available_copies') + 1, updated_at=now())
+        adjust_active_loan_count(loan.member_id, -1, [loan.book_id])
+
+    loan.is_returned = True
+    loan.return_date = today
+
+    return loan
+
+
+def _failed(book_id, error:str) -> dict:
+    return {'book_id': book_id, 'status': FAILED, 'error': error}
+
+
+def bulk_checkout(member_id:int, book_ids) -> list:
+    """
+    Loan a cart of books to a member in one transaction.
+
+    Stock for the whole cart is checked with one locking query and existing
+    loans with another, the loans are inserted with a single ``bulk_create``
+    and one aggregated notification is recorded in the outbox. Items that cannot be
+    loaned are reported and skipped without failing the rest of the cart.
+
+    Args:
+        member_id (int): Member ID, expected to exist
+        book_ids (list[int]): Books in the cart, in scan order
+
+    Returns:
+        list[dict]: One result per requested book, in request order
+    """
+    results = []
+    loans = []
+    seen = set()
+
+    with transaction.atomic():
+        stock = dict(
+            Book.objects.select_for_update().filter(
+                id__in=set(book_ids)
+            ).values_list('id', 'available_copies')
+        )
+        already_loaned = set(
+            Loan.objects.filter(
+                member_id=member_id,
+                book_id__in=list(stock),
+                is_returned=False
+            ).values_list('book_id', flat=True)
+        )
+
+        due_date = now().date() + LOAN_PERIOD
+
+        for book_id in book_ids:
+            if book_id in seen:
+                results.append(_failed(book_id, 'Duplicate book in request.'))
+                continue
+            seen.add(book_id)
+
+            if book_id not in stock:
+                results.append(_failed(book_id, 'Book does not exist.'))
+            elif book_id in already_loaned:
+                results.append(_failed(book_id, ALREADY_LOANED))
+            elif stock[book_id] < 1:
+                results.append(_failed(book_id, 'No available copies.'))
+            else:
+                loan = Loan(book_id=book_id, member_id=member_id, due_date=due_date)
+                loans.append(loan)
+                results.append({'book_id': book_id, 'status': LOANED, 'loan': loan})
+
+        if loans:
+            try:
+                with transaction.atomic():
+                    Loan.objects.bulk_create(loans)
+            except IntegrityError:
+                # Only reachable when the same cart is checked out concurrently
+                raise ValidationError(detail=ALREADY_LOANED)
+            # Every loaned book loses exactly one copy, so one UPDATE covers the cart
+            Book.objects.filter(
+                id__in=[loan.book_id for loan in loans]
+            ).update(available_copies=F('available_copies') - 1, updated_at=now())
+            adjust_active_loan_count(member_id, len(loans), [loan.book_id for loan in loans])
+
+            outbox.publish(outbox.LOANS_CHECKED_OUT, member_id=member_id, loan_ids=[loan.id for loan in loans])
+
+    for result in results:
+        if 'loan' in result:
+            result['loan_id'] = result.pop('loan').id
+
+    return results
+
+
+def bulk_return(member_id:int, book_ids) -> list:
+    """
+    Return a cart of books for a member in one transaction.
+
+    Args:
+        member_id (int): Member ID
+        book_ids (list[int]): Books being returned, in scan order
+
+    Returns:
+        list[dict]: One result per requested book, in request order
+    """
+    results = []
+    seen = set()
+    today = now().date()
+
+    with transaction.atomic():
+        # A member holds at most one active loan per book
+        active_loans = dict(
+            Loan.objects.select_for_update().filter(
+                member_id=member_id,
+                book_id__in=set(book_ids),
+                is_returned=False
+            ).values_list('book_id', 'id')
+        )
+
+        returned = {}
+        for book_id in book_ids:
+            if book_id in seen:
+                results.append(_failed(book_id, 'Duplicate book in request.'))
+                continue
+            seen.add(book_id)
+
+            if book_id not in active_loans:
+                results.append(_failed(book_id, 'Active loan does not exist.'))
+            else:
+                returned[book_id] = active_loans[book_id]
+                results.append({'book_id': book_id, 'status': RETURNED, 'loan_id': active_loans[book_id]})
+
+        if returned:
+            Loan.objects.filter(
+                id__in=list(returned.values())
+            ).update(is_returned=True, return_date=today, updated_at=now())
+            Book.objects.filter(
+                id__in=list(returned)
+            ).update(available_copies=F('available_copies') + 1, updated_at=now())
+            adjust_active_loan_count(member_id, -len(returned), list(returned))
+
+    return results
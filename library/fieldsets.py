@@ -0,0 +1,119 @@
+"""
+Sparse fieldsets and relation expansion.
+
+``?fields=`` names the fields a response should carry and ``?expand=`` the
+relations it should nest, nested names being joined with dots. Without
+either, responses are rendered in full with every relation nested, as they
+always were. With either, a relation is rendered as its primary key unless
+it is expanded, by ``?expand=`` or by selecting fields inside it:
+
+* ``/api/books/?fields=id,title,available_copies``: three fields, no author
+* ``/api/loans/?fields=id,book.title,member``: the book nested with its
+  title only, the member as its id
+* ``/api/loans/?expand=book.author``: every loan field, the book and its
+  author nested, the member as its id
+
+The serializer drops what was not asked for (see ``EagerLoadingMixin``) and
+the query is cut down to match: only the selected columns are read, and
+only the expanded relations joined.
+"""
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+
+FIELDS_PARAM = 'fields'
+EXPAND_PARAM = 'expand'
+
+
+class Fieldset:
+    """
+    Fields selected from one serializer, and the fieldsets of the relations
+    it expands.
+    """
+
+    def __init__(self):
+        # None: every field
+        self.names = None
+        self.expanded = {}
+
+    def select(self, path):
+        name, *rest = path
+        if self.names is None:
+            self.names = set()
+        self.names.add(name)
+        if rest:
+            self.expanded.setdefault(name, Fieldset()).select(rest)
+
+    def expand(self, path):
+        name, *rest = path
+        if self.names is not None:
+            self.names.add(name)
+        fieldset = self.expanded.setdefault(name, Fieldset())
+        if rest:
+            fieldset.expand(rest)
+
+    def validate(self, serializer, prefix=''):
+        """
+        Check that every selected field is readable from a serializer, and
+        every expanded one is a nested serializer.
+
+        Args:
+            serializer (Serializer): Serializer rendering every field
+            prefix (str): Dotted path of the serializer, for error messages
+        """
+        fields = {name: field for name, field in serializer.fields.items() if not field.write_only}
+        for name in sorted({*(self.names or ()), *self.expanded}):
+            if name not in fields:
+                raise ValidationError(detail=f'Unknown field "{prefix}{name}".')
+        for name, fieldset in sorted(self.expanded.items()):
+            if not isinstance(fields[name], serializers.ModelSerializer):
+                raise ValidationError(detail=f'"{prefix}{name}" cannot be expanded.')
+            fieldset.validate(fields[name], prefix=f'{prefix}{name}.')
+
+    def prune(self, fields):
+        """
+        Drop the fields not selected from a serializer's fields, and render
+        the relations not expanded as primary keys.
+
+        Args:
+            fields (dict): Serializer fields by name
+        """
+        pruned = {}
+        for name, field in fields.items():
+            if not field.write_only:
+                if self.names is not None and name not in self.names:
+                    continue
+                if isinstance(field, serializers.ModelSerializer):
+                    if name in self.expanded:
+                        field.fieldset = self.expanded[name]
+                    else:
+                        field = serializers.PrimaryKeyRelatedField(source=field.source, read_only=True)
+            pruned[name] = field
+        return pruned
+
+
+def _paths(params, name):
+    return [value.strip().split('.') for value in params.get(name, '').split(',') if value.strip()]
+
+
+def parse_fieldset(params, serializer_class):
+    """
+    Read the fieldset a request asks for.
+
+    Args:
+        params (QueryDict): Request query parameters
+        serializer_class (type): Serializer the response is rendered with
+
+    Returns:
+        Fieldset: The selection, or ``None`` for the full representation
+    """
+    fields, expand = _paths(params, FIELDS_PARAM), _paths(params, EXPAND_PARAM)
+    if not fields and not expand:
+        return None
+
+    fieldset = Fieldset()
+    for path in fields:
+        fieldset.select(path)
+    for path in expand:
+        fieldset.expand(path)
+    fieldset.validate(serializer_class())
+    return fieldset
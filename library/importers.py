@@ -0,0 +1,251 @@
+"""
+Bulk catalog import.
+
+Partner catalogs arrive as CSV or JSON Lines files of book records with the
+fields in ``FIELDS``. Records are streamed and written in chunks of
+``CATALOG_IMPORT_CHUNK_SIZE``:
+
+* authors are resolved through an in-memory (first name, last name) to id
+  map, and the chunk's unknown ones are looked up or created in one go
+* books are upserted by ISBN with one ``INSERT ... ON CONFLICT``; an existing
+  book takes the file's title, author and genre, but keeps its stock, which
+  belongs to circulation
+
+Invalid records are skipped and reported by line number, without failing
+the rest of their chunk.
+"""
+import csv
+import json
+from itertools import islice
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from rest_framework.exceptions import ValidationError
+
+from library import caching
+from library.choices import BookGenreChoices, FileFormatChoices
+from library.models import Author, Book
+
+FIELDS = ('title', 'isbn', 'genre', 'available_copies', 'author_first_name', 'author_last_name')
+REQUIRED_FIELDS = ('title', 'isbn', 'author_first_name', 'author_last_name')
+# Book fields an import overwrites on existing books
+UPDATE_FIELDS = ['title', 'author', 'genre', 'updated_at']
+# Invalid records reported in full; the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+
+EXTENSIONS = {
+    '.csv': FileFormatChoices.CSV,
+    '.jsonl': FileFormatChoices.NDJSON,
+    '.ndjson': FileFormatChoices.NDJSON,
+}
+
+
+def detect_format(filename:str) -> str:
+    """
+    Tell the format of a catalog file from its extension.
+
+    Args:
+        filename (str): File name
+    """
+    for extension, file_format in EXTENSIONS.items():
+        if filename.lower().endswith(extension):
+            return file_format
+    raise ValidationError(detail=f'Unknown catalog format, expected one of {", ".join(EXTENSIONS)}.')
+
+
+def iter_records(stream, file_format:str):
+    """
+    Stream the records of a catalog file.
+
+    Args:
+        stream: Text stream of the file
+        file_format (str): ``FileFormatChoices`` value
+
+    Yields:
+        tuple: Line number, the record or ``None``, and why it could not be
+            read or ``None``
+    """
+    if file_format == FileFormatChoices.CSV:
+        reader = csv.DictReader(stream)
+        missing = set(REQUIRED_FIELDS) - set(reader.fieldnames or ())
+        if missing:
+            raise ValidationError(detail=f'Missing CSV columns: {", ".join(sorted(missing))}.')
+        for record in reader:
+            yield reader.line_num, record, None
+        return
+
+    for line, text in enumerate(stream, 1):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError:
+            yield line, None, 'Invalid JSON.'
+            continue
+        if not isinstance(record, dict):
+            yield line, None, 'Expected a JSON object.'
+            continue
+        yield line, record, None
+
+
+def _text(record, name, max_length):
+    value = str(record.get(name) or '').strip()
+    if not value and name in REQUIRED_FIELDS:
+        raise ValueError(f'{name} is required.')
+    if len(value) > max_length:
+        raise ValueError(f'{name} is longer than {max_length} characters.')
+    return value
+
+
+def clean_record(record:dict) -> dict:
+    """
+    Validate a record and normalize it to ``Book`` field values.
+
+    Args:
+        record (dict): Record as read from the file
+    """
+    genre = str(record.get('genre') or BookGenreChoices.OTHER).strip()
+    if genre not in BookGenreChoices.values:
+        raise ValueError(f'Unknown genre "{genre}".')
+
+    try:
+        available_copies = int(record.get('available_copies') or 1)
+    except (TypeError, ValueError):
+        raise ValueError('available_copies must be an integer.')
+    if available_copies < 0:
+        raise ValueError('available_copies must not be negative.')
+
+    return {
+        'title': _text(record, 'title', Book._meta.get_field('title').max_length),
+        'isbn': _text(record, 'isbn', Book._meta.get_field('isbn').max_length),
+        'genre': genre,
+        'available_copies': available_copies,
+        'author': (
+            _text(record, 'author_first_name', Author._meta.get_field('first_name').max_length),
+            _text(record, 'author_last_name', Author._meta.get_field('last_name').max_length),
+        ),
+    }
+
+
+def _fail(result, line, error):
+    result['failed'] += 1
+    if len(result['errors']) < MAX_REPORTED_ERRORS:
+        result['errors'].append({'line': line, 'error': error})
+
+
+def resolve_authors(names, authors:dict):
+    """
+    Add the ids of authors to a name map, creating the authors that do not
+    exist yet.
+
+    Args:
+        names (set[tuple]): (first name, last name) pairs
+        authors (dict): Map of (first name, last name) to author id, updated
+            in place
+    """
+    missing = {name for name in names if name not in authors}
+    if not missing:
+        return
+
+    # Narrowed by last name, matched on both names here; duplicates resolve to the oldest
+    existing = Author.objects.filter(
+        last_name__in={last_name for _, last_name in missing}
+    ).order_by('id').values_list('first_name', 'last_name', 'id')
+    for first_name, last_name, author_id in existing:
+        if (first_name, last_name) in missing:
+            authors.setdefault((first_name, last_name), author_id)
+
+    created = Author.objects.bulk_create([
+        Author(first_name=first_name, last_name=last_name)
+        for first_name, last_name in missing if (first_name, last_name) not in authors
+    ])
+    authors.update({(author.first_name, author.last_name): author.id for author in created})
+
+
+def _upsert_books(books):
+    Book.objects.bulk_create(books, update_conflicts=True, unique_fields=['isbn'], update_fields=UPDATE_FIELDS)
+
+
+def import_chunk(records, authors:dict, result:dict):
+    """
+    Write one chunk of records in a transaction.
+
+    Args:
+        records (list[tuple]): Line number, record and read error of each record
+        authors (dict): Author name map, see ``resolve_authors``
+        result (dict): Running totals, updated in place
+    """
+    # A statement may only upsert an ISBN once; later records win
+    rows = {}
+    for line, record, error in records:
+        result['rows'] += 1
+        if error is None:
+            try:
+                row = clean_record(record)
+            except ValueError as e:
+                error = str(e)
+        if error is not None:
+            _fail(result, line, error)
+            continue
+        rows[row['isbn']] = (line, row)
+    result['imported'] += len(rows)
+
+    with transaction.atomic():
+        resolve_authors({row['author'] for _, row in rows.values()}, authors)
+        books = [
+            Book(
+                title=row['title'],
+                author_id=authors[row['author']],
+                isbn=row['isbn'],
+                genre=row['genre'],
+                available_copies=row['available_copies'],
+            )
+            for _, row in rows.values()
+        ]
+
+        try:
+            with transaction.atomic():
+                _upsert_books(books)
+        except DatabaseError:
+            # Find the offending records one at a time
+            for (line, _), book in zip(rows.values(), books):
+                try:
+                    with transaction.atomic():
+                        _upsert_books([book])
+                except DatabaseError as e:
+                    result['imported'] -= 1
+                    _fail(result, line, str(e))
+
+
+def import_catalog(stream, file_format:str, chunk_size:int=None, progress=None) -> dict:
+    """
+    Import a catalog file of books and their authors.
+
+    Args:
+        stream: Text stream of the file
+        file_format (str): ``FileFormatChoices`` value
+        chunk_size (int): Records written per transaction,
+            ``CATALOG_IMPORT_CHUNK_SIZE`` by default
+        progress (callable): Called with the running totals after each chunk
+
+    Returns:
+        dict: Records read, imported and failed, and the first
+            ``MAX_REPORTED_ERRORS`` failures as ``{'line', 'error'}``
+    """
+    chunk_size = chunk_size or settings.CATALOG_IMPORT_CHUNK_SIZE
+    records = iter_records(stream, file_format)
+    authors = {}
+    result = {'rows': 0, 'imported': 0, 'failed': 0, 'errors': []}
+
+    try:
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                return result
+            import_chunk(chunk, authors, result)
+            if progress is not None:
+                progress(result)
+    finally:
+        # Bulk writes send no post_save, so retire cached catalog pages here
+        if result['imported']:
+            caching.invalidate(caching.CATALOG)
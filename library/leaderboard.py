@@ -0,0 +1,151 @@
+"""
+Cached top-active members leaderboard.
+
+Entries are cached per ``number`` under a shared version key. Any committed
+checkout or return bumps the version, which retires every cached entry in one
+cache write; ``LEADERBOARD_CACHE_TIMEOUT`` bounds staleness for changes that
+do not go through circulation, such as admin edits.
+
+On a miss only the worker holding the rebuild lock recomputes. The others
+serve the last value they can find, or wait briefly for the rebuild.
+
+``aget_top_active`` is the same for async views, on the async cache and ORM
+APIs.
+"""
+import asyncio
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from library import caching
+from library.metrics import registry
+from library.operations import get_top_active_members
+
+NAMESPACE = 'leaderboard:top-active'
+LOCK_TIMEOUT = 10
+WAIT_STEP = 0.05
+
+
+def _entry_key(version, number):
+    return f'leaderboard:top-active:v{version}:{number}'
+
+
+def _stale_key(number):
+    return f'leaderboard:top-active:stale:{number}'
+
+
+def _lock_key(number):
+    return f'leaderboard:top-active:lock:{number}'
+
+
+def _count(result):
+    registry.inc(
+        'library_leaderboard_cache_total', {'result': result},
+        help_text='Top-active leaderboard cache lookups by result.'
+    )
+
+
+def get_version():
+    return caching.get_version(NAMESPACE)
+
+
+def invalidate():
+    """
+    Retire every cached leaderboard entry.
+    """
+    caching.invalidate(NAMESPACE)
+
+
+def get_top_active(number:int):
+    """
+    Get the top active members, from cache when possible.
+
+    Args:
+        number (int): Number of members to return
+    """
+    version = get_version()
+    key = _entry_key(version, number)
+
+    members = cache.get(key)
+    if members is not None:
+        _count('hit')
+        return members
+
+    lock_key = _lock_key(number)
+    if not cache.add(lock_key, version, timeout=LOCK_TIMEOUT):
+        stale = cache.get(_stale_key(number))
+        if stale is not None:
+            _count('stale')
+            return stale
+
+        # Cold cache: give the rebuilding worker a moment before piling on
+        deadline = time.monotonic() + settings.LEADERBOARD_REBUILD_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(WAIT_STEP)
+            members = cache.get(key)
+            if members is not None:
+                _count('hit')
+                return members
+
+        _count('miss')
+        return list(get_top_active_members(number=number))
+
+    _count('miss')
+    try:
+        members = list(get_top_active_members(number=number))
+        cache.set(key, members, timeout=settings.LEADERBOARD_CACHE_TIMEOUT)
+        # Outlives the versioned entry so it can cover for the next rebuild
+        cache.set(_stale_key(number), members, timeout=settings.LEADERBOARD_CACHE_TIMEOUT * 10)
+    finally:
+        cache.delete(lock_key)
+
+    return members
+
+
+async def _afetch(number):
+    return [member async for member in get_top_active_members(number=number).aiterator()]
+
+
+async def aget_top_active(number:int):
+    """
+    Async ``get_top_active``.
+
+    Args:
+        number (int): Number of members to return
+    """
+    version = await caching.aget_version(NAMESPACE)
+    key = _entry_key(version, number)
+
+    members = await cache.aget(key)
+    if members is not None:
+        _count('hit')
+        return members
+
+    lock_key = _lock_key(number)
+    if not await cache.aadd(lock_key, version, timeout=LOCK_TIMEOUT):
+        stale = await cache.aget(_stale_key(number))
+        if stale is not None:
+            _count('stale')
+            return stale
+
+        deadline = time.monotonic() + settings.LEADERBOARD_REBUILD_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(WAIT_STEP)
+            members = await cache.aget(key)
+            if members is not None:
+                _count('hit')
+                return members
+
+        _count('miss')
+        return await _afetch(number)
+
+    _count('miss')
+    try:
+        members = await _afetch(number)
+        await cache.aset(key, members, timeout=settings.LEADERBOARD_CACHE_TIMEOUT)
+        await cache.aset(_stale_key(number), members, timeout=settings.LEADERBOARD_CACHE_TIMEOUT * 10)
+    finally:
+        await cache.adelete(lock_key)
+
+    return members
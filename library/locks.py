@@ -0,0 +1,197 @@
+"""
+Distributed locks on top of the configured cache.
+
+A lock is held under a random token so only its owner can extend or release
+it. With the Redis cache backend the lock is a ``SET NX PX`` key and release
+and renewal are compare-and-set Lua scripts; other backends fall back to
+``cache.add``, which is atomic on every backend Django ships, with a
+best-effort ownership check on release.
+
+Long jobs keep the lock alive with a heartbeat thread instead of a timeout
+sized for the worst case, so a crashed worker frees the lock quickly.
+"""
+import logging
+import threading
+import time
+import uuid
+from functools import wraps
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+RETRY_INTERVAL = 0.01
+
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+EXTEND_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class LockNotAcquired(Exception):
+    pass
+
+
+def get_redis_client(name:str):
+    """
+    Get the raw Redis client and full key for a cache key, when the cache is
+    Django's Redis backend. Returns ``(None, None)`` for other backends.
+
+    Args:
+        name (str): Cache key, before prefixing and versioning
+    """
+    # django.core.cache.backends.redis.RedisCache exposes its client here
+    get_client = getattr(getattr(cache, '_cache', None), 'get_client', None)
+    if get_client is None:
+        return None, None
+    key = cache.make_and_validate_key(name)
+    return get_client(key, write=True), key
+
+
+class CacheLock:
+    """
+    A lock shared by every process using the same cache.
+
+    Args:
+        name (str): Lock name, one lock per name
+        timeout (float): Seconds the lock survives without renewal
+        heartbeat (float): Seconds between renewals while held, ``None`` for
+            a third of the timeout, ``0`` to disable
+        wait (float): Seconds ``with`` keeps retrying before giving up
+    """
+
+    def __init__(self, name:str, timeout:float=60, heartbeat:float=None, wait:float=0):
+        self.key = f'lock:{name}'
+        self.timeout = timeout
+        self.heartbeat = timeout / 3 if heartbeat is None else heartbeat
+        self.wait = wait
+        self.token = None
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire(self, wait:float=0) -> bool:
+        """
+        Take the lock.
+
+        Args:
+            wait (float): Seconds to keep retrying, ``0`` to try once
+        """
+        deadline = time.monotonic() + wait
+        while not self._try_acquire():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(RETRY_INTERVAL)
+        return True
+
+    def _try_acquire(self) -> bool:
+        token = uuid.uuid4().hex
+        client, key = get_redis_client(self.key)
+        if client is not None:
+            acquired = bool(client.set(key, token, nx=True, px=int(self.timeout * 1000)))
+        else:
+            acquired = cache.add(self.key, token, timeout=self.timeout)
+
+        if acquired:
+            self.token = token
+            self.lost = False
+            self._start_heartbeat()
+        return acquired
+
+    def extend(self) -> bool:
+        """
+        Push the expiry back by ``timeout``, if the lock is still ours.
+        """
+        if self.token is None:
+            return False
+
+        client, key = get_redis_client(self.key)
+        if client is not None:
+            return bool(client.eval(EXTEND_SCRIPT, 1, key, self.token, int(self.timeout * 1000)))
+
+        if cache.get(self.key) != self.token:
+            return False
+        return cache.touch(self.key, timeout=self.timeout)
+
+    def release(self) -> bool:
+        """
+        Release the lock, unless it expired and someone else took it.
+        """
+        self._stop_heartbeat()
+        token, self.token = self.token, None
+        if token is None:
+            return False
+
+        client, key = get_redis_client(self.key)
+        if client is not None:
+            return bool(client.eval(RELEASE_SCRIPT, 1, key, token))
+
+        if cache.get(self.key) != token:
+            return False
+        return cache.delete(self.key)
+
+    def _start_heartbeat(self):
+        if not self.heartbeat:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._beat, name=f'{self.key}-heartbeat', daemon=True)
+        self._thread.start()
+
+    def _stop_heartbeat(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat):
+            if not self.extend():
+                self.lost = True
+                logger.warning('Lost lock %s before release.', self.key)
+                return
+
+    def __enter__(self):
+        if not self.acquire(wait=self.wait):
+            raise LockNotAcquired(self.key)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def single_instance(name:str=None, timeout:float=60, heartbeat:float=None, skipped='Task is running.'):
+    """
+    Skip a call while another call holding the same lock is running.
+
+    Meant for periodic tasks; put it under ``@shared_task``.
+
+    Args:
+        name (str): Lock name, the function's dotted path by default
+        timeout (float): Lock timeout, see ``CacheLock``
+        heartbeat (float): Renewal interval, see ``CacheLock``
+        skipped: Value returned when the lock is held elsewhere
+    """
+    def decorator(func):
+        lock_name = name or f'{func.__module__}.{func.__qualname__}'
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            lock = CacheLock(lock_name, timeout=timeout, heartbeat=heartbeat)
+            if not lock.acquire():
+                logger.info('Skipping %s, lock is held.', lock_name)
+                return skipped
+            try:
+                return func(*args, **kwargs)
+            finally:
+                lock.release()
+        return wrapper
+    return decorator
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from library.benchmarks import SCENARIOS
+
+
+class Command(BaseCommand):
+    help = 'Run a benchmark scenario against the configured database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(SCENARIOS))
+        parser.add_argument('--size', type=int, default=None, help='Scenario data size, see the scenario docstring.')
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent workers for threaded scenarios.')
+
+    def handle(self, *args, **options):
+        scenario = SCENARIOS[options.pop('scenario')]
+        scenario(self.stdout, **options)
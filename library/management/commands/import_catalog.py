@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+
+from library.choices import FileFormatChoices
+from library.importers import detect_format, import_catalog
+
+# Failures listed on the console; the rest are only counted
+SHOWN_ERRORS = 20
+
+
+class Command(BaseCommand):
+    help = 'Import books and their authors from a CSV or JSON Lines catalog file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Catalog file.')
+        parser.add_argument('--format', choices=FileFormatChoices.values, help='File format, by extension if omitted.')
+        parser.add_argument('--chunk-size', type=int, default=None, help='Records written per transaction.')
+
+    def handle(self, *args, **options):
+        try:
+            file_format = options['format'] or detect_format(options['path'])
+            with open(options['path'], encoding='utf-8-sig', newline='') as stream:
+                result = import_catalog(
+                    stream, file_format, chunk_size=options['chunk_size'],
+                    progress=self.report_progress if options['verbosity'] > 1 else None,
+                )
+        except (OSError, ValidationError) as e:
+            raise CommandError(e)
+
+        for error in result['errors'][:SHOWN_ERRORS]:
+            self.stderr.write(f'Line {error["line"]}: {error["error"]}')
+        if result['failed'] > SHOWN_ERRORS:
+            self.stderr.write(f'... and {result["failed"] - SHOWN_ERRORS} more.')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {result["imported"]} of {result["rows"]} record(s), {result["failed"]} failed.'
+        ))
+
+    def report_progress(self, result):
+        self.stdout.write(f'{result["rows"]} record(s) read, {result["imported"]} imported, {result["failed"]} failed.')
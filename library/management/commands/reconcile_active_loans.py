@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from library import leaderboard
+from library.operations import reconcile_active_loan_counts
+
+
+class Command(BaseCommand):
+    help = "Recount members' active loans and repair drifted counters."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without repairing it.')
+
+    def handle(self, *args, **options):
+        drifted = reconcile_active_loan_counts(dry_run=options['dry_run'])
+
+        if options['dry_run']:
+            self.stdout.write(f'{drifted} member(s) with drifted active loan counts.')
+        else:
+            if drifted:
+                leaderboard.invalidate()
+            self.stdout.write(self.style.SUCCESS(f'Repaired {drifted} member(s).'))
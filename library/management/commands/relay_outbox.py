@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from library.outbox import relay_outbox_events
+
+
+class Command(BaseCommand):
+    help = 'Hand committed outbox events to Celery, continuously or once.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Events relayed per transaction.')
+        parser.add_argument('--interval', type=float, default=0.5, help='Seconds to sleep once the outbox is empty.')
+        parser.add_argument('--once', action='store_true', help='Drain the outbox and exit.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        total = 0
+
+        try:
+            while True:
+                relayed = relay_outbox_events(batch_size=batch_size)
+                total += relayed
+                if relayed < batch_size:
+                    # Drained, or only events backing off are left
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(f'Relayed {total} event(s).'))
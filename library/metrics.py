@@ -0,0 +1,155 @@
+"""
+In-process metrics, exported in Prometheus text format at ``/api/_metrics/``.
+
+Numbers are kept per worker process; Prometheus adds the ``instance`` label
+when every process is scraped. Numbers that live elsewhere, such as queue
+depths or counters shared through the cache, are read at scrape time by
+collectors.
+"""
+import logging
+import threading
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _label_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(label_key, **extra):
+    pairs = list(label_key) + sorted(extra.items())
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _quantile(ordered, q):
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and summaries.
+
+    Summaries keep a sliding window of the last ``window`` observations per
+    label set for quantiles, plus running ``_sum`` and ``_count`` totals.
+    """
+
+    def __init__(self, window:int=1024):
+        self.window = window
+        self._lock = threading.Lock()
+        self._help = {}
+        self._types = {}
+        self._counters = defaultdict(float)
+        self._samples = defaultdict(lambda: deque(maxlen=self.window))
+        self._totals = defaultdict(lambda: [0.0, 0])
+        self._collectors = []
+
+    def _describe(self, name, kind, help_text):
+        self._types.setdefault(name, kind)
+        if help_text:
+            self._help.setdefault(name, help_text)
+
+    def inc(self, name:str, labels:dict=None, amount:float=1, help_text:str=''):
+        """
+        Increment a counter.
+
+        Args:
+            name (str): Metric name
+            labels (dict): Label values
+            amount (float): Increment
+            help_text (str): HELP line, recorded on first use
+        """
+        with self._lock:
+            self._describe(name, 'counter', help_text)
+            self._counters[(name, _label_key(labels))] += amount
+
+    def observe(self, name:str, value:float, labels:dict=None, help_text:str=''):
+        """
+        Record an observation in a summary.
+
+        Args:
+            name (str): Metric name
+            value (float): Observed value
+            labels (dict): Label values
+            help_text (str): HELP line, recorded on first use
+        """
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._describe(name, 'summary', help_text)
+            self._samples[key].append(value)
+            totals = self._totals[key]
+            totals[0] += value
+            totals[1] += 1
+
+    def register_collector(self, collector):
+        """
+        Add a callable run on every render.
+
+        Args:
+            collector: Callable returning ``(name, type, help_text, labels,
+                value)`` tuples, e.g. ``type`` ``'gauge'`` for a queue depth
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        """
+        Render every metric in Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            samples = {key: sorted(values) for key, values in self._samples.items()}
+            totals = {key: tuple(values) for key, values in self._totals.items()}
+            types = dict(self._types)
+            help_texts = dict(self._help)
+            collectors = list(self._collectors)
+
+        series = defaultdict(list)
+        for collector in collectors:
+            try:
+                collected = list(collector())
+            except Exception:
+                # A broken collector must not take the other metrics down
+                logger.exception('Metrics collector %r failed.', collector)
+                continue
+            for name, kind, help_text, labels, value in collected:
+                types.setdefault(name, kind)
+                if help_text:
+                    help_texts.setdefault(name, help_text)
+                series[name].append(f'{name}{_format_labels(_label_key(labels))} {value:g}')
+
+        for (name, label_key), value in sorted(counters.items()):
+            series[name].append(f'{name}{_format_labels(label_key)} {value:g}')
+        for (name, label_key), ordered in sorted(samples.items()):
+            for q in QUANTILES:
+                series[name].append(
+                    f'{name}{_format_labels(label_key, quantile=q)} {_quantile(ordered, q):g}'
+                )
+            value_sum, count = totals[(name, label_key)]
+            series[name].append(f'{name}_sum{_format_labels(label_key)} {value_sum:g}')
+            series[name].append(f'{name}_count{_format_labels(label_key)} {count}')
+
+        lines = []
+        for name in sorted(series):
+            if name in help_texts:
+                lines.append(f'# HELP {name} {help_texts[name]}')
+            lines.append(f'# TYPE {name} {types[name]}')
+            lines.extend(series[name])
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._samples.clear()
+            self._totals.clear()
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,231 @@
+import json
+import logging
+import random
+from contextlib import asynccontextmanager
+from time import perf_counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+
+from library.metrics import registry
+
+query_plan_logger = logging.getLogger('library.query_plans')
+
+
+def _add_execute_wrapper(wrapper):
+    connection.execute_wrappers.append(wrapper)
+
+
+def _remove_execute_wrapper(wrapper):
+    connection.execute_wrappers.remove(wrapper)
+
+
+@asynccontextmanager
+async def aexecute_wrapper(wrapper):
+    """
+    ``connection.execute_wrapper`` for async code. Connections are per
+    thread, and the async ORM queries on the request's sync thread, so the
+    wrapper is installed on that thread's connection rather than the event
+    loop's.
+
+    Args:
+        wrapper (callable): Execute wrapper, see ``connection.execute_wrapper``
+    """
+    await sync_to_async(_add_execute_wrapper)(wrapper)
+    try:
+        yield
+    finally:
+        await sync_to_async(_remove_execute_wrapper)(wrapper)
+
+
+class QueryPlanSamplingMiddleware:
+    """
+    Log query plans for slow SELECTs on a sample of requests.
+
+    Off by default. ``QUERY_PLAN_SAMPLE_RATE`` is the fraction of requests
+    that are timed, and only queries slower than ``QUERY_PLAN_SLOW_MS`` are
+    explained, once the response is ready. ``QUERY_PLAN_ANALYZE`` runs
+    ``EXPLAIN ANALYZE`` on backends that support it, which executes the query
+    a second time.
+
+    Runs in sync and async stacks alike, so async views stay async.
+    """
+    sync_capable = True
+    async_capable = True
+
+    max_plans_per_request = 5
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def is_sampled():
+        sample_rate = settings.QUERY_PLAN_SAMPLE_RATE
+        return sample_rate > 0 and random.random() < sample_rate
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.is_sampled():
+            return self.get_response(request)
+
+        slow_queries, time_query = self.record_slow_queries()
+        with connection.execute_wrapper(time_query):
+            response = self.get_response(request)
+        self.log_plans(request, slow_queries)
+        return response
+
+    async def __acall__(self, request):
+        if not self.is_sampled():
+            return await self.get_response(request)
+
+        slow_queries, time_query = self.record_slow_queries()
+        async with aexecute_wrapper(time_query):
+            response = await self.get_response(request)
+        # EXPLAIN queries the database, so off the event loop
+        await sync_to_async(self.log_plans)(request, slow_queries)
+        return response
+
+    @staticmethod
+    def record_slow_queries():
+        """
+        Get a list of slow SELECTs and the execute wrapper filling it.
+        """
+        slow_queries = []
+
+        def time_query(execute, sql, params, many, context):
+            started = perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                duration_ms = (perf_counter() - started) * 1000
+                if (
+                    not many
+                    and duration_ms >= settings.QUERY_PLAN_SLOW_MS
+                    and sql.lstrip()[:6].upper() == 'SELECT'
+                ):
+                    slow_queries.append((sql, params, duration_ms))
+
+        return slow_queries, time_query
+
+    def log_plans(self, request, slow_queries):
+        slow_queries.sort(key=lambda query: query[2], reverse=True)
+        for sql, params, duration_ms in slow_queries[:self.max_plans_per_request]:
+            query_plan_logger.info(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'view': getattr(request.resolver_match, 'view_name', None),
+                'duration_ms': round(duration_ms, 3),
+                'sql': sql,
+                'plan': self.explain(sql, params),
+            }, default=str))
+
+    @staticmethod
+    def explain(sql, params):
+        """
+        Explain an already executed query with the backend's EXPLAIN syntax,
+        or return ``None`` if it cannot be explained. The request has already
+        succeeded, so sampling must not fail it.
+
+        Args:
+            sql (str): Query with placeholders
+            params: Query parameters
+        """
+        options = {'analyze': True} if settings.QUERY_PLAN_ANALYZE else {}
+        try:
+            prefix = connection.ops.explain_query_prefix(format='json', **options)
+        except ValueError:
+            # Backends without JSON output, e.g. SQLite
+            prefix = connection.ops.explain_query_prefix()
+
+        try:
+            # In a savepoint, so a failed EXPLAIN cannot break an open transaction
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(f'{prefix} {sql}', params)
+                rows = cursor.fetchall()
+        except DatabaseError:
+            query_plan_logger.warning('Could not explain query: %s', sql, exc_info=True)
+            return None
+
+        if len(rows) == 1 and len(rows[0]) == 1:
+            return rows[0][0]
+        return [' '.join(str(column) for column in row) for row in rows]
+
+
+class QueryMetricsMiddleware:
+    """
+    Count queries and database time for every request.
+
+    The numbers are returned in ``X-DB-Queries`` and ``Server-Timing``
+    headers and aggregated per view in the metrics registry. Runs in sync
+    and async stacks alike.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        stats, count_query = self.count_queries()
+        started = perf_counter()
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+        return self.record(request, response, stats, (perf_counter() - started) * 1000)
+
+    async def __acall__(self, request):
+        stats, count_query = self.count_queries()
+        started = perf_counter()
+        async with aexecute_wrapper(count_query):
+            response = await self.get_response(request)
+        return self.record(request, response, stats, (perf_counter() - started) * 1000)
+
+    @staticmethod
+    def count_queries():
+        """
+        Get the query stats of a request and the execute wrapper keeping them.
+        """
+        stats = {'queries': 0, 'db_ms': 0.0}
+
+        def count_query(execute, sql, params, many, context):
+            started = perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                stats['queries'] += 1
+                stats['db_ms'] += (perf_counter() - started) * 1000
+
+        return stats, count_query
+
+    def record(self, request, response, stats, total_ms):
+        response['X-DB-Queries'] = str(stats['queries'])
+        response['Server-Timing'] = (
+            f'db;dur={stats["db_ms"]:.2f};desc="{stats["queries"]} queries", app;dur={total_ms:.2f}'
+        )
+
+        labels = {
+            'view': getattr(request.resolver_match, 'view_name', None) or 'unresolved',
+            'method': request.method,
+        }
+        registry.observe(
+            'library_request_duration_ms', total_ms, labels,
+            help_text='Request handling time in milliseconds.'
+        )
+        registry.observe(
+            'library_request_db_queries', stats['queries'], labels,
+            help_text='Database queries issued per request.'
+        )
+        registry.observe(
+            'library_request_db_duration_ms', stats['db_ms'], labels,
+            help_text='Time spent in database queries per request in milliseconds.'
+        )
+
+        return response
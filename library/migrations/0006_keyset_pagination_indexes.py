@@ -0,0 +1,21 @@
+# Generated by Django 4.2 on 2026-10-18 02:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0005_alter_author_options_alter_book_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['title', 'id'], name='book_title_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loan',
+            index=models.Index(fields=['-loan_date', 'id'], name='loan_date_id_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2 on 2026-10-18 02:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0006_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='loan',
+            index=models.Index(condition=models.Q(('is_returned', False)), fields=['member', 'due_date'], name='loan_active_member_due_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='loan',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_returned', False)), fields=('book', 'member'), name='loan_unique_active_book_member'),
+        ),
+    ]
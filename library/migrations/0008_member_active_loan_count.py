@@ -0,0 +1,34 @@
+# Generated by Django 4.2 on 2026-10-18 02:13
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_active_loan_count(apps, schema_editor):
+    MemberModel = apps.get_model("library", "Member")
+    LoanModel = apps.get_model("library", "Loan")
+    active_loans = LoanModel.objects.filter(
+        member_id=OuterRef("id"), is_returned=False
+    ).order_by().values("member_id").annotate(total=Count("id")).values("total")
+    MemberModel.objects.update(active_loan_count=Coalesce(Subquery(active_loans), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0007_active_loan_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='member',
+            name='active_loan_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_active_loan_count, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='member',
+            index=models.Index(fields=['-active_loan_count', 'id'], name='member_active_loans_idx'),
+        ),
+    ]
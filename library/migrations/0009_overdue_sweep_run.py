@@ -0,0 +1,35 @@
+# Generated by Django 4.2 on 2026-10-18 02:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0008_member_active_loan_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OverdueSweepRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_date', models.DateField(unique=True)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('completed', 'Completed')], default='running', max_length=20)),
+                ('last_member_id', models.PositiveIntegerField(default=0)),
+                ('members_queued', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Overdue sweep run',
+                'verbose_name_plural': 'Overdue sweep runs',
+                'ordering': ['-run_date'],
+            },
+        ),
+        migrations.AddField(
+            model_name='member',
+            name='last_overdue_reminder_on',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+    ]
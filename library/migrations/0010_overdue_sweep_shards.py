@@ -0,0 +1,57 @@
+# Generated by Django 4.2 on 2026-10-18 02:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0009_overdue_sweep_run'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='overduesweeprun',
+            old_name='members_queued',
+            new_name='members',
+        ),
+        migrations.RemoveField(
+            model_name='overduesweeprun',
+            name='last_member_id',
+        ),
+        migrations.AddField(
+            model_name='overduesweeprun',
+            name='reminders_failed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='overduesweeprun',
+            name='reminders_sent',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='OverdueSweepShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lower_member_id', models.PositiveIntegerField()),
+                ('upper_member_id', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('running', 'Running'), ('completed', 'Completed')], default='running', max_length=20)),
+                ('last_member_id', models.PositiveIntegerField()),
+                ('members', models.PositiveIntegerField(default=0)),
+                ('reminders_sent', models.PositiveIntegerField(default=0)),
+                ('reminders_failed', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='library.overduesweeprun')),
+            ],
+            options={
+                'verbose_name': 'Overdue sweep shard',
+                'verbose_name_plural': 'Overdue sweep shards',
+                'ordering': ['run', 'lower_member_id'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='overduesweepshard',
+            constraint=models.UniqueConstraint(fields=('run', 'lower_member_id'), name='sweep_shard_unique_range'),
+        ),
+    ]
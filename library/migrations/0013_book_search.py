@@ -0,0 +1,81 @@
+# Generated by Django 4.2 on 2026-10-18 02:45
+
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# Kept in step with library.search.SEARCH_CONFIG
+CREATE_SEARCH = """
+CREATE FUNCTION library_book_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(
+            (SELECT first_name || ' ' || last_name FROM library_author WHERE id = NEW.author_id), ''
+        )), 'B') ||
+        setweight(to_tsvector('english', coalesce(NEW.genre, '')), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER library_book_search_vector
+    BEFORE INSERT OR UPDATE OF title, genre, author_id, search_vector ON library_book
+    FOR EACH ROW EXECUTE FUNCTION library_book_search_vector();
+
+-- A renamed author rewrites the author_id of its books, which re-runs the book trigger
+CREATE FUNCTION library_author_search_vector() RETURNS trigger AS $$
+BEGIN
+    UPDATE library_book SET author_id = author_id WHERE author_id = NEW.id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER library_author_search_vector
+    AFTER UPDATE OF first_name, last_name ON library_author
+    FOR EACH ROW
+    WHEN (OLD.first_name IS DISTINCT FROM NEW.first_name OR OLD.last_name IS DISTINCT FROM NEW.last_name)
+    EXECUTE FUNCTION library_author_search_vector();
+
+UPDATE library_book SET author_id = author_id;
+
+CREATE INDEX book_search_vector_idx ON library_book USING gin (search_vector);
+CREATE INDEX book_title_trgm_idx ON library_book USING gin (title gin_trgm_ops);
+"""
+
+DROP_SEARCH = """
+DROP INDEX book_title_trgm_idx;
+DROP INDEX book_search_vector_idx;
+DROP TRIGGER library_author_search_vector ON library_author;
+DROP FUNCTION library_author_search_vector();
+DROP TRIGGER library_book_search_vector ON library_book;
+DROP FUNCTION library_book_search_vector();
+"""
+
+
+def create_search(apps, schema_editor):
+    # Triggers and GIN indexes only exist on PostgreSQL; see library.search
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_SEARCH)
+
+
+def drop_search(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_SEARCH)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0012_updated_at'),
+    ]
+
+    operations = [
+        # No-op off PostgreSQL
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='book',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search, drop_search),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-18 03:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0014_catalog_import'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='overduesweepshard',
+            name='last_member_id',
+            field=models.PositiveBigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='overduesweepshard',
+            name='lower_member_id',
+            field=models.PositiveBigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='overduesweepshard',
+            name='upper_member_id',
+            field=models.PositiveBigIntegerField(),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2 on 2026-10-18 03:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0015_sweep_member_id_bigint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxevent',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='outboxevent',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('dead', 'Dead')], default='pending', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='outboxevent',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='outbox_status_next_attempt_idx'),
+        ),
+    ]
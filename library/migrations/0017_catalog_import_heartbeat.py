@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 03:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0016_outbox_event_retry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='catalogimport',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
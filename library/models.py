@@ -1,16 +1,24 @@
 from datetime import timedelta
 
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils.timezone import now
 
-from library.choices import BookGenreChoices
+from library.choices import (
+    BookGenreChoices, FileFormatChoices, ImportStatusChoices, OutboxStatusChoices, SweepStatusChoices,
+)
+
+LOAN_PERIOD = timedelta(days=14)
 
 
 class Author(models.Model):
     first_name = models.CharField(max_length=100)
     last_name = models.CharField(max_length=100)
     biography = models.TextField(blank=True)
+    # Conditional GET validator, see library.views.ConditionalGetViewSetMixin.
+    # auto_now is skipped by QuerySet.update(), which must set it explicitly
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return f"{self.first_name} {self.last_name}"
@@ -28,6 +36,10 @@ class Book(models.Model):
     genre = models.CharField(
         max_length=50, choices=BookGenreChoices.choices, default=BookGenreChoices.OTHER)
     available_copies = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Title, author name and genre, written by PostgreSQL triggers and GIN
+    # indexed by migration 0013; always NULL elsewhere, see library.search
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return self.title
@@ -36,10 +48,20 @@ class Book(models.Model):
         verbose_name = "Book"
         verbose_name_plural = "Books"
         ordering = ['title']
+        indexes = [
+            # Keyset pagination order, see library.pagination.BookPagination
+            models.Index(fields=['title', 'id'], name='book_title_id_idx'),
+        ]
 
 class Member(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     membership_date = models.DateField(auto_now_add=True)
+    # Denormalized count of loans not yet returned, kept in step by
+    # library.circulation and repaired by the reconcile_active_loans command
+    active_loan_count = models.PositiveIntegerField(default=0, editable=False)
+    # Day of the last overdue reminder, so a sweep sends at most one per day
+    last_overdue_reminder_on = models.DateField(null=True, blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     # Add more fields if necessary
 
     def __str__(self):
@@ -49,6 +71,9 @@ class Member(models.Model):
         verbose_name = "Member"
         verbose_name_plural = "Members"
         ordering = ['-membership_date']
+        indexes = [
+            models.Index(fields=['-active_loan_count', 'id'], name='member_active_loans_idx'),
+        ]
 
 class Loan(models.Model):
     book = models.ForeignKey(Book, related_name='loans', on_delete=models.CASCADE)
@@ -57,6 +82,7 @@ class Loan(models.Model):
     return_date = models.DateField(null=True, blank=True)
     is_returned = models.BooleanField(default=False)
     due_date = models.DateField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return f"{self.book.title} loaned to {self.member.user.username}"
@@ -65,12 +91,140 @@ class Loan(models.Model):
         verbose_name = "Loan"
         verbose_name_plural = "Loans"
         ordering = ['-loan_date']
+        indexes = [
+            # Keyset pagination order, see library.pagination.LoanPagination
+            models.Index(fields=['-loan_date', 'id'], name='loan_date_id_idx'),
+            # Overdue lookups only ever look at active loans
+            models.Index(
+                fields=['member', 'due_date'],
+                condition=models.Q(is_returned=False),
+                name='loan_active_member_due_idx'
+            ),
+        ]
+        constraints = [
+            # Also serves as the (book, member) index for active loan lookups
+            models.UniqueConstraint(
+                fields=['book', 'member'],
+                condition=models.Q(is_returned=False),
+                name='loan_unique_active_book_member'
+            ),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.due_date:
-            self.due_date = (self.loan_date or now()) + timedelta(days=14)
+            self.due_date = (self.loan_date or now()) + LOAN_PERIOD
         super().save(*args, **kwargs)
 
     @property
     def is_overdue(self):
-        return self.due_date < now().date() if self.due_date else self.loan_date + timedelta(days=14) < now()
+        return self.due_date < now().date() if self.due_date else self.loan_date + LOAN_PERIOD < now()
+
+
+class OverdueSweepRun(models.Model):
+    """
+    One nightly overdue sweep, split into member-id range shards.
+    """
+    run_date = models.DateField(unique=True)
+    status = models.CharField(
+        max_length=20, choices=SweepStatusChoices.choices, default=SweepStatusChoices.RUNNING)
+    # Totals, filled in by the summary once every shard has finished
+    members = models.PositiveIntegerField(default=0)
+    reminders_sent = models.PositiveIntegerField(default=0)
+    reminders_failed = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Overdue sweep {self.run_date} ({self.status})"
+
+    class Meta:
+        verbose_name = "Overdue sweep run"
+        verbose_name_plural = "Overdue sweep runs"
+        ordering = ['-run_date']
+
+
+class OverdueSweepShard(models.Model):
+    """
+    Members with ids in ``(lower_member_id, upper_member_id]`` of a sweep,
+    checkpointed so an interrupted shard resumes.
+    """
+    run = models.ForeignKey(OverdueSweepRun, related_name='shards', on_delete=models.CASCADE)
+    lower_member_id = models.PositiveBigIntegerField()
+    upper_member_id = models.PositiveBigIntegerField()
+    status = models.CharField(
+        max_length=20, choices=SweepStatusChoices.choices, default=SweepStatusChoices.RUNNING)
+    # Keyset checkpoint: members up to this id have been handled
+    last_member_id = models.PositiveBigIntegerField()
+    members = models.PositiveIntegerField(default=0)
+    reminders_sent = models.PositiveIntegerField(default=0)
+    reminders_failed = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Overdue sweep {self.run.run_date} members {self.lower_member_id + 1}-{self.upper_member_id}"
+
+    class Meta:
+        verbose_name = "Overdue sweep shard"
+        verbose_name_plural = "Overdue sweep shards"
+        ordering = ['run', 'lower_member_id']
+        constraints = [
+            models.UniqueConstraint(fields=['run', 'lower_member_id'], name='sweep_shard_unique_range'),
+        ]
+
+
+class OutboxEvent(models.Model):
+    """
+    An event written in the same transaction as the change it announces,
+    and handed to Celery by the outbox relay once committed.
+    """
+    topic = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Failed relay attempts; the event stays until it is handed over, or
+    # turns dead after settings.OUTBOX_MAX_ATTEMPTS
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=OutboxStatusChoices.choices, default=OutboxStatusChoices.PENDING)
+    # Not relayed before then, so a failing event backs off; None: at once
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.topic} #{self.id}"
+
+    class Meta:
+        verbose_name = "Outbox event"
+        verbose_name_plural = "Outbox events"
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_status_next_attempt_idx'),
+        ]
+
+
+class CatalogImport(models.Model):
+    """
+    A partner catalog file uploaded for import, see library.importers.
+    """
+    file = models.FileField(upload_to='catalog-imports/')
+    format = models.CharField(max_length=10, choices=FileFormatChoices.choices)
+    status = models.CharField(
+        max_length=20, choices=ImportStatusChoices.choices, default=ImportStatusChoices.PENDING)
+    # Progress, updated after every chunk
+    rows = models.PositiveIntegerField(default=0)
+    imported = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    # The first invalid records as {'line', 'error'}, or why the import failed
+    errors = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Set when claimed and after every chunk; a running import silent for
+    # settings.CATALOG_IMPORT_STALE_SECONDS is taken over by a redelivered task
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Catalog import #{self.id} ({self.status})"
+
+    class Meta:
+        verbose_name = "Catalog import"
+        verbose_name_plural = "Catalog imports"
+        ordering = ['-created_at']
@@ -0,0 +1,258 @@
+"""
+Outgoing mail.
+
+Tasks build ``EmailMessage`` objects and hand them to ``send_messages``, which
+pushes them through as few backend connections as possible instead of one
+``send_mail`` (and one SMTP handshake) per message.
+
+Notifications come in two priorities, each with its own Celery queue so a
+nightly reminder burst never sits in front of checkout confirmations:
+
+* ``HIGH``: confirmations a member is waiting for, on ``notifications``
+* ``LOW``: overdue reminders, on ``schedule``
+
+With ``NOTIFICATION_COALESCE_SECONDS`` set, loan confirmations are buffered
+per member for that long and sent as one digest.
+
+Both priorities draw from one token bucket per mail backend when
+``NOTIFICATION_RATE_LIMIT`` is set, with ``NOTIFICATION_HIGH_PRIORITY_RESERVE``
+of the bucket kept back for high priority. Send counts, send time and time
+spent throttled are counted in the cache, so every worker's numbers show up
+at ``/api/_metrics/`` next to the queue depths.
+"""
+import logging
+import time
+from itertools import islice
+from typing import Iterable, List
+
+from celery import current_app
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from kombu.exceptions import ChannelError
+
+from library.locks import CacheLock, get_redis_client
+from library.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+HIGH = 'high'
+LOW = 'low'
+QUEUES = {HIGH: 'notifications', LOW: 'schedule'}
+
+# Counters kept in the cache, with their metric help text
+STATS = {
+    'sent': 'Notification emails sent.',
+    'send_ms': 'Milliseconds spent handing notification emails to the mail backend.',
+    'throttled_ms': 'Milliseconds notification sends waited on the rate limit.',
+}
+
+
+def _stat_key(priority, stat):
+    return f'notifications:stats:{priority}:{stat}'
+
+
+def _add_stat(priority, stat, amount):
+    key = _stat_key(priority, stat)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        if not cache.add(key, amount, timeout=None):
+            cache.incr(key, amount)
+
+
+def get_bucket():
+    """
+    Get the rate limit bucket of the configured mail backend, or ``None``
+    when sending is not rate limited.
+    """
+    rate = settings.NOTIFICATION_RATE_LIMIT
+    if not rate:
+        return None
+    return TokenBucket(
+        f'mail:{settings.EMAIL_BACKEND}:{settings.EMAIL_HOST}',
+        rate=rate,
+        capacity=settings.NOTIFICATION_RATE_BURST or rate,
+    )
+
+
+def throttle(bucket, priority:str):
+    """
+    Block until the bucket lets one more message through.
+
+    Args:
+        bucket (TokenBucket): Mail backend bucket
+        priority (str): ``HIGH`` or ``LOW``
+    """
+    reserve = 0 if priority == HIGH else bucket.capacity * settings.NOTIFICATION_HIGH_PRIORITY_RESERVE
+    started = time.perf_counter()
+    wait = bucket.take(reserve=reserve)
+    while wait:
+        time.sleep(min(wait, 1))
+        wait = bucket.take(reserve=reserve)
+
+    throttled_ms = int((time.perf_counter() - started) * 1000)
+    if throttled_ms:
+        _add_stat(priority, 'throttled_ms', throttled_ms)
+
+
+def build_message(subject:str, body:str, to:str) -> EmailMessage:
+    """
+    Build a plain text message from the library's default sender.
+
+    Args:
+        subject (str): Subject line
+        body (str): Message body
+        to (str): Recipient address
+    """
+    return EmailMessage(subject=subject, body=body, from_email=settings.DEFAULT_FROM_EMAIL, to=[to])
+
+
+def send_messages(messages:Iterable[EmailMessage], priority:str=LOW, delivered:list=None) -> int:
+    """
+    Send messages over pooled backend connections.
+
+    One connection is opened per ``NOTIFICATION_MAX_MESSAGES_PER_CONNECTION``
+    messages, since SMTP servers commonly drop sessions that send too many.
+
+    Args:
+        messages (Iterable[EmailMessage]): Messages to send
+        priority (str): ``HIGH`` or ``LOW``, for rate limiting and metrics
+        delivered (list): Filled with the messages handed to the backend, so
+            a caller can tell which went out before a send raised
+
+    Returns:
+        int: Number of messages sent
+    """
+    messages = iter(messages)
+    limit = settings.NOTIFICATION_MAX_MESSAGES_PER_CONNECTION
+    bucket = get_bucket()
+    sent = 0
+
+    while True:
+        chunk = list(islice(messages, limit))
+        if not chunk:
+            return sent
+
+        with get_connection(fail_silently=False) as connection:
+            if bucket is None and delivered is None:
+                started = time.perf_counter()
+                count = connection.send_messages(chunk) or 0
+                _add_stat(priority, 'send_ms', int((time.perf_counter() - started) * 1000))
+            else:
+                count = 0
+                for message in chunk:
+                    if bucket is not None:
+                        throttle(bucket, priority)
+                    started = time.perf_counter()
+                    if connection.send_messages([message]):
+                        count += 1
+                        if delivered is not None:
+                            delivered.append(message)
+                    _add_stat(priority, 'send_ms', int((time.perf_counter() - started) * 1000))
+
+        _add_stat(priority, 'sent', count)
+        sent += count
+
+
+def _digest_key(member_id):
+    return f'notifications:loan-digest:{member_id}'
+
+
+def buffer_loan_ids(member_id:int, loan_ids:List[int]) -> bool:
+    """
+    Add loans to a member's pending confirmation digest.
+
+    The buffer outlives the coalescing window by a wide margin, so loans
+    are not kept forever if their flush task is lost.
+
+    Args:
+        member_id (int): Member who took the loans
+        loan_ids (List[int]): Loans to confirm
+
+    Returns:
+        bool: True when the buffer was empty, so the caller must schedule
+            its flush
+    """
+    name = _digest_key(member_id)
+    timeout = int(settings.NOTIFICATION_COALESCE_SECONDS * 10) + 60
+
+    client, key = get_redis_client(name)
+    if client is not None:
+        pipe = client.pipeline()
+        pipe.rpush(key, *loan_ids)
+        pipe.expire(key, timeout)
+        length, _ = pipe.execute()
+        return length == len(loan_ids)
+
+    with CacheLock(name, timeout=5, heartbeat=0, wait=1):
+        pending = cache.get(name, [])
+        cache.set(name, pending + list(loan_ids), timeout=timeout)
+    return not pending
+
+
+def drain_loan_ids(member_id:int) -> List[int]:
+    """
+    Take every loan out of a member's pending confirmation digest.
+
+    Args:
+        member_id (int): Member whose digest to flush
+    """
+    name = _digest_key(member_id)
+
+    client, key = get_redis_client(name)
+    if client is not None:
+        pipe = client.pipeline(transaction=True)
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        pending, _ = pipe.execute()
+        return sorted({int(loan_id) for loan_id in pending})
+
+    with CacheLock(name, timeout=5, heartbeat=0, wait=1):
+        pending = cache.get(name, [])
+        cache.delete(name)
+    return sorted(set(pending))
+
+
+def get_queue_depths() -> dict:
+    """
+    Count the messages waiting in each notification queue on the broker.
+    """
+    if current_app.conf.task_always_eager:
+        return {}
+
+    depths = {}
+    with current_app.connection_for_read() as connection:
+        connection.ensure_connection(max_retries=1, interval_start=0, timeout=1)
+        channel = connection.default_channel
+        for queue in QUEUES.values():
+            try:
+                depths[queue] = channel.queue_declare(queue=queue, passive=True).message_count
+            except ChannelError:
+                # Queues that were never declared, or drained on Redis
+                depths[queue] = 0
+    return depths
+
+
+def collect_metrics():
+    """
+    Metrics collector for the notification pipeline, see
+    ``MetricsRegistry.register_collector``.
+    """
+    keys = {_stat_key(priority, stat): (priority, stat) for priority in QUEUES for stat in STATS}
+    values = cache.get_many(list(keys))
+    for key, (priority, stat) in keys.items():
+        yield (
+            f'library_notification_{stat}_total', 'counter', STATS[stat], {'priority': priority}, values.get(key, 0)
+        )
+
+    try:
+        depths = get_queue_depths()
+    except Exception:
+        logger.warning('Could not read notification queue depths.', exc_info=True)
+        depths = {}
+    for queue, depth in depths.items():
+        yield (
+            'library_notification_queue_depth', 'gauge',
+            'Notification tasks waiting on the broker.', {'queue': queue}, depth
+        )
@@ -1,10 +1,15 @@
-from datetime import timedelta
-
-from django.db.models import Exists, OuterRef, Count, Q
+from datetime import date, timedelta
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, List, Optional
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Count, F, Max, Min, Q, Subquery
+from django.db.models.functions import Coalesce
 from django.utils.timezone import now
 from rest_framework.exceptions import ValidationError
 
-from library.models import Member, Loan
+from library.models import Member, Loan, OverdueSweepShard
 
 
 def get_loan_overdue_members():
@@ -44,6 +49,125 @@ def get_member_overdue_book_title_values(member_id:int):
     )
 
 
+def iter_overdue_member_digests(chunk_size:int=2000, after_member_id:int=0, up_to_member_id:int=None):
+    """
+    Stream overdue loans as one digest per member.
+
+    A single server-side cursor walks the active-loan index in member order,
+    joined to the book title and member's user, so building the whole
+    nightly sweep costs one query regardless of the number of members.
+    Members already reminded today are left out.
+
+    Args:
+        chunk_size (int): Rows fetched per round trip
+        after_member_id (int): Keyset checkpoint, only members after it
+        up_to_member_id (int): Last member id to include, for shards
+
+    Yields:
+        dict: Member ``id``, ``name``, ``email`` and overdue book ``titles``
+    """
+    today = now().date()
+    rows = Loan.objects.filter(
+        Q(member__last_overdue_reminder_on__isnull=True) | Q(member__last_overdue_reminder_on__lt=today),
+        is_returned=False,
+        due_date__lt=today,
+        member_id__gt=after_member_id,
+    )
+    if up_to_member_id is not None:
+        rows = rows.filter(member_id__lte=up_to_member_id)
+
+    rows = rows.order_by(
+        'member_id', 'due_date'
+    ).values_list(
+        'member_id', 'member__user__first_name', 'member__user__email', 'book__title'
+    ).iterator(chunk_size=chunk_size)
+
+    for member_id, loans in groupby(rows, key=itemgetter(0)):
+        loans = list(loans)
+        _, name, email, _ = loans[0]
+        yield {
+            'id': member_id,
+            'name': name,
+            'email': email,
+            'titles': [title for *_, title in loans],
+        }
+
+
+def plan_overdue_sweep_shards(run, shard_count:int) -> List[int]:
+    """
+    Split today's overdue members into member-id ranges of equal width.
+
+    Args:
+        run (OverdueSweepRun): Sweep to plan
+        shard_count (int): Maximum number of shards
+
+    Returns:
+        List[int]: IDs of the created shards
+    """
+    bounds = Loan.objects.filter(
+        is_returned=False,
+        due_date__lt=now().date(),
+    ).aggregate(lowest=Min('member_id'), highest=Max('member_id'))
+    if bounds['lowest'] is None:
+        return []
+
+    lower = bounds['lowest'] - 1
+    width = -(-(bounds['highest'] - lower) // shard_count)
+    shards = OverdueSweepShard.objects.bulk_create([
+        OverdueSweepShard(
+            run=run,
+            lower_member_id=start,
+            upper_member_id=min(start + width, bounds['highest']),
+            last_member_id=start,
+        )
+        for start in range(lower, bounds['highest'], width)
+    ])
+    return [shard.id for shard in shards]
+
+
+def claim_overdue_reminders(member_ids:List[int], on_date:date) -> Dict[int, Optional[date]]:
+    """
+    Mark members as reminded on a date, unless they already are.
+
+    Rows another worker is claiming right now are skipped rather than waited
+    for, so the same member queued twice is only reminded once.
+
+    Args:
+        member_ids (List[int]): Members about to be reminded
+        on_date (date): Reminder date
+
+    Returns:
+        dict: Claimed member ids mapped to their previous reminder date,
+            for ``release_overdue_reminders``
+    """
+    with transaction.atomic():
+        claims = dict(
+            Member.objects.filter(
+                Q(last_overdue_reminder_on__isnull=True) | Q(last_overdue_reminder_on__lt=on_date),
+                id__in=member_ids,
+            ).select_for_update(skip_locked=True).values_list('id', 'last_overdue_reminder_on')
+        )
+        if claims:
+            Member.objects.filter(id__in=claims).update(last_overdue_reminder_on=on_date, updated_at=now())
+    return claims
+
+
+def release_overdue_reminders(claims:Dict[int, Optional[date]], on_date:date):
+    """
+    Undo ``claim_overdue_reminders`` for reminders that were not sent.
+
+    Args:
+        claims (dict): Claims as returned by ``claim_overdue_reminders``
+        on_date (date): Reminder date they were claimed for
+    """
+    previous = sorted(claims.items(), key=lambda claim: claim[1] or date.min)
+    for last_reminded_on, members in groupby(previous, key=itemgetter(1)):
+        Member.objects.filter(
+            id__in=[member_id for member_id, _ in members],
+            last_overdue_reminder_on=on_date,
+        ).update(last_overdue_reminder_on=last_reminded_on, updated_at=now())
+
+
 def extend_loan_due_date_by(days:int, loan):
     """
     Extend a loan due date by the days specified.
@@ -66,7 +190,7 @@ def extend_loan_due_date_by(days:int, loan):
         raise  ValidationError('Loan already overdue.')
 
     loan.due_date = loan.due_date + timedelta(days=days)
-    loan.save(update_fields=['due_date'])
+    loan.save(update_fields=['due_date', 'updated_at'])
 
     return loan
 
@@ -74,14 +198,49 @@ def extend_loan_due_date_by(days:int, loan):
 def get_top_active_members(number:int):
     """
     Get top active members with overdue loans
+
+    Served from the denormalized ``active_loan_count`` index, so only
+    ``number`` members are read.
+
     Args:
         number (int): Number of members to return
     """
 
-    return Member.objects.select_related(
-        'user'
-    ).annotate(
-        active_loans=Count("loans", filter=Q(loans__is_returned=False))
+    return Member.objects.order_by(
+        '-active_loan_count', 'id'
     ).values(
-        'id', 'user__username', 'user__email', 'active_loans'
-    ).order_by('-active_loans')[:number]
\ No newline at end of file
+        'id', 'user__username', 'user__email', active_loans=F('active_loan_count')
+    )[:number]
+
+
+def reconcile_active_loan_counts(dry_run:bool=False) -> int:
+    """
+    Repair members whose active loan counter drifted from their loans.
+
+    Args:
+        dry_run (bool): Only count drifted members
+
+    Returns:
+        int: Number of drifted members
+    """
+    active_loans = Coalesce(
+        Subquery(
+            Loan.objects.filter(
+                member_id=OuterRef('id'),
+                is_returned=False
+            ).order_by().values('member_id').annotate(total=Count('id')).values('total')
+        ),
+        0
+    )
+
+    drifted = Member.objects.annotate(
+        actual_loan_count=active_loans
+    ).exclude(
+        active_loan_count=F('actual_loan_count')
+    ).values_list('id', flat=True)
+
+    drifted_ids = list(drifted)
+    if drifted_ids and not dry_run:
+        Member.objects.filter(id__in=drifted_ids).update(active_loan_count=active_loans, updated_at=now())
+
+    return len(drifted_ids)
@@ -0,0 +1,111 @@
+"""
+Transactional outbox.
+
+Circulation records what happened as ``OutboxEvent`` rows in the same
+transaction as the change itself, instead of talking to the broker. Events
+of a rolled back transaction never exist, and events of a committed one are
+not lost if the broker is down; requests never wait on the broker.
+
+The relay (``python manage.py relay_outbox``) hands committed events to
+their topic's handler in id order and deletes them in the same transaction,
+so delivery is at least once: a relay dying between the two re-sends the
+batch.
+
+An event whose handler fails is retried with exponential backoff, and set
+aside as dead after ``OUTBOX_MAX_ATTEMPTS`` failures, so failing events
+never hold up the ones behind them.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import now
+from kombu.exceptions import OperationalError as BrokerError
+
+from library.choices import OutboxStatusChoices
+from library.models import OutboxEvent
+from library.tasks import import_catalog_file, notify_loans
+
+logger = logging.getLogger(__name__)
+
+LOANS_CHECKED_OUT = 'loans.checked_out'
+CATALOG_IMPORT_UPLOADED = 'catalog.import_uploaded'
+
+HANDLERS = {
+    LOANS_CHECKED_OUT: notify_loans,
+    CATALOG_IMPORT_UPLOADED: import_catalog_file.delay,
+}
+
+
+def publish(topic:str, **payload):
+    """
+    Record an event. Call it inside the transaction making the change.
+
+    Args:
+        topic (str): One of ``HANDLERS``
+        **payload: JSON serializable handler arguments
+    """
+    return OutboxEvent.objects.create(topic=topic, payload=payload)
+
+
+def retry_delay(attempts:int) -> timedelta:
+    """
+    Time to wait before relaying an event again.
+
+    Args:
+        attempts (int): Failed attempts so far, at least 1
+    """
+    seconds = settings.OUTBOX_RETRY_SECONDS * 2 ** (attempts - 1)
+    return timedelta(seconds=min(seconds, settings.OUTBOX_RETRY_MAX_SECONDS))
+
+
+def relay_outbox_events(batch_size:int=100) -> int:
+    """
+    Hand the oldest pending events due for relaying to their handlers.
+
+    Rows are locked with ``SKIP LOCKED`` so several relays can run side by
+    side. An event whose handler fails stays in the outbox with its error
+    and is not retried before its ``next_attempt_at``; after
+    ``OUTBOX_MAX_ATTEMPTS`` failures it is marked dead and left for an
+    operator. A broker error ends the batch early, since the rest would
+    fail too, and never makes an event dead.
+
+    Args:
+        batch_size (int): Events to relay at most
+
+    Returns:
+        int: Number of events relayed
+    """
+    with transaction.atomic():
+        started_at = now()
+        events = list(
+            OutboxEvent.objects.select_for_update(skip_locked=True)
+            .filter(status=OutboxStatusChoices.PENDING)
+            .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=started_at))
+            .order_by('id')[:batch_size]
+        )
+
+        relayed, failed = [], []
+        for event in events:
+            try:
+                HANDLERS[event.topic](**event.payload)
+            except Exception as e:
+                logger.exception('Could not relay outbox event %s.', event.id)
+                event.attempts += 1
+                event.last_error = repr(e)
+                event.next_attempt_at = started_at + retry_delay(event.attempts)
+                failed.append(event)
+                if isinstance(e, BrokerError):
+                    break
+                if event.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                    logger.error('Outbox event %s is dead after %s attempts.', event.id, event.attempts)
+                    event.status = OutboxStatusChoices.DEAD
+            else:
+                relayed.append(event.id)
+
+        OutboxEvent.objects.filter(id__in=relayed).delete()
+        OutboxEvent.objects.bulk_update(failed, ['attempts', 'last_error', 'next_attempt_at', 'status'])
+
+    return len(relayed)
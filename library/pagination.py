@@ -0,0 +1,211 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (seek) pagination over a fixed, unique ordering.
+
+    Pages are fetched with ``WHERE (ordering) > (last row)`` instead of an
+    ``OFFSET``, so deep pages cost the same as the first one as long as the
+    ordering is indexed. The cursor is an opaque token holding the ordering
+    values of the row at the page boundary.
+
+    No ``COUNT(*)`` is issued unless the client asks for one with
+    ``?count=estimate``, which reads the planner's row estimate on PostgreSQL
+    and falls back to an exact count elsewhere.
+    """
+    ordering = ('id',)
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.count = self.get_count(queryset) if request.query_params.get(self.count_query_param) else None
+
+        values, reverse = self.decode_cursor(request, queryset.model)
+        queryset = queryset.order_by(*self.get_ordering(reverse))
+        if values is not None:
+            queryset = queryset.filter(self.get_seek_filter(values, reverse))
+
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+
+        self.has_next = (values is not None) if reverse else has_more
+        self.has_previous = has_more if reverse else (values is not None)
+        self.first_key = self.get_row_key(rows[0]) if rows else None
+        self.last_key = self.get_row_key(rows[-1]) if rows else None
+
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_ordering(self, reverse=False):
+        if not reverse:
+            return self.ordering
+        return tuple(field[1:] if field.startswith('-') else f'-{field}' for field in self.ordering)
+
+    def get_seek_filter(self, values, reverse):
+        """
+        Build the row-value comparison for rows after the cursor.
+
+        ``(a, b) > (x, y)`` becomes ``a >= x AND (a > x OR (a = x AND b > y))``,
+        with the comparisons flipped for descending fields and for backwards
+        paging. The redundant leading bound gives the planner an index range
+        to start from, which the OR alone does not.
+        """
+        seek = Q()
+        equal = Q()
+        bound = None
+        for field, value in zip(self.ordering, values):
+            descending = field.startswith('-')
+            name = field.lstrip('-')
+            lookup = 'lt' if descending != reverse else 'gt'
+            if bound is None:
+                bound = Q(**{f'{name}__{lookup}e': value})
+            seek |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        return bound & seek if len(values) > 1 else seek
+
+    def get_key_fields(self):
+        """
+        Get the fields a row's cursor is made of, which every row must load.
+        """
+        return [field.lstrip('-') for field in self.ordering]
+
+    def get_row_key(self, row):
+        names = self.get_key_fields()
+        if isinstance(row, dict):
+            return [row[name] for name in names]
+        return [getattr(row, name) for name in names]
+
+    def get_count(self, queryset):
+        """
+        Estimate the number of rows in a queryset.
+
+        Args:
+            queryset (QuerySet): Filtered, unpaginated queryset
+        """
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return queryset.count()
+
+        if not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                    [queryset.model._meta.db_table]
+                )
+                row = cursor.fetchone()
+            # reltuples is -1 until the table has been analyzed
+            if row and row[0] >= 0:
+                return row[0]
+
+        plan = json.loads(queryset.explain(format='json'))
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def encode_cursor(self, key, reverse):
+        payload = json.dumps({'k': key, 'r': int(reverse)}, cls=DjangoJSONEncoder, separators=(',', ':'))
+        token = urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, token)
+
+    def decode_cursor(self, request, model):
+        """
+        Read the cursor of a request, its values converted to the types of
+        the ordering fields.
+
+        Args:
+            request (Request): Current request
+            model (type): Model being paginated
+        """
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None, False
+
+        try:
+            payload = json.loads(urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+            values, reverse = payload['k'], bool(payload['r'])
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError('Wrong number of cursor values.')
+            values = [
+                self.to_python(model._meta.get_field(name), value)
+                for name, value in zip(self.get_key_fields(), values)
+            ]
+        except (BinasciiError, ValidationError, ValueError, TypeError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+        return values, reverse
+
+    @staticmethod
+    def to_python(field, value):
+        # Cursors only ever hold scalars, and NULL only for nullable fields
+        if isinstance(value, (dict, list)) or (value is None and not field.null):
+            raise ValueError(f'Invalid cursor value for {field.name}.')
+        return field.to_python(value)
+
+    def get_next_link(self):
+        if not self.has_next or self.last_key is None:
+            return None
+        return self.encode_cursor(self.last_key, reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or self.first_key is None:
+            return None
+        return self.encode_cursor(self.first_key, reverse=True)
+
+    def get_paginated_response(self, data):
+        payload = {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+        if self.count is not None:
+            payload = {'count': self.count, **payload}
+        return Response(payload)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'count': {'type': 'integer', 'example': 123},
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class BookPagination(KeysetPagination):
+    ordering = ('title', 'id')
+
+
+class MemberPagination(KeysetPagination):
+    ordering = ('id',)
+
+
+class LoanPagination(KeysetPagination):
+    ordering = ('-loan_date', 'id')
@@ -0,0 +1,96 @@
+"""
+Token bucket rate limits shared through the configured cache.
+
+With the Redis cache backend a bucket is a hash updated by a Lua script, so
+every worker draws from the same bucket atomically. Other backends guard a
+read-modify-write with a short ``CacheLock``.
+"""
+import time
+
+from django.core.cache import cache
+
+from library.locks import CacheLock, get_redis_client
+
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local count = tonumber(ARGV[3])
+local floor = tonumber(ARGV[4])
+local clock = redis.call('time')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call('hmget', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(state[1]) or capacity
+local at = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - at, 0) * rate)
+
+local wait = 0
+if tokens - count >= floor then
+    tokens = tokens - count
+else
+    wait = (count + floor - tokens) / rate
+end
+
+redis.call('hset', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+redis.call('pexpire', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at ``rate`` tokens per second up to ``capacity``.
+
+    Callers can ask to leave a ``reserve`` of tokens in the bucket, so
+    low-priority work cannot drain the capacity kept for urgent work.
+
+    Args:
+        name (str): Bucket name, one bucket per name
+        rate (float): Tokens added per second
+        capacity (float): Bucket size, the largest burst; ``rate`` by default
+    """
+
+    def __init__(self, name:str, rate:float, capacity:float=None):
+        self.key = f'ratelimit:{name}'
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+
+    def take(self, count:float=1, reserve:float=0) -> float:
+        """
+        Take tokens if enough are available.
+
+        Args:
+            count (float): Tokens to take
+            reserve (float): Tokens that must be left in the bucket, capped so
+                that ``count`` always fits
+
+        Returns:
+            float: 0 when the tokens were taken, else seconds to wait before
+                trying again
+        """
+        reserve = max(min(reserve, self.capacity - count), 0)
+
+        client, key = get_redis_client(self.key)
+        if client is not None:
+            return float(client.eval(TAKE_SCRIPT, 1, key, self.rate, self.capacity, count, reserve))
+
+        lock = CacheLock(f'{self.key}:mutex', timeout=5, heartbeat=0)
+        if not lock.acquire():
+            # Someone is updating the bucket right now
+            return count / self.rate
+
+        try:
+            now = time.time()
+            tokens, at = cache.get(self.key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + max(now - at, 0) * self.rate)
+
+            wait = 0.0
+            if tokens - count >= reserve:
+                tokens -= count
+            else:
+                wait = (count + reserve - tokens) / self.rate
+
+            cache.set(self.key, (tokens, now), timeout=self.capacity / self.rate + 1)
+            return wait
+        finally:
+            lock.release()
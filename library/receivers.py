@@ -0,0 +1,42 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.timezone import now
+
+from library import caching, leaderboard
+from library.models import Author, Book, Loan, Member
+from library.signals import loans_checked_out, loans_returned
+
+
+@receiver(loans_checked_out)
+@receiver(loans_returned)
+def invalidate_leaderboard(sender, member_id, book_ids, **kwargs):
+    leaderboard.invalidate()
+
+
+@receiver(loans_checked_out)
+@receiver(loans_returned)
+def invalidate_book_stock(sender, member_id, book_ids, **kwargs):
+    caching.invalidate_book_stock(book_ids)
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+def invalidate_catalog(sender, **kwargs):
+    caching.invalidate(caching.CATALOG)
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=Member)
+@receiver(post_delete, sender=Loan)
+def count_deletion(sender, **kwargs):
+    caching.invalidate(caching.deletions(sender))
+
+
+@receiver(post_save, sender=User)
+def touch_member(sender, instance, **kwargs):
+    # Members render their user, which has no updated_at of its own
+    Member.objects.filter(user_id=instance.id).update(updated_at=now())
@@ -0,0 +1,53 @@
+"""
+Book search.
+
+On PostgreSQL a book is matched against its stored ``search_vector``: title
+(weight A), author name (B) and genre (C). Database triggers keep the vector
+current on every write path, bulk ones included, and a GIN index serves the
+match; see migration ``0013_book_search``. Words that match no lexeme, typos
+mostly, fall back to trigram similarity with the title, served by a trigram
+GIN index, so ``"pyhton"`` still finds Python books.
+
+Other backends, SQLite in the test settings, get a case-insensitive
+substring match over the same fields, for every word of the query.
+"""
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
+from django.db import connections
+from django.db.models import F, Q
+
+from library.models import Book
+
+# Text search configuration the triggers build the vectors with
+SEARCH_CONFIG = 'english'
+
+
+def search_books(query:str, queryset=None):
+    """
+    Find books matching a free text query, best matches first.
+
+    Args:
+        query (str): Words to look for; quoted phrases, ``or`` and ``-word``
+            are understood on PostgreSQL
+        queryset (QuerySet): Books to search, all of them by default
+    """
+    if queryset is None:
+        queryset = Book.objects.all()
+
+    if connections[queryset.db].vendor != 'postgresql':
+        # Each word in any field, so "David Beazley" spans both author names
+        for word in query.split():
+            queryset = queryset.filter(
+                Q(title__icontains=word)
+                | Q(author__first_name__icontains=word)
+                | Q(author__last_name__icontains=word)
+                | Q(genre__icontains=word)
+            )
+        return queryset.order_by('title', 'id')
+
+    search_query = SearchQuery(query, config=SEARCH_CONFIG, search_type='websearch')
+    # Either side can use its own GIN index, combined with a BitmapOr
+    return queryset.filter(
+        Q(search_vector=search_query) | Q(title__trigram_word_similar=query)
+    ).annotate(
+        rank=SearchRank(F('search_vector'), search_query) + TrigramWordSimilarity(query, 'title')
+    ).order_by('-rank', 'id')
@@ -1,13 +1,205 @@
+from django.core.exceptions import FieldDoesNotExist
 from rest_framework import serializers
-from .models import Author, Book, Member, Loan
+from rest_framework.exceptions import ValidationError
+from .choices import FileFormatChoices
+from .importers import detect_format
+from .models import Author, Book, CatalogImport, Member, Loan
 from django.contrib.auth.models import User
 
-class AuthorSerializer(serializers.ModelSerializer):
+
+class EagerLoadingMixin:
+    """
+    Load the relations a serializer renders together with the queryset.
+
+    Nested serializers are discovered from the declared fields: a single
+    nested object becomes a ``select_related`` path and a ``many=True`` one a
+    ``prefetch_related`` path, recursively. Relations a serializer reaches in
+    other ways can be listed in ``select_related_fields`` and
+    ``prefetch_related_fields``.
+
+    A serializer built with a ``fieldset`` renders only the fields it
+    selects, see ``library.fieldsets``.
+    """
+    select_related_fields = ()
+    prefetch_related_fields = ()
+    fieldset = None
+
+    def __init__(self, *args, fieldset=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fieldset = fieldset
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if self.fieldset is None:
+            return fields
+        return self.fieldset.prune(fields)
+
+    @classmethod
+    def get_eager_loading_paths(cls, prefix=''):
+        select_related = [f'{prefix}{path}' for path in cls.select_related_fields]
+        prefetch_related = [f'{prefix}{path}' for path in cls.prefetch_related_fields]
+
+        for name, field in cls._declared_fields.items():
+            if getattr(field, 'write_only', False):
+                continue
+
+            source = field.source or name
+            if isinstance(field, serializers.ListSerializer):
+                prefetch_related.append(f'{prefix}{source}')
+                continue
+
+            if not isinstance(field, EagerLoadingMixin):
+                continue
+
+            select_related.append(f'{prefix}{source}')
+            nested_select, nested_prefetch = field.get_eager_loading_paths(prefix=f'{prefix}{source}__')
+            select_related.extend(nested_select)
+            prefetch_related.extend(nested_prefetch)
+
+        return select_related, prefetch_related
+
+    @classmethod
+    def get_values_representation(cls, fieldset=None):
+        """
+        Get the serializer's ``ValuesRepresentation``, or ``None`` if it
+        cannot be compiled. The full one is compiled on first use and kept.
+
+        Args:
+            fieldset (Fieldset): Fields to render, all of them by default
+        """
+        if fieldset is not None:
+            return ValuesRepresentation.compile(cls, fieldset)
+        if '_values_representation' not in cls.__dict__:
+            cls._values_representation = ValuesRepresentation.compile(cls)
+        return cls._values_representation
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """
+        Apply the serializer's eager loading paths to a queryset.
+
+        Args:
+            queryset (QuerySet): Queryset the serializer will render
+        """
+        select_related, prefetch_related = cls.get_eager_loading_paths()
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        return queryset
+
+
+class ValuesRepresentation:
+    """
+    Render what a serializer renders straight from ``.values()`` rows.
+
+    The serializer's readable fields are compiled once into a layout of
+    ``values()`` paths, with nested serializers flattened into joined paths,
+    and each row becomes a plain dict without any serializer or model
+    instance being built. Fields holding strings, numbers and booleans pass
+    through; the others, dates mostly, go through their own
+    ``to_representation``, so the JSON is the serializer's byte for byte.
+
+    Only model serializers over concrete fields, nested or not, can be
+    compiled; ``compile`` returns ``None`` for anything else.
+    """
+    # values() reads a relation as its primary key
+    passthrough = (serializers.BooleanField, serializers.CharField, serializers.ChoiceField,
+                   serializers.IntegerField, serializers.PrimaryKeyRelatedField)
+
+    def __init__(self, layout, paths, relations):
+        self.layout = layout
+        self.paths = paths
+        self.relations = relations
+
+    @classmethod
+    def compile(cls, serializer_class, fieldset=None):
+        """
+        Compile a serializer class, or return ``None`` if it cannot be.
+
+        Args:
+            serializer_class (type): ``ModelSerializer`` subclass
+            fieldset (Fieldset): Fields to render, all of them by default
+        """
+        paths, relations = [], []
+        serializer = serializer_class() if fieldset is None else serializer_class(fieldset=fieldset)
+        try:
+            layout = cls._compile_layout(serializer, '', paths, relations)
+        except (AttributeError, FieldDoesNotExist, ValueError):
+            return None
+        return cls(layout, paths, relations)
+
+    @classmethod
+    def _compile_layout(cls, serializer, prefix, paths, relations):
+        model = serializer.Meta.model
+        layout = []
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            if '.' in field.source or field.source == '*':
+                raise ValueError(f'Cannot compile source "{field.source}".')
+
+            model_field = model._meta.get_field(field.source)
+            if not model_field.concrete:
+                raise ValueError(f'"{field.source}" is not a column.')
+
+            path = f'{prefix}{field.source}'
+            paths.append(path)
+            if isinstance(field, serializers.ModelSerializer):
+                # Nested: rendered as None when the relation is empty
+                relations.append(path)
+                layout.append((name, path, None, cls._compile_layout(field, f'{path}__', paths, relations)))
+            elif isinstance(field, serializers.BaseSerializer):
+                raise ValueError(f'Cannot compile nested "{name}".')
+            else:
+                convert = None if isinstance(field, cls.passthrough) else field.to_representation
+                layout.append((name, path, convert, None))
+        return layout
+
+    def apply(self, queryset, extra=()):
+        """
+        Read the rows to render as dicts.
+
+        Args:
+            queryset (QuerySet): Rows to render
+            extra (tuple): Other field paths to read, pagination keys say
+        """
+        return queryset.values(*dict.fromkeys([*self.paths, *extra]))
+
+    def load_only(self, queryset, extra=()):
+        """
+        Load model instances with the rendered columns and relations only.
+
+        Args:
+            queryset (QuerySet): Instances to render
+            extra (tuple): Other field paths to load
+        """
+        if self.relations:
+            queryset = queryset.select_related(*self.relations)
+        return queryset.only(*dict.fromkeys([*self.paths, *extra]))
+
+    def to_representation(self, row:dict) -> dict:
+        return self._render(row, self.layout)
+
+    def _render(self, row, layout):
+        data = {}
+        for name, path, convert, nested in layout:
+            value = row[path]
+            if nested is not None:
+                data[name] = None if value is None else self._render(row, nested)
+            elif convert is None or value is None:
+                data[name] = value
+            else:
+                data[name] = convert(value)
+        return data
+
+
+class AuthorSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     class Meta:
         model = Author
         fields = '__all__'
 
-class BookSerializer(serializers.ModelSerializer):
+class BookSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     author = AuthorSerializer(read_only=True)
     author_id = serializers.PrimaryKeyRelatedField(
         queryset=Author.objects.all(), source='author', write_only=True
@@ -17,12 +209,12 @@ class BookSerializer(serializers.ModelSerializer):
         model = Book
         fields = ['id', 'title', 'author', 'author_id', 'isbn', 'genre', 'available_copies']
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'username', 'email']
 
-class MemberSerializer(serializers.ModelSerializer):
+class MemberSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
     user_id = serializers.PrimaryKeyRelatedField(
         queryset=User.objects.all(), source='user', write_only=True
@@ -32,7 +224,7 @@ class MemberSerializer(serializers.ModelSerializer):
         model = Member
         fields = ['id', 'user', 'user_id', 'membership_date']
 
-class LoanSerializer(serializers.ModelSerializer):
+class LoanSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     book = BookSerializer(read_only=True)
     book_id = serializers.PrimaryKeyRelatedField(
         queryset=Book.objects.all(), source='book', write_only=True
@@ -46,9 +238,49 @@ class LoanSerializer(serializers.ModelSerializer):
         model = Loan
         fields = ['id', 'book', 'book_id', 'member', 'member_id', 'loan_date', 'return_date', 'is_returned']
 
+    def validate(self, attrs):
+        book = attrs.get('book', getattr(self.instance, 'book', None))
+        member = attrs.get('member', getattr(self.instance, 'member', None))
+        is_returned = attrs.get('is_returned', getattr(self.instance, 'is_returned', False))
+
+        if not is_returned and book and member:
+            active_loans = Loan.objects.filter(book=book, member=member, is_returned=False)
+            if self.instance is not None:
+                active_loans = active_loans.exclude(id=self.instance.id)
+            if active_loans.exists():
+                raise serializers.ValidationError('Member already has an active loan for this book.')
+
+        return attrs
+
 
 class ActiveMemberSerializer(serializers.Serializer):
     id = serializers.IntegerField(read_only=True)
     username = serializers.CharField(source='user__username', read_only=True)
     email = serializers.CharField(source='user__email', read_only=True)
-    active_loans = serializers.IntegerField()
\ No newline at end of file
+    active_loans = serializers.IntegerField()
+
+
+class BulkCirculationSerializer(serializers.Serializer):
+    member_id = serializers.PrimaryKeyRelatedField(queryset=Member.objects.all(), source='member')
+    book_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=100
+    )
+
+
+class CatalogImportSerializer(serializers.ModelSerializer):
+    format = serializers.ChoiceField(choices=FileFormatChoices.choices, required=False)
+
+    class Meta:
+        model = CatalogImport
+        fields = ['id', 'file', 'format', 'status', 'rows', 'imported', 'failed', 'errors',
+                  'created_at', 'started_at', 'finished_at']
+        read_only_fields = ['status', 'rows', 'imported', 'failed', 'errors', 'created_at', 'started_at', 'finished_at']
+        extra_kwargs = {'file': {'write_only': True}}
+
+    def validate(self, attrs):
+        if not attrs.get('format'):
+            try:
+                attrs['format'] = detect_format(attrs['file'].name)
+            except ValidationError as e:
+                raise serializers.ValidationError({'format': e.detail})
+        return attrs
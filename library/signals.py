@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# Sent once the transaction that checked loans out or returned them has
+# committed, with ``member_id`` and the ``book_ids`` involved. Bulk writes
+# that bypass model signals, such as the circulation updates, rely on these.
+loans_checked_out = Signal()
+loans_returned = Signal()
@@ -1,14 +1,25 @@
+import io
+import logging
+from datetime import timedelta
 from typing import List, Dict
-from itertools import islice
+from itertools import groupby, islice
+from smtplib import SMTPException
 
-from celery import shared_task
-from django.core.cache import cache
-
-from .models import Loan
-from django.core.mail import send_mail
+from celery import chord, shared_task
 from django.conf import settings
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils.timezone import now
+
+from .choices import ImportStatusChoices, SweepStatusChoices
+from .importers import import_catalog
+from .locks import CacheLock, single_instance
+from .models import CatalogImport, Loan, OverdueSweepRun, OverdueSweepShard
+from .notifications import HIGH, LOW, buffer_loan_ids, build_message, drain_loan_ids, send_messages
+from .operations import (claim_overdue_reminders, get_member_overdue_book_title_values, iter_overdue_member_digests,
+                         plan_overdue_sweep_shards, release_overdue_reminders)
 
-from .operations import get_loan_overdue_members, get_member_overdue_book_title_values
+logger = logging.getLogger(__name__)
 
 
 @shared_task
@@ -17,78 +28,316 @@ def send_loan_notification(loan_id):
         loan = Loan.objects.get(id=loan_id)
         member_email = loan.member.user.email
         book_title = loan.book.title
-        send_mail(
+        send_messages([build_message(
             subject='Book Loaned Successfully',
-            message=f'Hello {loan.member.user.username},\n\nYou have successfully loaned "{book_title}".\nPlease return it by the due date.',
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[member_email],
-            fail_silently=False,
-        )
+            body=f'Hello {loan.member.user.username},\n\nYou have successfully loaned "{book_title}".\nPlease return it by the due date.',
+            to=member_email,
+        )], priority=HIGH)
     except Loan.DoesNotExist:
         pass
 
 
-@shared_task(queue='schedule')
+@shared_task
+def send_bulk_loan_notification(loan_ids: List[int]):
+    """
+    Send one email per member for loans created together, e.g. a checkout cart.
+
+    Args:
+        loan_ids: IDs of the loans to confirm.
+    """
+    loans = Loan.objects.filter(
+        id__in=loan_ids
+    ).select_related(
+        'book', 'member__user'
+    ).order_by('member_id', 'id')
+
+    messages = []
+    for _, member_loans in groupby(loans, key=lambda loan: loan.member_id):
+        member_loans = list(member_loans)
+        user = member_loans[0].member.user
+        book_titles = "\n".join(f'"{loan.book.title}"' for loan in member_loans)
+        messages.append(build_message(
+            subject='Books Loaned Successfully',
+            body=f'Hello {user.username},\n\nYou have successfully loaned:\n{book_titles}\nPlease return them by the due date.',
+            to=user.email,
+        ))
+
+    send_messages(messages, priority=HIGH)
+
+
+@shared_task
+def send_loan_digest(member_id:int):
+    """
+    Send one confirmation for every loan buffered for a member.
+
+    Args:
+        member_id (int): Member whose buffered loans to confirm
+    """
+    loan_ids = drain_loan_ids(member_id)
+    if loan_ids:
+        send_bulk_loan_notification(loan_ids)
+
+
+def notify_loans(member_id:int, loan_ids:List[int]):
+    """
+    Queue the confirmation of new loans. Call it once they are committed.
+
+    With ``NOTIFICATION_COALESCE_SECONDS`` set, loans are buffered per member
+    and the first loan of a window schedules one ``send_loan_digest`` for
+    the whole window.
+
+    Args:
+        member_id (int): Member who took the loans
+        loan_ids (List[int]): New loans
+    """
+    window = settings.NOTIFICATION_COALESCE_SECONDS
+    if window:
+        if buffer_loan_ids(member_id, loan_ids):
+            send_loan_digest.apply_async((member_id,), countdown=window)
+    elif len(loan_ids) == 1:
+        send_loan_notification.delay(loan_ids[0])
+    else:
+        send_bulk_loan_notification.delay(loan_ids)
+
+
+@shared_task(autoretry_for=(SMTPException,), retry_backoff=True, max_retries=3)
 def send_batch_overdue_notification(members: List[Dict[str, str]]):
     """
     Send email reminder to members with overdue loans in batch
 
+    Members are claimed for today before sending, so a batch that is queued
+    twice, or retried, does not remind anyone twice. If sending fails, the
+    claims of the members not reminded yet are released for the retry.
+
     Args:
-        members: list of member dictionary with id, name, and email.
+        members: list of member digests with id, name, email and overdue
+            book titles, as built by ``iter_overdue_member_digests``.
     """
     email_subject = 'Book Loan Overdue Reminder'
+    today = now().date()
 
+    members = [member for member in members if int(member['id']) and member['email']]
+    claims = claim_overdue_reminders([int(member['id']) for member in members], today)
+
+    messages, recipients = [], {}
     for member in members:
-        # Get member loans
         member_id:int = int(member['id'])
         email:str = member['email']
 
-        if not (member_id and email):
+        if member_id not in claims:
             continue
 
-        # Get books
-        books = get_member_overdue_book_title_values(member_id)
+        # Batches queued before digests carried titles still need a lookup
+        titles = member.get('titles')
+        if titles is None:
+            titles = [book['book__title'] for book in get_member_overdue_book_title_values(member_id)]
 
-        overdue_books = "\n".join([book['book__title'] for book in books])
+        overdue_books = "\n".join(titles)
 
         message = f'Hello {member["name"]},\n\nThese books are overdue \n "{overdue_books}".\n Please return them.'
-        send_mail(
-            subject=email_subject,
-            message=message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[email],
-            fail_silently=False,
-        )
+        messages.append(build_message(subject=email_subject, body=message, to=email))
+        recipients[id(messages[-1])] = member_id
 
+    delivered = []
+    try:
+        # One connection for the whole batch instead of one per member
+        return send_messages(messages, priority=LOW, delivered=delivered)
+    except Exception:
+        reminded = {recipients[id(message)] for message in delivered}
+        release_overdue_reminders(
+            {member_id: previous for member_id, previous in claims.items() if member_id not in reminded}, today
+        )
+        raise
 
 
 @shared_task
+@single_instance('overdue_loans_task', timeout=60)
 def check_overdue_loans():
     """
     Check overdue loans.
+
+    Plans today's ``OverdueSweepRun`` as member-id range shards and runs them
+    as a chord on the ``schedule`` queue, with ``summarize_overdue_sweep`` as
+    the callback. Calling it again re-queues the shards that have not
+    completed, which resume from their checkpoints, and does nothing once
+    the run has completed.
     """
+    run, _ = OverdueSweepRun.objects.get_or_create(run_date=now().date())
+    if run.status == SweepStatusChoices.COMPLETED:
+        return 'Sweep already completed.'
 
-    # Implement lock to prevent task overlap
-    overdue_task_key = 'overdue_loans_task'
+    if run.shards.exists():
+        shard_ids = list(run.shards.exclude(status=SweepStatusChoices.COMPLETED).values_list('id', flat=True))
+    else:
+        shard_ids = plan_overdue_sweep_shards(run, shard_count=settings.OVERDUE_SWEEP_SHARDS)
 
-    # Check if cache exists
-    if cache.get(overdue_task_key):
-        return "Task is running."
+    if not shard_ids:
+        return summarize_overdue_sweep([], run.id)
 
-    cache.set(overdue_task_key, True, timeout=300)
+    chord(sweep_overdue_shard.s(shard_id) for shard_id in shard_ids)(summarize_overdue_sweep.s(run.id))
+    return f'Queued {len(shard_ids)} shard(s).'
 
-    try:
-        overdue_members = get_loan_overdue_members().iterator(chunk_size=500)
 
-        batch_size = 50
+@shared_task
+def sweep_overdue_shard(shard_id:int):
+    """
+    Remind the overdue members of one sweep shard.
 
-        while True:
-            chunk = list(islice(overdue_members, batch_size))
+    Batches are sent inline so the shard only finishes, and the chord only
+    fires, once its mail is out. A failed batch ends the shard without
+    failing the chord: its members stay unclaimed, the checkpoint stays
+    before them and the shard stays incomplete, so the next
+    ``check_overdue_loans`` retries them.
+
+    Args:
+        shard_id (int): ``OverdueSweepShard`` to run
+    """
+    # A re-queued shard must not run alongside the one it replaces
+    lock = CacheLock(f'overdue_sweep_shard:{shard_id}')
+    if not lock.acquire():
+        return {'shard': shard_id, 'skipped': True}
+
+    try:
+        shard = OverdueSweepShard.objects.get(id=shard_id)
+        digests = iter_overdue_member_digests(
+            chunk_size=2000, after_member_id=shard.last_member_id, up_to_member_id=shard.upper_member_id
+        )
+        totals = {'shard': shard_id, 'members': 0, 'sent': 0, 'failed': 0}
+
+        while shard.status != SweepStatusChoices.COMPLETED:
+            chunk = list(islice(digests, settings.OVERDUE_SWEEP_BATCH_SIZE))
             if not chunk:
                 break
 
-            # Get member data list
-            members_data = [{'id':m.id, 'name':m.user.first_name, 'email':m.user.email} for m in chunk]
-            send_batch_overdue_notification.delay(members_data)
+            batch = [digest for digest in chunk if digest['email']]
+            sent, failed = 0, 0
+            if batch:
+                try:
+                    sent = send_batch_overdue_notification(batch)
+                except Exception:
+                    logger.exception('Overdue reminder batch failed in shard %s.', shard_id)
+                    failed = len(batch)
+
+            if failed:
+                totals['failed'] = failed
+                OverdueSweepShard.objects.filter(id=shard_id).update(reminders_failed=failed, updated_at=now())
+                return totals
+
+            totals['members'] += len(batch)
+            totals['sent'] += sent
+            OverdueSweepShard.objects.filter(id=shard_id).update(
+                last_member_id=chunk[-1]['id'],
+                members=F('members') + len(batch),
+                reminders_sent=F('reminders_sent') + sent,
+                updated_at=now(),
+            )
+
+        OverdueSweepShard.objects.filter(id=shard_id).update(
+            status=SweepStatusChoices.COMPLETED, last_member_id=shard.upper_member_id, reminders_failed=0,
+            updated_at=now()
+        )
+        return totals
     finally:
-        cache.delete(overdue_task_key)
+        lock.release()
+
+
+@shared_task
+def summarize_overdue_sweep(results:List[Dict], run_id:int):
+    """
+    Record and log the totals of a sweep once its shards have finished.
+
+    Totals are read back from the shards, so they include work done before
+    a resume; ``failed`` counts the members of the batches waiting for a
+    retry. The run is only completed when every shard is, with no failed
+    batch left.
+
+    Args:
+        results: Shard task results, as passed by the chord
+        run_id (int): ``OverdueSweepRun`` to summarize
+    """
+    run = OverdueSweepRun.objects.get(id=run_id)
+    totals = run.shards.aggregate(
+        shards=Count('id'),
+        incomplete=Count('id', filter=~Q(status=SweepStatusChoices.COMPLETED)),
+        members=Coalesce(Sum('members'), 0),
+        sent=Coalesce(Sum('reminders_sent'), 0),
+        failed=Coalesce(Sum('reminders_failed'), 0),
+    )
+
+    run.members = totals['members']
+    run.reminders_sent = totals['sent']
+    run.reminders_failed = totals['failed']
+    if not totals['incomplete'] and not totals['failed']:
+        run.status = SweepStatusChoices.COMPLETED
+        run.finished_at = now()
+    run.save(update_fields=['members', 'reminders_sent', 'reminders_failed', 'status', 'finished_at'])
+
+    summary = {
+        'run_date': run.run_date.isoformat(),
+        'status': str(run.status),
+        'shards': totals['shards'],
+        'incomplete_shards': totals['incomplete'],
+        'members': totals['members'],
+        'sent': totals['sent'],
+        'failed': totals['failed'],
+        'skipped_shards': sum(1 for result in results if result.get('skipped')),
+        'duration_seconds': round(((run.finished_at or now()) - run.started_at).total_seconds(), 3),
+    }
+    logger.info('Overdue sweep summary: %s', summary)
+    return summary
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True, max_retries=None)
+def import_catalog_file(self, import_id:int):
+    """
+    Import an uploaded catalog file, recording progress on its
+    ``CatalogImport`` after every chunk.
+
+    The import is claimed with a conditional update, so delivering the task
+    twice imports the file once. The task is acknowledged once it is done:
+    if its worker dies, the broker delivers it again. A delivery finding
+    the import running retries until it has made no progress for
+    ``CATALOG_IMPORT_STALE_SECONDS`` and takes it over, or until it has
+    finished. Books are upserted by ISBN, so starting over does not import
+    a record twice.
+
+    Args:
+        import_id (int): ``CatalogImport`` to run
+    """
+    started_at = now()
+    stale = timedelta(seconds=settings.CATALOG_IMPORT_STALE_SECONDS)
+    # Running imports from before heartbeats were recorded have none
+    stalled = Q(heartbeat_at__lt=started_at - stale) | Q(heartbeat_at__isnull=True)
+    claimed = CatalogImport.objects.filter(
+        Q(status=ImportStatusChoices.PENDING) | Q(stalled, status=ImportStatusChoices.RUNNING),
+        id=import_id,
+    ).update(status=ImportStatusChoices.RUNNING, started_at=started_at, heartbeat_at=started_at)
+    if not claimed:
+        running = CatalogImport.objects.filter(id=import_id, status=ImportStatusChoices.RUNNING).first()
+        if running is None:
+            return 'Import already finished.'
+        # Its worker may be alive, or may have died just now; look again once it would be stale
+        raise self.retry(countdown=max((running.heartbeat_at + stale - started_at).total_seconds(), 0) + 1)
+
+    imports = CatalogImport.objects.filter(id=import_id)
+    catalog_import = imports.get()
+
+    def progress(result):
+        imports.update(
+            rows=result['rows'], imported=result['imported'], failed=result['failed'], heartbeat_at=now()
+        )
+
+    try:
+        with catalog_import.file.open('rb') as file:
+            stream = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+            result = import_catalog(stream, catalog_import.format, progress=progress)
+    except Exception as e:
+        logger.exception('Catalog import %s failed.', import_id)
+        imports.update(status=ImportStatusChoices.FAILED, finished_at=now(), errors=[{'line': None, 'error': str(e)}])
+        return 'Import failed.'
+
+    imports.update(
+        status=ImportStatusChoices.COMPLETED, finished_at=now(), rows=result['rows'],
+        imported=result['imported'], failed=result['failed'], errors=result['errors'],
+    )
+    return {key: result[key] for key in ('rows', 'imported', 'failed')}
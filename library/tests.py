@@ -1,18 +1,82 @@
+import json
+import csv
+import gzip
 import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from base64 import urlsafe_b64encode
 from datetime import timedelta
+from io import StringIO
+from smtplib import SMTPException
+from unittest.mock import patch
 
+from asgiref.sync import sync_to_async
+from celery import current_app
+from celery.exceptions import Retry
 from django.contrib.auth.models import User
 from django.core import mail
-from django.test import TestCase
-from django.urls import reverse_lazy
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends.locmem import EmailBackend as LocMemEmailBackend
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse, reverse_lazy
 from django.utils.timezone import now
+from kombu.exceptions import OperationalError as KombuOperationalError
 from rest_framework.test import APITestCase
-from rest_framework import status
+from rest_framework import serializers, status
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
 
+from library import caching, leaderboard
+from library.circulation import bulk_checkout, bulk_return, checkout_book, return_book
 from library.factory import TestFactory
-from library.models import Member, Book, Loan
-from library.operations import get_loan_overdue_members, get_member_overdue_book_title_values
-from library.tasks import check_overdue_loans
+from library.importers import import_catalog
+from library.locks import CacheLock, LockNotAcquired, single_instance
+from library.metrics import registry
+from library.notifications import HIGH, LOW, QUEUES, build_message, collect_metrics, send_messages
+from library.outbox import publish, relay_outbox_events
+from library.ratelimit import TokenBucket
+from library.choices import FileFormatChoices, ImportStatusChoices, OutboxStatusChoices, SweepStatusChoices
+from library.models import Author, CatalogImport, Member, Book, Loan, OutboxEvent, OverdueSweepRun, OverdueSweepShard
+from library.operations import (get_loan_overdue_members, get_member_overdue_book_title_values,
+                                iter_overdue_member_digests, plan_overdue_sweep_shards, reconcile_active_loan_counts)
+from library.serializers import BookSerializer, LoanSerializer, MemberSerializer, ValuesRepresentation
+from library.tasks import (check_overdue_loans, import_catalog_file, send_batch_overdue_notification, send_loan_digest,
+                           send_loan_notification, summarize_overdue_sweep, sweep_overdue_shard)
+
+
+class CountingEmailBackend(LocMemEmailBackend):
+    """
+    In-memory backend that records how many connections were opened.
+    """
+    opened = 0
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return True
+
+
+class FailingEmailBackend(LocMemEmailBackend):
+
+    def send_messages(self, messages):
+        raise SMTPException('Connection unexpectedly closed')
+
+
+class FailingOnRecipientEmailBackend(LocMemEmailBackend):
+    """
+    In-memory backend that fails on messages to one address.
+    """
+    failing = 'fail@example.com'
+
+    def send_messages(self, messages):
+        if any(self.failing in message.to for message in messages):
+            raise SMTPException('Recipient refused')
+        return super().send_messages(messages)
 
 
 def create_test_member(**kwargs):
@@ -28,6 +92,9 @@ class AuthorApiTest(APITestCase):
 
     base_url = reverse_lazy('api:author-list')
 
+    def setUp(self):
+        cache.clear()
+
     def test_author_list(self):
         response = self.client.get(self.base_url)
         json = response.json()
@@ -54,13 +121,49 @@ class BookApiTest(APITestCase):
     base_url = reverse_lazy('api:book-list')
     detail_url = 'api:book-detail'
 
+    def setUp(self):
+        cache.clear()
+
     def test_book_list(self):
-        response = self.client.get(self.base_url)
+        response = self.client.get(self.base_url, {'count': 'estimate'})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         json = response.json()
         self.assertEqual(json['count'], 3)
         self.assertEqual(len(json['results']), 3)
 
+    def test_book_list_keyset_pages(self):
+        response = self.client.get(self.base_url, {'page_size': 1})
+        json = response.json()
+        self.assertNotIn('count', json)
+        self.assertIsNone(json['previous'])
+
+        titles = [json['results'][0]['title']]
+        while json['next']:
+            json = self.client.get(json['next']).json()
+            titles.extend(book['title'] for book in json['results'])
+
+        self.assertEqual(titles, sorted(titles))
+        self.assertEqual(len(titles), 3)
+
+        # Walk back from the last page
+        json = self.client.get(json['previous']).json()
+        self.assertEqual([book['title'] for book in json['results']], titles[1:2])
+
+    def test_book_list_invalid_cursor(self):
+        response = self.client.get(self.base_url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cursor_values_of_the_wrong_type(self):
+        cases = (
+            (self.base_url, [{'title': 'x'}, 'x']),
+            (self.base_url, [None, 1]),
+            (reverse_lazy('api:loan-list'), ['not-a-date', 1]),
+        )
+        for url, key in cases:
+            token = urlsafe_b64encode(json.dumps({'k': key, 'r': 0}).encode()).decode()
+            response = self.client.get(url, {'cursor': token})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, key)
+
     def test_book_create(self):
         response = self.client.post(self.base_url, data=TestFactory.book_factory())
         json = response.json()
@@ -93,6 +196,890 @@ class BookApiTest(APITestCase):
         member.refresh_from_db()
         self.assertEqual(member.loans.count(), 1)
 
+    def test_book_loan_no_copies(self):
+        member = create_test_member()
+        Book.objects.filter(id=1).update(available_copies=0)
+
+        url = reverse_lazy(self.detail_url, kwargs={'pk': 1}) + 'loan/'
+        response = self.client.post(url, data={'member_id': member.id})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Loan.objects.exists())
+
+    def test_book_return(self):
+        member = create_test_member()
+        checkout_book(book_id=1, member_id=member.id)
+
+        url = reverse_lazy(self.detail_url, kwargs={'pk': 1}) + 'return_book/'
+        response = self.client.post(url, data={'member_id': member.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(Book.objects.get(id=1).available_copies, 5)
+        self.assertTrue(Loan.objects.get(member=member).is_returned)
+
+        # A second return has no active loan left
+        response = self.client.post(url, data={'member_id': member.id})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Book.objects.get(id=1).available_copies, 5)
+
+    def test_book_search(self):
+        url = self.base_url + 'search/'
+
+        response = self.client.get(url, {'q': 'celery'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([book['id'] for book in response.json()['results']], [3])
+
+        # Author names are searched too, and page_size caps the matches
+        response = self.client.get(url, {'q': 'author', 'page_size': 2})
+        self.assertEqual([book['title'] for book in response.json()['results']],
+                         ['Django Cook Book', 'Programing with Python'])
+
+        # Every word has to match, each in any field
+        author = Author.objects.create(first_name='David', last_name='Beazley')
+        book = Book.objects.create(title='Python Cookbook', author=author, isbn='978-1449340377')
+        for query in ('David Beazley', 'beazley python'):
+            response = self.client.get(url, {'q': query})
+            self.assertEqual([result['id'] for result in response.json()['results']], [book.id])
+
+        response = self.client.get(url, {'q': '  '})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=300)
+class CatalogCacheTest(APITestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    list_url = reverse_lazy('api:book-list')
+
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+
+    def detail_url(self, book_id):
+        return reverse_lazy('api:book-detail', kwargs={'pk': book_id})
+
+    def lookups(self, result, view='book'):
+        return registry._counters[('library_response_cache_total', (('result', result), ('view', view)))]
+
+    def test_list_is_served_from_cache(self):
+        first = self.client.get(self.list_url)
+
+        with self.assertNumQueries(0):
+            second = self.client.get(self.list_url)
+
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual((self.lookups('miss'), self.lookups('hit')), (1, 1))
+
+    def test_if_none_match_returns_304(self):
+        etag = self.client.get(self.detail_url(1))['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.detail_url(1), HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.lookups('not_modified'), 1)
+
+    def test_checkout_invalidates_book_and_lists_only(self):
+        member = create_test_member()
+        list_etag = self.client.get(self.list_url)['ETag']
+        detail_etags = {book_id: self.client.get(self.detail_url(book_id))['ETag'] for book_id in (1, 2)}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            checkout_book(book_id=1, member_id=member.id)
+
+        response = self.client.get(self.detail_url(1), HTTP_IF_NONE_MATCH=detail_etags[1])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['available_copies'], Book.objects.get(id=1).available_copies)
+        self.assertEqual(self.client.get(self.list_url, HTTP_IF_NONE_MATCH=list_etag).status_code, status.HTTP_200_OK)
+        # Other books keep their cached detail
+        response = self.client.get(self.detail_url(2), HTTP_IF_NONE_MATCH=detail_etags[2])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_lost_versions_do_not_revalidate_old_etags(self):
+        etag = self.client.get(self.detail_url(1))['ETag']
+
+        # Evicted, or the cache was flushed or restarted
+        cache.delete_many([f'{namespace}:version' for namespace in (caching.CATALOG, caching.catalog_book(1))])
+
+        response = self.client.get(self.detail_url(1), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.lookups('miss'), 2)
+
+    def test_author_change_invalidates_books(self):
+        etag = self.client.get(self.detail_url(1))['ETag']
+        book = Book.objects.select_related('author').get(id=1)
+        book.author.last_name = 'Renamed'
+        book.author.save()
+
+        response = self.client.get(self.detail_url(1), HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['author']['last_name'], 'Renamed')
+
+
+class ConditionalGetTest(APITestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    loan_list_url = reverse_lazy('api:loan-list')
+
+    def setUp(self):
+        cache.clear()
+        self.member = create_test_member()
+        self.loans = [checkout_book(book_id=book_id, member_id=self.member.id) for book_id in (1, 2)]
+
+    def loan_url(self, loan):
+        return reverse_lazy('api:loan-detail', kwargs={'pk': loan.id})
+
+    def test_unchanged_loan_returns_304_from_one_query(self):
+        first = self.client.get(self.loan_url(self.loans[0]))
+        self.assertTrue(first.has_header('Last-Modified'))
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.loan_url(self.loans[0]), HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], first['ETag'])
+
+        response = self.client.get(self.loan_url(self.loans[0]), HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_loan_changes_with_its_nested_rows(self):
+        etag = self.client.get(self.loan_url(self.loans[0]))['ETag']
+
+        # Stock of the loaned book changes with another member's checkout
+        other = create_test_member(username='other', email='other@example.com')
+        checkout_book(book_id=1, member_id=other.id)
+        response = self.client.get(self.loan_url(self.loans[0]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        etag = response['ETag']
+        self.member.user.email = 'renamed@example.com'
+        self.member.user.save()
+        response = self.client.get(self.loan_url(self.loans[0]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['member']['user']['email'], 'renamed@example.com')
+
+    def test_loan_list_changes_on_update_and_delete(self):
+        etag = self.client.get(self.loan_list_url)['ETag']
+        self.assertEqual(
+            self.client.get(self.loan_list_url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED
+        )
+
+        return_book(book_id=2, member_id=self.member.id)
+        response = self.client.get(self.loan_list_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.has_header('Last-Modified'))
+
+        # Deleting a row other than the latest lowers no MAX(updated_at)
+        etag = response['ETag']
+        self.loans[0].delete()
+        response = self.client.get(self.loan_list_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()['results']), 1)
+
+    @override_settings(CATALOG_CACHE_TIMEOUT=0)
+    def test_uncached_book_is_validated_from_updated_at(self):
+        url = reverse_lazy('api:book-detail', kwargs={'pk': 3})
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        checkout_book(book_id=3, member_id=self.member.id)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['available_copies'], 4)
+
+
+CATALOG_CSV = """title,isbn,genre,available_copies,author_first_name,author_last_name
+Python Cookbook,978-1449340,dev,3,David,Beazley
+Programming with Python 2nd Edition,033-5678-456,dev,9,Author 1,Author 1
+Fluent Python,978-1491946,dev,,David,Beazley
+No Isbn,,dev,1,David,Beazley
+Bad Copies,978-0000001,dev,many,David,Beazley
+"""
+
+
+class CatalogImportTest(APITestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    def test_import_creates_and_upserts_by_isbn(self):
+        authors = Author.objects.count()
+
+        result = import_catalog(StringIO(CATALOG_CSV), FileFormatChoices.CSV, chunk_size=2)
+
+        self.assertEqual((result['rows'], result['imported'], result['failed']), (5, 3, 2))
+        self.assertEqual([error['line'] for error in result['errors']], [5, 6])
+        # One new author, however many of their books; the fixture author is reused
+        self.assertEqual(Author.objects.count(), authors + 1)
+        self.assertEqual(Book.objects.get(isbn='978-1491946').available_copies, 1)
+
+        # Existing books take the catalog's title but keep their stock
+        book = Book.objects.get(isbn='033-5678-456')
+        self.assertEqual((book.id, book.title, book.available_copies), (1, 'Programming with Python 2nd Edition', 5))
+
+    def test_import_json_lines_later_records_win(self):
+        lines = [
+            json.dumps({'title': 'Draft', 'isbn': '978-1', 'author_first_name': 'A', 'author_last_name': 'B'}),
+            'not json',
+            json.dumps({'title': 'Final', 'isbn': '978-1', 'author_first_name': 'A', 'author_last_name': 'B'}),
+        ]
+
+        result = import_catalog(StringIO('\n'.join(lines)), FileFormatChoices.NDJSON)
+
+        self.assertEqual((result['rows'], result['imported'], result['failed']), (3, 1, 1))
+        self.assertEqual(result['errors'], [{'line': 2, 'error': 'Invalid JSON.'}])
+        self.assertEqual(Book.objects.get(isbn='978-1').title, 'Final')
+
+    def test_import_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as catalog:
+            catalog.write(CATALOG_CSV)
+            catalog.flush()
+            out, err = StringIO(), StringIO()
+            call_command('import_catalog', catalog.name, stdout=out, stderr=err)
+
+        self.assertIn('Imported 3 of 5 record(s), 2 failed.', out.getvalue())
+        self.assertIn('Line 5: isbn is required.', err.getvalue())
+
+    def test_upload_is_imported_in_the_background(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            response = self.client.post(reverse_lazy('api:catalogimport-list'), {
+                'file': SimpleUploadedFile('partner.csv', CATALOG_CSV.encode()),
+            })
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            self.assertEqual(response.json()['status'], ImportStatusChoices.PENDING)
+
+            # Handed to Celery once the upload is committed
+            self.assertEqual(relay_outbox_events(), 1)
+
+        response = self.client.get(reverse_lazy('api:catalogimport-detail', kwargs={'pk': response.json()['id']}))
+        json = response.json()
+        self.assertEqual(json['status'], ImportStatusChoices.COMPLETED)
+        self.assertEqual((json['format'], json['imported'], json['failed']), ('csv', 3, 2))
+        self.assertTrue(Book.objects.filter(isbn='978-1449340').exists())
+
+    def test_stale_running_import_is_taken_over(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            response = self.client.post(reverse_lazy('api:catalogimport-list'), {
+                'file': SimpleUploadedFile('partner.csv', CATALOG_CSV.encode()),
+            })
+            imports = CatalogImport.objects.filter(id=response.json()['id'])
+
+            import_id = response.json()['id']
+            imports = CatalogImport.objects.filter(id=import_id)
+
+            # Redelivered as soon as its worker died, while the heartbeat is fresh
+            imports.update(status=ImportStatusChoices.RUNNING, heartbeat_at=now() - timedelta(seconds=100))
+            with patch.object(import_catalog_file, 'retry', side_effect=Retry()) as retry, self.assertRaises(Retry):
+                import_catalog_file(import_id)
+            self.assertAlmostEqual(retry.call_args.kwargs['countdown'], 501, delta=5)
+            self.assertEqual(imports.get().status, ImportStatusChoices.RUNNING)
+
+            # The retry finds it stale and takes it over
+            imports.update(heartbeat_at=now() - timedelta(hours=1))
+            self.assertEqual(import_catalog_file(import_id), {'rows': 5, 'imported': 3, 'failed': 2})
+            self.assertEqual(import_catalog_file(import_id), 'Import already finished.')
+
+        catalog_import = imports.get()
+        self.assertEqual(catalog_import.status, ImportStatusChoices.COMPLETED)
+        self.assertGreater(catalog_import.heartbeat_at, now() - timedelta(minutes=1))
+
+    def test_upload_of_unknown_format(self):
+        response = self.client.post(reverse_lazy('api:catalogimport-list'), {
+            'file': SimpleUploadedFile('partner.xlsx', b'...'),
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(CatalogImport.objects.exists())
+
+
+class ExportTest(APITestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    loans_url = reverse_lazy('api:loan-export')
+    books_url = reverse_lazy('api:book-export')
+
+    def setUp(self):
+        self.member = create_test_member()
+
+    def returned_loans(self, count, loan_date=None):
+        loans = Loan.objects.bulk_create([
+            Loan(member=self.member, book_id=i % 3 + 1, is_returned=True) for i in range(count)
+        ])
+        if loan_date:
+            Loan.objects.filter(id__in=[loan.id for loan in loans]).update(loan_date=loan_date)
+        return loans
+
+    def test_loan_csv_export_filters_by_date_and_genre(self):
+        old = self.returned_loans(2, loan_date=now().date() - timedelta(days=60))
+        recent = self.returned_loans(3)
+        Book.objects.filter(id=3).update(genre='fiction')
+
+        response = self.client.get(self.loans_url, {
+            'from': (now().date() - timedelta(days=7)).isoformat(), 'genre': 'dev'
+        }, HTTP_ACCEPT='text/csv')
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0][:3], ['id', 'book_id', 'book__title'])
+        self.assertEqual([int(row[0]) for row in rows[1:]], [loan.id for loan in recent if loan.book_id != 3])
+        self.assertNotIn(old[0].id, [int(row[0]) for row in rows[1:]])
+
+    def test_book_ndjson_export_gzipped(self):
+        response = self.client.get(self.books_url, {'file_format': 'ndjson'}, HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        books = [json.loads(line) for line in gzip.decompress(b''.join(response.streaming_content)).splitlines()]
+        self.assertEqual([book['isbn'] for book in books], list(Book.objects.order_by('id').values_list('isbn', flat=True)))
+        self.assertEqual(books[0]['author__last_name'], 'Author 1')
+
+    def test_export_rejects_bad_filters(self):
+        for params in ({'from': 'yesterday'}, {'genre': 'poetry'}, {'file_format': 'xlsx'}):
+            response = self.client.get(self.loans_url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+
+    @override_settings(EXPORT_CHUNK_SIZE=500)
+    def test_export_memory_does_not_grow_with_rows(self):
+        def peak_memory():
+            response = self.client.get(self.loans_url)
+            tracemalloc.start()
+            try:
+                rows = sum(chunk.count(b'\n') for chunk in response.streaming_content)
+                return rows, tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        self.returned_loans(1000)
+        few_rows, few_peak = peak_memory()
+        self.returned_loans(9000)
+        many_rows, many_peak = peak_memory()
+
+        self.assertEqual((few_rows, many_rows), (1001, 10001))
+        # Ten times the rows, about the same peak: one chunk is held at a time
+        self.assertLess(many_peak, few_peak * 2)
+
+
+class ValuesRepresentationTest(APITestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    def setUp(self):
+        cache.clear()
+        member = create_test_member()
+        other = create_test_member(username='other', email='other@example.com')
+        for book_id in (1, 2):
+            checkout_book(book_id=book_id, member_id=member.id)
+        checkout_book(book_id=3, member_id=other.id)
+        return_book(book_id=2, member_id=member.id)
+
+    def test_list_json_is_identical_to_the_serializers(self):
+        endpoints = (
+            ('api:book-list', BookSerializer, Book.objects.order_by('title', 'id')),
+            ('api:loan-list', LoanSerializer, Loan.objects.order_by('-loan_date', 'id')),
+            ('api:member-list', MemberSerializer, Member.objects.order_by('id')),
+        )
+        for url, serializer_class, queryset in endpoints:
+            response = self.client.get(reverse_lazy(url))
+            expected = serializer_class(queryset, many=True).data
+
+            self.assertTrue(response.data['results'])
+            self.assertEqual(JSONRenderer().render(response.data['results']), JSONRenderer().render(expected), url)
+
+    def test_list_builds_no_serializer_per_row(self):
+        with patch.object(LoanSerializer, 'to_representation') as to_representation:
+            response = self.client.get(reverse_lazy('api:loan-list'))
+
+        self.assertEqual(len(response.json()['results']), 3)
+        to_representation.assert_not_called()
+
+    def test_uncompilable_serializers_are_refused(self):
+        class TitleSerializer(BookSerializer):
+            shout = serializers.SerializerMethodField()
+
+            class Meta(BookSerializer.Meta):
+                fields = ['id', 'shout']
+
+            def get_shout(self, book):
+                return book.title.upper()
+
+        self.assertIsNone(ValuesRepresentation.compile(TitleSerializer))
+
+
+class SparseFieldsetTest(APITestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    def setUp(self):
+        cache.clear()
+        self.member = create_test_member()
+        checkout_book(book_id=1, member_id=self.member.id)
+        self.loan = Loan.objects.get(book_id=1, member=self.member)
+
+    def get_sql(self, queries, table):
+        # The rows read, past the conditional GET validators
+        return [query['sql'] for query in queries if f'FROM "{table}"' in query['sql'] and 'MAX(' not in query['sql']][-1]
+
+    def test_list_reads_only_the_selected_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse_lazy('api:book-list'), {'fields': 'id,title,available_copies'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()['results']), Book.objects.count())
+        for book in response.json()['results']:
+            self.assertEqual(set(book), {'id', 'title', 'available_copies'})
+
+        sql = self.get_sql(queries, 'library_book')
+        self.assertIn('"library_book"."available_copies"', sql)
+        self.assertNotIn('"library_book"."isbn"', sql)
+        self.assertNotIn('JOIN', sql)
+
+    def test_detail_joins_only_the_expanded_relations(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse_lazy('api:loan-detail', kwargs={'pk': self.loan.id}), {'fields': 'id,book.title,member'}
+            )
+
+        self.assertEqual(response.json(), {
+            'id': self.loan.id, 'book': {'title': 'Programing with Python'}, 'member': self.member.id,
+        })
+
+        sql = self.get_sql(queries, 'library_loan')
+        self.assertIn('JOIN "library_book"', sql)
+        for table in ('library_author', 'library_member', 'auth_user'):
+            self.assertNotIn(f'JOIN "{table}"', sql)
+        self.assertNotIn('"library_book"."isbn"', sql)
+        self.assertNotIn('"library_loan"."return_date"', sql)
+
+    def test_expand_nests_the_named_relations_only(self):
+        response = self.client.get(reverse_lazy('api:loan-list'), {'expand': 'book'})
+
+        loan = response.json()['results'][0]
+        full = LoanSerializer(self.loan).data
+        self.assertEqual(set(loan), set(full))
+        self.assertEqual(loan['member'], self.member.id)
+        self.assertEqual(loan['book']['title'], full['book']['title'])
+        self.assertEqual(loan['book']['author'], self.loan.book.author_id)
+
+    def test_list_and_detail_render_fieldsets_alike(self):
+        params = {'fields': 'id,loan_date,book.author.last_name,member.user', 'expand': 'member.user'}
+        listed = self.client.get(reverse_lazy('api:loan-list'), params).json()['results'][0]
+        detail = self.client.get(reverse_lazy('api:loan-detail', kwargs={'pk': self.loan.id}), params).json()
+
+        self.assertEqual(listed, detail)
+        self.assertEqual(detail['book'], {'author': {'last_name': 'Author 1'}})
+        self.assertEqual(set(detail['member']), {'user'})
+        self.assertEqual(detail['member']['user']['username'], self.member.user.username)
+
+    def test_unknown_fields_are_refused(self):
+        cases = (
+            ('api:loan-list', {'fields': 'id,book.nope'}, 'Unknown field "book.nope".'),
+            ('api:loan-list', {'fields': 'book_id'}, 'Unknown field "book_id".'),
+            ('api:book-list', {'expand': 'title'}, '"title" cannot be expanded.'),
+        )
+        for url, params, error in cases:
+            response = self.client.get(reverse_lazy(url), params)
+
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.json(), {'error': [error]})
+
+
+class AsyncViewTest(TestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    def setUp(self):
+        cache.clear()
+        self.member = create_test_member()
+        checkout_book(book_id=1, member_id=self.member.id)
+        self.loan = Loan.objects.get(book_id=1, member=self.member)
+
+    async def test_book_detail_matches_the_viewset(self):
+        response = await self.async_client.get(reverse_lazy('api:async-book-detail', kwargs={'pk': 1}))
+        expected = await sync_to_async(self.client.get)(reverse_lazy('api:book-detail', kwargs={'pk': 1}))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), expected.json())
+        # Counted by the metrics middleware without leaving the async stack
+        self.assertEqual(response['X-DB-Queries'], '1')
+
+        missing = await self.async_client.get(reverse_lazy('api:async-book-detail', kwargs={'pk': 999}))
+        self.assertEqual(missing.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_book_availability(self):
+        response = await self.async_client.get(reverse_lazy('api:async-book-availability', kwargs={'pk': 1}))
+
+        self.assertEqual(response.json(), {
+            'book_id': 1,
+            'available_copies': 4,
+            'is_available': True,
+            'on_loan': 1,
+            'next_due_date': self.loan.due_date.isoformat(),
+        })
+        self.assertEqual(response['X-DB-Queries'], '2')
+
+    async def test_top_active_members_match_the_viewset(self):
+        url = reverse_lazy('api:async-member-top-active')
+        response = await self.async_client.get(url, {'number': 3})
+        expected = await sync_to_async(self.client.get)(reverse_lazy('api:member-top-active'), {'number': 3})
+
+        self.assertEqual(response.json(), expected.json())
+        self.assertEqual(response.json()[0]['active_loans'], 1)
+
+        invalid = await self.async_client.get(url, {'number': 'many'})
+        self.assertEqual(invalid.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_writes_are_not_allowed(self):
+        response = await self.async_client.post(reverse_lazy('api:async-book-detail', kwargs={'pk': 1}))
+
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    async def test_asgi_deployment_routes_async_endpoints_only(self):
+        book_url, export_url = reverse('api:async-book-detail', kwargs={'pk': 1}), reverse('api:book-export')
+
+        with override_settings(ROOT_URLCONF='library_system.urls_asgi'):
+            self.assertEqual(reverse('api:async-book-detail', kwargs={'pk': 1}), book_url)
+            response = await self.async_client.get(book_url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            # Streamed exports would be buffered in full under ASGI
+            response = await self.async_client.get(export_url)
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class CirculationTest(TestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    def test_checkout_notifies_through_outbox(self):
+        member = create_test_member()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            loan = checkout_book(book_id=1, member_id=member.id)
+
+        # Recorded with the loan; nothing reaches the broker until relayed
+        event = OutboxEvent.objects.get()
+        self.assertEqual((event.topic, event.payload), ('loans.checked_out', {'member_id': member.id, 'loan_ids': [loan.id]}))
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(relay_outbox_events(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_rejected_checkout_leaves_no_event(self):
+        member = create_test_member()
+        Book.objects.filter(id=1).update(available_copies=0)
+
+        with self.assertRaises(ValidationError):
+            checkout_book(book_id=1, member_id=member.id)
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    @override_settings(OUTBOX_RETRY_SECONDS=0)
+    def test_relay_keeps_failed_events(self):
+        member = create_test_member()
+        loan = checkout_book(book_id=1, member_id=member.id)
+        unknown = publish('unknown.topic')
+        checkout_book(book_id=2, member_id=member.id)
+
+        self.assertEqual(relay_outbox_events(), 2)
+
+        unknown.refresh_from_db()
+        self.assertEqual(unknown.attempts, 1)
+        self.assertIn('unknown.topic', unknown.last_error)
+        self.assertEqual(len(mail.outbox), 2)
+
+        # A broker outage stops the batch and keeps the events in order
+        pending = publish('loans.checked_out', member_id=member.id, loan_ids=[loan.id])
+        with patch.object(send_loan_notification, 'delay', side_effect=KombuOperationalError('down')):
+            self.assertEqual(relay_outbox_events(), 0)
+        self.assertEqual(
+            list(OutboxEvent.objects.values_list('id', 'attempts')), [(unknown.id, 2), (pending.id, 1)]
+        )
+
+        call_command('relay_outbox', '--once', stdout=StringIO())
+        self.assertEqual(OutboxEvent.objects.get().id, unknown.id)
+        self.assertEqual(len(mail.outbox), 3)
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2)
+    def test_failing_events_back_off_and_die(self):
+        member = create_test_member()
+        poisoned = [publish('unknown.topic') for _ in range(3)]
+        checkout_book(book_id=1, member_id=member.id)
+
+        # The failing head of the outbox does not hold up the event behind it
+        self.assertEqual(relay_outbox_events(batch_size=2), 0)
+        self.assertEqual(relay_outbox_events(batch_size=2), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(relay_outbox_events(batch_size=2), 0)
+        self.assertEqual(
+            list(OutboxEvent.objects.values_list('attempts', 'status')), [(1, OutboxStatusChoices.PENDING)] * 3
+        )
+
+        OutboxEvent.objects.update(next_attempt_at=now())
+        self.assertEqual(relay_outbox_events(), 0)
+        self.assertEqual(
+            list(OutboxEvent.objects.values_list('id', 'attempts', 'status')),
+            [(event.id, 2, OutboxStatusChoices.DEAD) for event in poisoned],
+        )
+
+        OutboxEvent.objects.update(next_attempt_at=None)
+        self.assertEqual(relay_outbox_events(), 0)
+        self.assertFalse(OutboxEvent.objects.exclude(attempts=2).exists())
+
+    def test_checkout_unknown_member(self):
+        with self.assertRaises(ValidationError):
+            checkout_book(book_id=1, member_id=999)
+
+        self.assertEqual(Book.objects.get(id=1).available_copies, 5)
+
+    def test_checkout_last_copy(self):
+        member = create_test_member()
+        Book.objects.filter(id=1).update(available_copies=1)
+
+        checkout_book(book_id=1, member_id=member.id)
+
+        with self.assertRaises(ValidationError):
+            checkout_book(book_id=1, member_id=member.id)
+
+        self.assertEqual(Book.objects.get(id=1).available_copies, 0)
+        self.assertEqual(Loan.objects.count(), 1)
+
+    def test_checkout_same_book_twice(self):
+        member = create_test_member()
+        checkout_book(book_id=1, member_id=member.id)
+
+        with self.assertRaises(ValidationError):
+            checkout_book(book_id=1, member_id=member.id)
+
+        # The rejected checkout does not consume a copy
+        self.assertEqual(Book.objects.get(id=1).available_copies, 4)
+
+        return_book(book_id=1, member_id=member.id)
+        checkout_book(book_id=1, member_id=member.id)
+        self.assertEqual(member.loans.count(), 2)
+
+    def test_return_without_loan(self):
+        member = create_test_member()
+
+        with self.assertRaises(ValidationError):
+            return_book(book_id=1, member_id=member.id)
+
+        self.assertEqual(Book.objects.get(id=1).available_copies, 5)
+
+
+class CheckoutConcurrencyTest(TransactionTestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    copies = 10
+    workers = 8
+    attempts_per_worker = 5
+
+    def _hammer(self, member_ids, results, barrier):
+        barrier.wait()
+        try:
+            for member_id in member_ids:
+                while True:
+                    try:
+                        checkout_book(book_id=1, member_id=member_id)
+                        results.append('loaned')
+                    except ValidationError:
+                        results.append('rejected')
+                    except OperationalError:
+                        # SQLite serializes writers; contention is not a failure
+                        continue
+                    break
+        finally:
+            connection.close()
+
+    def test_concurrent_checkout_never_oversells(self):
+        Book.objects.filter(id=1).update(available_copies=self.copies)
+        users = User.objects.bulk_create([
+            User(username=f'member{i}', email=f'member{i}@example.com')
+            for i in range(self.workers * self.attempts_per_worker)
+        ])
+        members = Member.objects.bulk_create([Member(user=user) for user in users])
+
+        results = []
+        barrier = threading.Barrier(self.workers)
+        threads = [
+            threading.Thread(
+                target=self._hammer,
+                args=([m.id for m in members[i::self.workers]], results, barrier)
+            )
+            for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count('loaned'), self.copies)
+        self.assertEqual(len(results), len(members))
+        self.assertEqual(Book.objects.get(id=1).available_copies, 0)
+        self.assertEqual(Loan.objects.filter(book_id=1).count(), self.copies)
+
+
+class QueryPlanSamplingTest(APITestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    base_url = reverse_lazy('api:book-list')
+
+    def setUp(self):
+        # A cached response runs no query to explain
+        cache.clear()
+
+    def test_book_list_does_not_explain_by_default(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.base_url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(any('EXPLAIN' in query['sql'] for query in queries))
+
+    @override_settings(QUERY_PLAN_SAMPLE_RATE=1, QUERY_PLAN_SLOW_MS=0)
+    def test_sampled_request_logs_query_plans(self):
+        with self.assertLogs('library.query_plans', level='INFO') as logs:
+            self.client.get(self.base_url)
+
+        # Slowest first, and the conditional GET validators may take longest
+        entries = [json.loads(record.getMessage()) for record in logs.records]
+        entry = next(entry for entry in entries if 'FROM "library_book"' in entry['sql'] and 'MAX(' not in entry['sql'])
+        self.assertEqual(entry['view'], 'api:book-list')
+        self.assertTrue(entry['plan'])
+
+    @override_settings(QUERY_PLAN_SAMPLE_RATE=1, QUERY_PLAN_SLOW_MS=0)
+    def test_failed_explain_does_not_fail_the_request(self):
+        with patch.object(connection.ops, 'explain_query_prefix', return_value='EXPLAIN NONSENSE'), \
+                self.assertLogs('library.query_plans', level='INFO') as logs:
+            response = self.client.get(self.base_url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        plans = [json.loads(record.getMessage()) for record in logs.records if record.levelname == 'INFO']
+        self.assertTrue(plans)
+        self.assertTrue(all(plan['plan'] is None for plan in plans))
+
+    @override_settings(QUERY_PLAN_SAMPLE_RATE=1, QUERY_PLAN_SLOW_MS=60_000)
+    def test_fast_queries_are_not_explained(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.base_url)
+
+        self.assertFalse(any('EXPLAIN' in query['sql'] for query in queries))
+
+
+class QueryMetricsTest(APITestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+
+    def test_query_headers(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse_lazy('api:book-list'))
+
+        self.assertEqual(response['X-DB-Queries'], str(len(queries)))
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn(f'desc="{len(queries)} queries"', response['Server-Timing'])
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse_lazy('api:book-list'))
+        self.client.get(reverse_lazy('api:book-list'))
+
+        response = self.client.get(reverse_lazy('api:metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+        body = response.content.decode()
+        self.assertIn('# TYPE library_request_db_queries summary', body)
+        self.assertIn('library_request_db_queries_count{method="GET",view="api:book-list"} 2', body)
+        self.assertIn('library_request_duration_ms{method="GET",view="api:book-list",quantile="0.99"}', body)
+
+    def test_registry_quantiles(self):
+        for value in range(1, 101):
+            registry.observe('sample', value, {'view': 'x'})
+        registry.inc('hits', amount=3)
+
+        body = registry.render()
+        self.assertIn('sample{view="x",quantile="0.5"} 51', body)
+        self.assertIn('sample{view="x",quantile="0.99"} 100', body)
+        self.assertIn('sample_sum{view="x"} 5050', body)
+        self.assertIn('hits 3', body)
+
+
+class NotificationDispatchTest(TestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_token_bucket(self):
+        bucket = TokenBucket('test', rate=10, capacity=2)
+
+        self.assertEqual(bucket.take(), 0)
+        self.assertEqual(bucket.take(), 0)
+        self.assertAlmostEqual(bucket.take(), 0.1, delta=0.02)
+
+    def test_token_bucket_reserve(self):
+        bucket = TokenBucket('test', rate=1, capacity=2)
+
+        self.assertEqual(bucket.take(reserve=1), 0)
+        # The last token is kept for callers without a reserve
+        self.assertGreater(bucket.take(reserve=1), 0)
+        self.assertEqual(bucket.take(), 0)
+
+    @override_settings(NOTIFICATION_RATE_LIMIT=20, NOTIFICATION_RATE_BURST=1)
+    def test_send_messages_is_rate_limited(self):
+        messages = [build_message('Subject', 'Body', f'member{i}@example.com') for i in range(3)]
+
+        started = time.perf_counter()
+        self.assertEqual(send_messages(messages, priority=LOW), 3)
+        elapsed = time.perf_counter() - started
+
+        # One token up front, the other two at 20 per second
+        self.assertGreaterEqual(elapsed, 0.09)
+        self.assertEqual(len(mail.outbox), 3)
+        stats = {(name, labels['priority']): value for name, _, _, labels, value in collect_metrics()}
+        self.assertEqual(stats[('library_notification_sent_total', LOW)], 3)
+        self.assertGreater(stats[('library_notification_throttled_ms_total', LOW)], 0)
+        self.assertEqual(stats[('library_notification_sent_total', HIGH)], 0)
+
+    def test_confirmations_are_routed_to_their_own_queue(self):
+        router = current_app.amqp.router
+
+        self.assertEqual(router.route({}, 'library.tasks.send_loan_notification')['queue'].name, QUEUES[HIGH])
+        self.assertEqual(router.route({}, 'library.tasks.send_bulk_loan_notification')['queue'].name, QUEUES[HIGH])
+        self.assertEqual(
+            router.route({}, 'library.tasks.send_batch_overdue_notification')['queue'].name, QUEUES[LOW]
+        )
+
+    @override_settings(NOTIFICATION_COALESCE_SECONDS=30)
+    def test_loan_confirmations_are_coalesced(self):
+        member = create_test_member()
+
+        with patch.object(send_loan_digest, 'apply_async') as schedule:
+            for book_id in (1, 2):
+                with self.captureOnCommitCallbacks(execute=True):
+                    checkout_book(book_id=book_id, member_id=member.id)
+            with self.captureOnCommitCallbacks(execute=True):
+                bulk_checkout(member.id, [3])
+            relay_outbox_events()
+
+        # The first loan of the window schedules the only flush
+        schedule.assert_called_once_with((member.id,), countdown=30)
+        self.assertEqual(len(mail.outbox), 0)
+
+        with self.assertNumQueries(1):
+            send_loan_digest(member.id)
+
+        self.assertEqual(len(mail.outbox), 1)
+        for title in Book.objects.filter(id__in=[1, 2, 3]).values_list('title', flat=True):
+            self.assertIn(title, mail.outbox[0].body)
+
+        # Drained, so a late duplicate flush sends nothing
+        send_loan_digest(member.id)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_metrics_endpoint_reports_notifications(self):
+        member = create_test_member()
+        checkout_book(book_id=1, member_id=member.id)
+        relay_outbox_events()
+
+        response = self.client.get(reverse_lazy('api:metrics'))
+
+        self.assertIn('# TYPE library_notification_sent_total counter', response.content.decode())
+        self.assertIn('library_notification_sent_total{priority="high"} 1', response.content.decode())
+
 
 class OperationsTest(TestCase):
     fixtures = ['books.json', 'authors.json']
@@ -130,6 +1117,111 @@ class OperationsTest(TestCase):
 class OverdueTaskTest(TestCase):
     fixtures = ['books.json', 'authors.json']
 
+    def test_overdue_digests_single_query(self):
+        today = now()
+        members = [
+            create_test_member(username=f'member{i}', email=f'member{i}@example.com', first_name=f'Name{i}')
+            for i in range(3)
+        ]
+        for member in members:
+            for book_id in (1, 2):
+                Loan.objects.create(member=member, book_id=book_id, loan_date=today - timedelta(days=15))
+        # Not overdue yet, and overdue but returned
+        Loan.objects.create(member=members[0], book_id=3, loan_date=today)
+        Loan.objects.create(
+            member=members[1], book_id=3, loan_date=today - timedelta(days=15), is_returned=True
+        )
+
+        with self.assertNumQueries(1):
+            digests = list(iter_overdue_member_digests())
+
+        self.assertEqual([digest['id'] for digest in digests], [member.id for member in members])
+        self.assertEqual(digests[0]['name'], 'Name0')
+        self.assertEqual(digests[0]['email'], 'member0@example.com')
+        self.assertEqual(sorted(digests[0]['titles']), ['Django Cook Book', 'Programing with Python'])
+
+    def test_batch_notification_uses_digest_titles(self):
+        member = create_test_member()
+        digest = {'id': member.id, 'name': 'test', 'email': 'test@example.com', 'titles': ['Some Title']}
+
+        with CaptureQueriesContext(connection) as queries:
+            send_batch_overdue_notification([digest])
+
+        # Only the reminder claim, no title lookups
+        self.assertFalse([query for query in queries if 'library_loan' in query['sql']])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('Some Title', mail.outbox[0].body)
+
+    def test_batch_notification_is_idempotent(self):
+        member = create_test_member()
+        digest = {'id': member.id, 'name': 'test', 'email': 'test@example.com', 'titles': ['Some Title']}
+
+        self.assertEqual(send_batch_overdue_notification([digest]), 1)
+        self.assertEqual(send_batch_overdue_notification([digest]), 0)
+
+        self.assertEqual(len(mail.outbox), 1)
+        member.refresh_from_db()
+        self.assertEqual(member.last_overdue_reminder_on, now().date())
+
+    @override_settings(EMAIL_BACKEND='library.tests.FailingEmailBackend')
+    def test_failed_send_releases_claim(self):
+        yesterday = now().date() - timedelta(days=1)
+        member = create_test_member()
+        Member.objects.filter(id=member.id).update(last_overdue_reminder_on=yesterday)
+        digest = {'id': member.id, 'name': 'test', 'email': 'test@example.com', 'titles': ['Some Title']}
+
+        with self.assertRaises(SMTPException):
+            send_batch_overdue_notification([digest])
+
+        member.refresh_from_db()
+        self.assertEqual(member.last_overdue_reminder_on, yesterday)
+
+    def test_failure_partway_releases_unsent_claims_only(self):
+        members = [create_test_member(username=f'm{i}', email=f'm{i}@example.com') for i in range(3)]
+        digests = [
+            {'id': member.id, 'name': f'Name{i}', 'email': email, 'titles': ['Some Title']}
+            for i, (member, email) in enumerate(
+                zip(members, ['m0@example.com', FailingOnRecipientEmailBackend.failing, 'm2@example.com'])
+            )
+        ]
+
+        with override_settings(EMAIL_BACKEND='library.tests.FailingOnRecipientEmailBackend'), \
+                self.assertRaises(SMTPException):
+            send_batch_overdue_notification(digests)
+
+        self.assertEqual([message.to for message in mail.outbox], [['m0@example.com']])
+        self.assertEqual(
+            list(Member.objects.filter(id__in=[member.id for member in members]).order_by('id')
+                 .values_list('last_overdue_reminder_on', flat=True)),
+            [now().date(), None, None],
+        )
+
+        # The retry reminds the members left, and not the one already reminded
+        digests[1]['email'] = 'm1@example.com'
+        self.assertEqual(send_batch_overdue_notification(digests), 2)
+        self.assertEqual(len(mail.outbox), 3)
+
+    @override_settings(
+        EMAIL_BACKEND='library.tests.CountingEmailBackend',
+        NOTIFICATION_MAX_MESSAGES_PER_CONNECTION=2,
+    )
+    def test_batch_notification_pools_connections(self):
+        CountingEmailBackend.opened = 0
+        digests = [
+            {'id': member.id, 'name': f'Name{i}', 'email': f'member{i}@example.com', 'titles': ['Some Title']}
+            for i, member in enumerate(
+                (create_test_member(username=f'member{i}') for i in range(1, 6)), start=1
+            )
+        ]
+
+        sent = send_batch_overdue_notification(digests)
+
+        self.assertEqual(sent, 5)
+        self.assertEqual(len(mail.outbox), 5)
+        # Five messages at two per connection
+        self.assertEqual(CountingEmailBackend.opened, 3)
+        self.assertEqual(mail.outbox[4].to, ['member5@example.com'])
+
     def test_check_overdue_loans_task(self):
         today = now()
         member = create_test_member()
@@ -146,6 +1238,168 @@ class OverdueTaskTest(TestCase):
         # Verify task was queued or executed
         self.assertEqual(len(mail.outbox), 1)
 
+    def test_sweep_resumes_from_checkpoint(self):
+        members = [create_test_member(username=f'member{i}', email=f'member{i}@example.com') for i in range(3)]
+        for member in members:
+            Loan.objects.create(member=member, book_id=1, loan_date=now() - timedelta(days=15))
+        # A run whose only shard died after handling the first member
+        run = OverdueSweepRun.objects.create(run_date=now().date())
+        OverdueSweepShard.objects.create(
+            run=run, lower_member_id=0, upper_member_id=members[2].id,
+            last_member_id=members[0].id, members=1, reminders_sent=1
+        )
+
+        check_overdue_loans()
+
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), ['member1@example.com', 'member2@example.com'])
+        run.refresh_from_db()
+        self.assertEqual(run.status, SweepStatusChoices.COMPLETED)
+        self.assertEqual((run.members, run.reminders_sent, run.reminders_failed), (3, 3, 0))
+
+        self.assertEqual(check_overdue_loans(), 'Sweep already completed.')
+        self.assertEqual(len(mail.outbox), 2)
+
+    @override_settings(OVERDUE_SWEEP_SHARDS=3, OVERDUE_SWEEP_BATCH_SIZE=2)
+    def test_sweep_fans_out_over_shards(self):
+        members = [create_test_member(username=f'member{i}', email=f'member{i}@example.com') for i in range(7)]
+        for member in members:
+            Loan.objects.create(member=member, book_id=1, loan_date=now() - timedelta(days=15))
+
+        self.assertEqual(check_overdue_loans(), 'Queued 3 shard(s).')
+
+        self.assertEqual(len(mail.outbox), 7)
+        run = OverdueSweepRun.objects.get(run_date=now().date())
+        shards = list(run.shards.all())
+        # Ranges cover every member exactly once
+        self.assertEqual(shards[0].lower_member_id, members[0].id - 1)
+        self.assertEqual(shards[-1].upper_member_id, members[-1].id)
+        for shard, following in zip(shards, shards[1:]):
+            self.assertEqual(shard.upper_member_id, following.lower_member_id)
+        self.assertTrue(all(shard.status == SweepStatusChoices.COMPLETED for shard in shards))
+        self.assertEqual(sum(shard.members for shard in shards), 7)
+        self.assertEqual((run.status, run.members, run.reminders_sent), (SweepStatusChoices.COMPLETED, 7, 7))
+
+    def test_failed_sweep_batch_is_retried(self):
+        member = create_test_member()
+        Loan.objects.create(member=member, book_id=1, loan_date=now() - timedelta(days=15))
+        run = OverdueSweepRun.objects.create(run_date=now().date())
+        shard_ids = plan_overdue_sweep_shards(run, shard_count=4)
+
+        with override_settings(EMAIL_BACKEND='library.tests.FailingEmailBackend'):
+            results = [sweep_overdue_shard(shard_id) for shard_id in shard_ids]
+            summary = summarize_overdue_sweep(results, run.id)
+
+        self.assertEqual(summary['shards'], 1)
+        self.assertEqual((summary['members'], summary['sent'], summary['failed']), (0, 0, 1))
+        self.assertEqual((summary['status'], summary['incomplete_shards']), (SweepStatusChoices.RUNNING, 1))
+        member.refresh_from_db()
+        self.assertIsNone(member.last_overdue_reminder_on)
+
+        # The next hourly trigger picks the batch up again
+        check_overdue_loans()
+
+        self.assertEqual(len(mail.outbox), 1)
+        run.refresh_from_db()
+        self.assertEqual(run.status, SweepStatusChoices.COMPLETED)
+        self.assertEqual((run.members, run.reminders_sent, run.reminders_failed), (1, 1, 0))
+        # Logged and returned as a plain string, as for a running sweep
+        self.assertIs(type(summarize_overdue_sweep([], run.id)['status']), str)
+
+    def test_running_shard_is_not_run_twice(self):
+        member = create_test_member()
+        Loan.objects.create(member=member, book_id=1, loan_date=now() - timedelta(days=15))
+        run = OverdueSweepRun.objects.create(run_date=now().date())
+        shard_id, = plan_overdue_sweep_shards(run, shard_count=1)
+
+        with CacheLock(f'overdue_sweep_shard:{shard_id}', heartbeat=0):
+            self.assertEqual(sweep_overdue_shard(shard_id), {'shard': shard_id, 'skipped': True})
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_sweep_skips_members_reminded_today(self):
+        member = create_test_member()
+        Loan.objects.create(member=member, book_id=1, loan_date=now() - timedelta(days=15))
+        Member.objects.filter(id=member.id).update(last_overdue_reminder_on=now().date())
+
+        self.assertEqual(list(iter_overdue_member_digests()), [])
+
+
+class CacheLockTest(TestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_lock_is_exclusive(self):
+        first = CacheLock('test', heartbeat=0)
+        second = CacheLock('test', heartbeat=0)
+
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        with self.assertRaises(LockNotAcquired):
+            with second:
+                pass
+
+        self.assertTrue(first.release())
+        self.assertTrue(second.acquire())
+        second.release()
+
+    def test_release_after_expiry_keeps_new_owner(self):
+        first = CacheLock('test', timeout=0.05, heartbeat=0)
+        second = CacheLock('test', heartbeat=0)
+        first.acquire()
+        time.sleep(0.1)
+
+        self.assertTrue(second.acquire())
+        self.assertFalse(first.release())
+        self.assertFalse(CacheLock('test').acquire())
+        second.release()
+
+    def test_heartbeat_keeps_lock_past_timeout(self):
+        with CacheLock('test', timeout=0.2, heartbeat=0.05) as lock:
+            time.sleep(0.5)
+            self.assertFalse(CacheLock('test', heartbeat=0).acquire())
+            self.assertFalse(lock.lost)
+
+        self.assertTrue(CacheLock('test', heartbeat=0).acquire())
+
+    def test_single_instance_concurrent_workers(self):
+        workers = 8
+        barrier = threading.Barrier(workers)
+        runs = []
+        results = []
+
+        @single_instance('test-task')
+        def task():
+            runs.append(1)
+            time.sleep(0.2)
+            return 'done'
+
+        def worker():
+            barrier.wait()
+            results.append(task())
+
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(sorted(results), ['Task is running.'] * (workers - 1) + ['done'])
+        # Released once the run finished
+        self.assertEqual(task(), 'done')
+
+    def test_check_overdue_loans_skips_while_locked(self):
+        member = create_test_member()
+        Loan.objects.create(member=member, book_id=1, loan_date=now() - timedelta(days=15))
+
+        with CacheLock('overdue_loans_task', heartbeat=0):
+            self.assertEqual(check_overdue_loans(), 'Task is running.')
+        self.assertEqual(len(mail.outbox), 0)
+
+        check_overdue_loans()
+        self.assertEqual(len(mail.outbox), 1)
+
 
 class LoanApiTest(APITestCase):
     fixtures = ['books.json', 'authors.json']
@@ -163,6 +1417,65 @@ class LoanApiTest(APITestCase):
         self.assertEqual(json['member']['id'], 1)
         self.assertEqual(json['book']['id'], 1)
 
+        member.refresh_from_db()
+        self.assertEqual(member.active_loan_count, 1)
+
+    def test_loan_create_duplicate_active_loan(self):
+        member = create_test_member()
+        loan_data = {'member_id': member.id, 'book_id': 1}
+        self.client.post(self.base_url, data=loan_data)
+
+        response = self.client.post(self.base_url, data=loan_data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(member.loans.count(), 1)
+
+    def test_loan_list_query_count_is_constant(self):
+        member = create_test_member()
+        Loan.objects.bulk_create([Loan(member=member, book_id=book_id) for book_id in (1, 2)])
+
+        with CaptureQueriesContext(connection) as few:
+            response = self.client.get(self.base_url)
+        self.assertEqual(len(response.json()['results']), 2)
+
+        other = create_test_member(username='other', email='other@example.com')
+        Loan.objects.bulk_create([Loan(member=other, book_id=book_id) for book_id in (1, 2, 3)])
+        Loan.objects.bulk_create([
+            Loan(member=other, book_id=book_id, is_returned=True) for book_id in (2, 3) for _ in range(10)
+        ])
+
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(self.base_url)
+        self.assertEqual(len(response.json()['results']), 25)
+
+        # One MAX(updated_at) per rendered table for the ETag, then one
+        # joined SELECT for the page, no COUNT
+        self.assertEqual(len(few), 5)
+        self.assertEqual(len(many), 5)
+
+    def test_loan_list_keyset_order(self):
+        member = create_test_member()
+        today = now().date()
+        loans = Loan.objects.bulk_create([Loan(member=member, book_id=1, is_returned=True) for _ in range(5)])
+        Loan.objects.filter(id__in=[loans[1].id, loans[3].id]).update(loan_date=today - timedelta(days=3))
+
+        seen = []
+        url = self.base_url + '?page_size=2'
+        while url:
+            json = self.client.get(url).json()
+            seen.extend(loan['id'] for loan in json['results'])
+            url = json['next']
+
+        expected = [loans[i].id for i in (0, 2, 4, 1, 3)]
+        self.assertEqual(seen, expected)
+
+    def test_loan_serializer_eager_loading_paths(self):
+        select_related, prefetch_related = LoanSerializer.get_eager_loading_paths()
+        self.assertEqual(
+            sorted(select_related),
+            ['book', 'book__author', 'member', 'member__user']
+        )
+        self.assertEqual(prefetch_related, [])
+
     def test_loan_extend(self):
 
         member = create_test_member()
@@ -222,38 +1535,132 @@ class LoanApiTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
 
+class BulkCirculationApiTest(APITestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    checkout_url = reverse_lazy('api:loan-list') + 'bulk-checkout/'
+    return_url = reverse_lazy('api:loan-list') + 'bulk-return/'
+
+    def test_bulk_checkout(self):
+        member = create_test_member()
+        Book.objects.filter(id=3).update(available_copies=0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                self.checkout_url,
+                data={'member_id': member.id, 'book_ids': [1, 2, 2, 3, 99]},
+                format='json'
+            )
+        relay_outbox_events()
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.json()['results']
+        self.assertEqual([r['status'] for r in results], ['loaned', 'loaned', 'failed', 'failed', 'failed'])
+        self.assertEqual(results[2]['error'], 'Duplicate book in request.')
+        self.assertEqual(results[3]['error'], 'No available copies.')
+        self.assertEqual(results[4]['error'], 'Book does not exist.')
+
+        self.assertEqual(Book.objects.get(id=1).available_copies, 4)
+        self.assertEqual(Book.objects.get(id=2).available_copies, 4)
+        self.assertEqual(member.loans.count(), 2)
+        self.assertTrue(all(loan.due_date for loan in member.loans.all()))
+
+        # One aggregated confirmation for the whole cart
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('Programing with Python', mail.outbox[0].body)
+        self.assertIn('Django Cook Book', mail.outbox[0].body)
+
+    def test_bulk_checkout_query_count_independent_of_cart_size(self):
+        member = create_test_member()
+
+        with CaptureQueriesContext(connection) as single:
+            self.client.post(self.checkout_url, data={'member_id': member.id, 'book_ids': [1]}, format='json')
+
+        with CaptureQueriesContext(connection) as cart:
+            self.client.post(self.checkout_url, data={'member_id': member.id, 'book_ids': [2, 3]}, format='json')
+
+        self.assertEqual(len(single), len(cart))
+
+    def test_bulk_checkout_already_loaned(self):
+        member = create_test_member()
+        checkout_book(book_id=1, member_id=member.id)
+
+        response = self.client.post(self.checkout_url, data={'member_id': member.id, 'book_ids': [1, 2]}, format='json')
+        results = response.json()['results']
+        self.assertEqual(results[0]['error'], 'Member already has an active loan for this book.')
+        self.assertEqual(results[1]['status'], 'loaned')
+        self.assertEqual(Book.objects.get(id=1).available_copies, 4)
+
+    def test_bulk_checkout_unknown_member(self):
+        response = self.client.post(self.checkout_url, data={'member_id': 99, 'book_ids': [1]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Loan.objects.exists())
+
+    def test_bulk_return(self):
+        member = create_test_member()
+        circulation_data = {'member_id': member.id, 'book_ids': [1, 2]}
+        self.client.post(self.checkout_url, data=circulation_data, format='json')
+
+        response = self.client.post(
+            self.return_url,
+            data={'member_id': member.id, 'book_ids': [1, 2, 3]},
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.json()['results']
+        self.assertEqual([r['status'] for r in results], ['returned', 'returned', 'failed'])
+        self.assertEqual(Book.objects.get(id=1).available_copies, 5)
+        self.assertEqual(Book.objects.get(id=2).available_copies, 5)
+        self.assertFalse(member.loans.filter(is_returned=False).exists())
+
+        response = self.client.post(self.return_url, data=circulation_data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
 class MemberAPITest(APITestCase):
     fixtures = ['books.json', 'authors.json']
 
     base_url = reverse_lazy('api:member-list')
 
+    def setUp(self):
+        cache.clear()
+
     def test_top_active_members(self):
 
         member1 = create_test_member()
         member2 = create_test_member(first_name='John', last_name='Doe', username='johndoe')
 
         today = now()
+        # A member can only hold one active loan per book
+        book_ids = [book.id for book in Book.objects.all()] + [
+            Book.objects.create(title=f'Extra {i}', author_id=1, isbn=f'extra-{i}').id
+            for i in range(2)
+        ]
+
         # Create 5 loans
         member2_loans = [
             Loan(
                 member=member2,
-                book_id=random.randint(1, 3),
+                book_id=book_id,
                 loan_date=today
             )
-            for _ in range(5)
+            for book_id in book_ids
         ]
 
         # Create 3 loans
         member1_loans = [
             Loan(
                 member=member1,
-                book_id=random.randint(1, 3),
+                book_id=book_id,
                 loan_date=today
             )
-            for _ in range(3)
+            for book_id in random.sample(book_ids, 3)
         ]
 
         Loan.objects.bulk_create(member1_loans + member2_loans)
+        # bulk_create bypasses circulation, so recount the active loans
+        reconcile_active_loan_counts()
 
         url = self.base_url + 'top-active/'
         response = self.client.get(url)
@@ -263,3 +1670,130 @@ class MemberAPITest(APITestCase):
         self.assertEqual(len(json), 2)
         # Check first result is member 2
         self.assertEqual(json[0]['id'], member2.id)
+        self.assertEqual(json[0]['active_loans'], 5)
+        self.assertEqual(json[1]['active_loans'], 3)
+
+    def test_top_active_members_query_count(self):
+        for i in range(10):
+            create_test_member(username=f'member{i}', email=f'member{i}@example.com')
+
+        # Served from the counter index with the user joined in
+        with self.assertNumQueries(1):
+            response = self.client.get(self.base_url + 'top-active/')
+        self.assertEqual(len(response.json()), 5)
+
+
+class LeaderboardCacheTest(TestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+
+    def lookups(self, result):
+        key = ('library_leaderboard_cache_total', (('result', result),))
+        return registry._counters.get(key, 0)
+
+    def test_hit_after_miss(self):
+        create_test_member()
+
+        leaderboard.get_top_active(number=5)
+        with self.assertNumQueries(0):
+            members = leaderboard.get_top_active(number=5)
+
+        self.assertEqual(len(members), 1)
+        self.assertEqual(self.lookups('miss'), 1)
+        self.assertEqual(self.lookups('hit'), 1)
+
+    def test_circulation_invalidates(self):
+        member = create_test_member()
+        self.assertEqual(leaderboard.get_top_active(number=5)[0]['active_loans'], 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            checkout_book(book_id=1, member_id=member.id)
+        self.assertEqual(leaderboard.get_top_active(number=5)[0]['active_loans'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            return_book(book_id=1, member_id=member.id)
+        self.assertEqual(leaderboard.get_top_active(number=5)[0]['active_loans'], 0)
+        self.assertEqual(self.lookups('miss'), 3)
+
+    def test_concurrent_rebuild_serves_stale(self):
+        member = create_test_member()
+        leaderboard.get_top_active(number=5)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            checkout_book(book_id=1, member_id=member.id)
+
+        # Another worker is rebuilding the entry
+        cache.add(leaderboard._lock_key(5), 1)
+        with self.assertNumQueries(0):
+            members = leaderboard.get_top_active(number=5)
+
+        self.assertEqual(members[0]['active_loans'], 0)
+        self.assertEqual(self.lookups('stale'), 1)
+
+    @override_settings(LEADERBOARD_REBUILD_WAIT=0)
+    def test_cold_cache_with_rebuild_in_progress(self):
+        create_test_member()
+        cache.add(leaderboard._lock_key(5), 1)
+
+        with self.assertNumQueries(1):
+            members = leaderboard.get_top_active(number=5)
+        self.assertEqual(len(members), 1)
+
+
+class ActiveLoanCountTest(TestCase):
+    fixtures = ['books.json', 'authors.json']
+
+    def test_circulation_keeps_counter_in_step(self):
+        member = create_test_member()
+
+        checkout_book(book_id=1, member_id=member.id)
+        bulk_checkout(member_id=member.id, book_ids=[2, 3])
+        member.refresh_from_db()
+        self.assertEqual(member.active_loan_count, 3)
+
+        return_book(book_id=1, member_id=member.id)
+        bulk_return(member_id=member.id, book_ids=[2, 99])
+        member.refresh_from_db()
+        self.assertEqual(member.active_loan_count, 1)
+
+    def test_return_of_loan_created_outside_circulation(self):
+        member = create_test_member()
+        Loan.objects.create(member=member, book_id=1)
+        Loan.objects.create(member=member, book_id=2)
+
+        return_book(book_id=1, member_id=member.id)
+        bulk_return(member_id=member.id, book_ids=[2])
+
+        member.refresh_from_db()
+        self.assertEqual(member.active_loan_count, 0)
+        self.assertFalse(Loan.objects.filter(member=member, is_returned=False).exists())
+
+    def test_rejected_checkout_leaves_counter(self):
+        member = create_test_member()
+        Book.objects.filter(id=1).update(available_copies=0)
+
+        with self.assertRaises(ValidationError):
+            checkout_book(book_id=1, member_id=member.id)
+
+        member.refresh_from_db()
+        self.assertEqual(member.active_loan_count, 0)
+
+    def test_reconcile_command(self):
+        member = create_test_member()
+        checkout_book(book_id=1, member_id=member.id)
+        Loan.objects.create(member=member, book_id=2)
+        Member.objects.filter(id=member.id).update(active_loan_count=7)
+
+        out = StringIO()
+        call_command('reconcile_active_loans', '--dry-run', stdout=out)
+        self.assertIn('1 member(s)', out.getvalue())
+        member.refresh_from_db()
+        self.assertEqual(member.active_loan_count, 7)
+
+        call_command('reconcile_active_loans', stdout=StringIO())
+        member.refresh_from_db()
+        self.assertEqual(member.active_loan_count, 2)
+        self.assertEqual(reconcile_active_loan_counts(dry_run=True), 0)
@@ -8,9 +8,12 @@ router.register(r'authors', views.AuthorViewSet)
 router.register(r'books', views.BookViewSet)
 router.register(r'members', views.MemberViewSet)
 router.register(r'loans', views.LoanViewSet)
+router.register(r'catalog-imports', views.CatalogImportViewSet)
 
 app_name = 'api'
 
 urlpatterns = [
+    path('_metrics/', views.metrics, name='metrics'),
+    path('async/', include('library.async_urls')),
     path('', include(router.urls)),
 ]
\ No newline at end of file
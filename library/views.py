@@ -1,78 +1,435 @@
-from django.db.models import Count, Q
-from rest_framework import viewsets, status
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework import mixins, viewsets, status
 from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
-from .models import Author, Book, Member, Loan
-from .operations import extend_loan_due_date_by, get_top_active_members
-from .serializers import AuthorSerializer, BookSerializer, MemberSerializer, LoanSerializer, ActiveMemberSerializer
+from . import caching, circulation, exports, leaderboard, outbox
+from .fieldsets import parse_fieldset
+from .metrics import registry
+from .models import Author, Book, CatalogImport, Member, Loan
+from .operations import extend_loan_due_date_by
+from .pagination import BookPagination, KeysetPagination, LoanPagination, MemberPagination
+from .search import search_books
+from .serializers import (AuthorSerializer, BookSerializer, MemberSerializer, LoanSerializer, ActiveMemberSerializer,
+                          BulkCirculationSerializer, CatalogImportSerializer)
 from rest_framework.decorators import action
-from rest_framework.pagination import PageNumberPagination
-from django.utils import timezone
-from .tasks import send_loan_notification
 
-class AuthorViewSet(viewsets.ModelViewSet):
+def metrics(request):
+    """
+    Expose the metrics registry in Prometheus text format.
+    """
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def bulk_status(results, success_status):
+    """
+    Pick the response status for a bulk circulation request.
+
+    Args:
+        results (list[dict]): Per-item results
+        success_status (int): Status when every item succeeded
+    """
+    failed = sum(1 for result in results if result['status'] == circulation.FAILED)
+    if not failed:
+        return success_status
+    if failed == len(results):
+        return status.HTTP_400_BAD_REQUEST
+    return status.HTTP_207_MULTI_STATUS
+
+
+class EagerLoadingViewSetMixin:
+    """
+    Eager load whatever the view's serializer declares it will render.
+
+    ``list`` and ``retrieve`` also take ``?fields=`` and ``?expand=``, see
+    ``library.fieldsets``: the serializer then renders the selected fields
+    only, and the queryset loads their columns and joins their relations
+    only.
+    """
+    fieldset = None
+
+    def list(self, request, *args, **kwargs):
+        return self.sparse_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.sparse_response(super().retrieve, request, *args, **kwargs)
+
+    def sparse_response(self, render, request, *args, **kwargs):
+        serializer_class = self.get_serializer_class()
+        if hasattr(serializer_class, 'setup_eager_loading'):
+            try:
+                self.fieldset = parse_fieldset(request.query_params, serializer_class)
+            except ValidationError as e:
+                return Response({'error': e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        return render(request, *args, **kwargs)
+
+    def get_serializer(self, *args, **kwargs):
+        if self.fieldset is not None:
+            kwargs['fieldset'] = self.fieldset
+        return super().get_serializer(*args, **kwargs)
+
+    def get_values_representation(self):
+        serializer_class = self.get_serializer_class()
+        if not hasattr(serializer_class, 'get_values_representation'):
+            return None
+        return serializer_class.get_values_representation(self.fieldset)
+
+    def get_key_fields(self):
+        """
+        Get the fields loaded whatever the serializer renders.
+        """
+        # The keyset pagination reads its cursors from the rows
+        if self.action == 'list' and isinstance(self.paginator, KeysetPagination):
+            return self.paginator.get_key_fields()
+        return ()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.fieldset is not None:
+            representation = self.get_values_representation()
+            if representation is not None:
+                return representation.load_only(queryset, self.get_key_fields())
+
+        serializer_class = self.get_serializer_class()
+        if hasattr(serializer_class, 'setup_eager_loading'):
+            queryset = serializer_class.setup_eager_loading(queryset)
+        return queryset
+
+
+class ValuesListViewSetMixin:
+    """
+    Render ``list`` pages from ``.values()`` rows through the serializer's
+    ``ValuesRepresentation``, instead of building a model instance and a
+    serializer per row. Serializers that cannot be compiled are rendered
+    the usual way.
+
+    Goes after ``EagerLoadingViewSetMixin``, which picks the representation
+    for the request's fieldset.
+    """
+
+    def list(self, request, *args, **kwargs):
+        representation = self.get_values_representation()
+        if representation is None:
+            return super().list(request, *args, **kwargs)
+
+        queryset = representation.apply(self.filter_queryset(self.get_queryset()), self.get_key_fields())
+        page = self.paginate_queryset(queryset)
+        rows = queryset if page is None else page
+        data = [representation.to_representation(row) for row in rows]
+
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+
+class ConditionalGetViewSetMixin:
+    """
+    Answer ``list`` and ``retrieve`` with validators computed from the
+    ``updated_at`` columns, and with a 304 before any row is serialized when
+    the client's copy is current.
+
+    A detail response depends on its row and the rows its serializer nests
+    (see ``EagerLoadingMixin``), whose ``updated_at`` are read in one query
+    and give it an ETag and a Last-Modified date.
+
+    A list may show any row of those tables, so it is validated by each
+    table's ``MAX(updated_at)``, one index lookup per table, and by the
+    table's deletion counter from ``library.caching``, since deleting a row
+    lowers no maximum. For that reason lists only carry an ETag.
+    """
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(super().retrieve, request, *args, **kwargs)
+
+    def get_dependencies(self):
+        """
+        Get the models a response is rendered from, by relation path, for
+        those that have an ``updated_at`` column.
+        """
+        model = self.get_queryset().model
+        dependencies = {'': model}
+
+        serializer_class = self.get_serializer_class()
+        if hasattr(serializer_class, 'get_eager_loading_paths'):
+            select_related, prefetch_related = serializer_class.get_eager_loading_paths()
+            for path in select_related + prefetch_related:
+                related = model
+                for name in path.split('__'):
+                    related = related._meta.get_field(name).related_model
+                dependencies[path] = related
+
+        return {
+            path: related for path, related in dependencies.items()
+            if any(field.name == 'updated_at' for field in related._meta.concrete_fields)
+        }
+
+    def get_validators(self, request):
+        """
+        Get what the response depends on, and when it last changed.
+
+        Returns:
+            tuple: A ``repr``-able state that changes whenever the response
+                would, and the last modification time or ``None``; or
+                ``None`` when the response cannot be validated
+        """
+        dependencies = self.get_dependencies()
+
+        if self.action == 'list':
+            models = set(dependencies.values())
+            maxima = [
+                (related._meta.label_lower, related.objects.aggregate(updated_at=Max('updated_at'))['updated_at'])
+                for related in models
+            ]
+            deletions = caching.get_versions(*(caching.deletions(related) for related in models))
+            return (sorted(maxima), sorted(deletions.items())), None
+
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        model = dependencies.pop('')
+        try:
+            changed = model.objects.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]}).aggregate(
+                updated_at=Max('updated_at'),
+                **{path: Max(f'{path}__updated_at') for path in dependencies}
+            )
+        except (TypeError, ValueError):
+            return None
+
+        if changed['updated_at'] is None:
+            # No such row; let retrieve answer with its 404
+            return None
+        return sorted(changed.items()), max(value for value in changed.values() if value is not None)
+
+    def count_conditional_response(self, result):
+        registry.inc(
+            'library_conditional_response_total', {'view': self.basename, 'result': result},
+            help_text='Conditional read responses by result.'
+        )
+
+    def conditional_response(self, render, request, *args, **kwargs):
+        validators = self.get_validators(request)
+        if validators is None:
+            return render(request, *args, **kwargs)
+
+        state, last_modified = validators
+        digest = md5(repr((request.build_absolute_uri(), state)).encode()).hexdigest()
+        # Weak: the same data is rendered differently per Accept header
+        headers = {'ETag': f'W/"{digest}"', 'Vary': 'Accept'}
+        if last_modified is not None:
+            headers['Last-Modified'] = http_date(last_modified.timestamp())
+
+        not_modified = get_conditional_response(
+            request, etag=headers['ETag'],
+            last_modified=int(last_modified.timestamp()) if last_modified is not None else None
+        )
+        if not_modified is not None:
+            self.count_conditional_response('not_modified')
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            self.count_conditional_response('modified')
+            response = self.render_response(digest, render, request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    def render_response(self, digest, render, request, *args, **kwargs):
+        """
+        Render the full response for a client without a current copy.
+
+        Args:
+            digest (str): ETag value, unique to the response's state
+            render (callable): The viewset's own ``list`` or ``retrieve``
+            request (Request): Current request
+        """
+        return render(request, *args, **kwargs)
+
+
+class CachedReadViewSetMixin(ConditionalGetViewSetMixin):
+    """
+    Serve ``list`` and ``retrieve`` from a versioned cache, with ETags.
+
+    The ETag is derived from the request URI and the versions of the cache
+    namespaces the response depends on, so ``If-None-Match`` is answered with
+    a 304 from two cache reads, without touching the database or the cached
+    body. Entries live for ``CATALOG_CACHE_TIMEOUT`` seconds at most; with
+    the cache turned off, responses are validated from ``updated_at``.
+    """
+
+    def get_cache_namespaces(self):
+        return [caching.CATALOG]
+
+    def count_cache_lookup(self, result):
+        registry.inc(
+            'library_response_cache_total', {'view': self.basename, 'result': result},
+            help_text='Cached read responses by result.'
+        )
+
+    def count_conditional_response(self, result):
+        super().count_conditional_response(result)
+        if result == 'not_modified' and settings.CATALOG_CACHE_TIMEOUT:
+            self.count_cache_lookup(result)
+
+    def get_validators(self, request):
+        if not settings.CATALOG_CACHE_TIMEOUT:
+            return super().get_validators(request)
+        return sorted(caching.get_versions(*self.get_cache_namespaces()).items()), None
+
+    def render_response(self, digest, render, request, *args, **kwargs):
+        timeout = settings.CATALOG_CACHE_TIMEOUT
+        if not timeout:
+            return render(request, *args, **kwargs)
+
+        key = f'response:{digest}'
+        data = cache.get(key)
+        if data is not None:
+            self.count_cache_lookup('hit')
+            return Response(data)
+
+        self.count_cache_lookup('miss')
+        response = render(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            cache.set(key, response.data, timeout=timeout)
+        return response
+
+
+class ExportViewSetMixin:
+    """
+    Stream the viewset's whole table at ``export/`` as CSV or JSON Lines,
+    see ``library.exports``. Viewsets list the exported field paths and
+    apply their filters in ``filter_export_queryset``.
+    """
+    export_fields = ()
+
+    def filter_export_queryset(self, queryset, params):
+        return queryset
+
+    def perform_content_negotiation(self, request, force=False):
+        # Exports pick their format from ?file_format=, whatever the client accepts
+        return super().perform_content_negotiation(request, force=force or self.action == 'export')
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        try:
+            queryset = self.filter_export_queryset(self.queryset.model.objects.all(), request.query_params)
+            return exports.streaming_export(request, queryset, self.export_fields, filename=self.basename)
+        except ValidationError as e:
+            return Response({'error': e.detail}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class AuthorViewSet(CachedReadViewSetMixin, EagerLoadingViewSetMixin, viewsets.ModelViewSet):
     queryset = Author.objects.all()
     serializer_class = AuthorSerializer
 
-class BookViewSet(viewsets.ModelViewSet):
-    queryset = Book.objects.select_related('author').all()
+class BookViewSet(CachedReadViewSetMixin, ExportViewSetMixin, EagerLoadingViewSetMixin, ValuesListViewSetMixin,
+                  viewsets.ModelViewSet):
+    # The search vector is only ever read by the database
+    queryset = Book.objects.defer('search_vector')
     serializer_class = BookSerializer
-    pagination_class = PageNumberPagination
+    pagination_class = BookPagination
+    export_fields = exports.BOOK_FIELDS
 
-    def get_queryset(self):
-        queryset = Book.objects.select_related('author').all()
-        print(queryset.explain())
-        return queryset
+    def filter_export_queryset(self, queryset, params):
+        queryset = exports.filter_by_date_range(queryset, params, 'updated_at__date')
+        return exports.filter_by_genre(queryset, params)
+
+    def get_cache_namespaces(self):
+        if self.action == 'retrieve':
+            return [caching.CATALOG, caching.catalog_book(self.kwargs['pk'])]
+        return [caching.CATALOG, caching.CATALOG_BOOK_LISTS]
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'error': 'Search query must not be empty.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Ranked, so only the best page_size matches are returned
+        books = search_books(query, self.get_queryset())[:self.paginator.get_page_size(request)]
+        serializer = self.get_serializer(books, many=True)
+
+        return Response({'results': serializer.data}, status=status.HTTP_200_OK)
 
     @action(detail=True, methods=['post'])
     def loan(self, request, pk=None):
-        book = self.get_object()
-        if book.available_copies < 1:
-            return Response({'error': 'No available copies.'}, status=status.HTTP_400_BAD_REQUEST)
-        member_id = request.data.get('member_id')
         try:
-            member = Member.objects.get(id=member_id)
-        except Member.DoesNotExist:
-            return Response({'error': 'Member does not exist.'}, status=status.HTTP_400_BAD_REQUEST)
-        loan = Loan.objects.create(book=book, member=member)
-        book.available_copies -= 1
-        book.save()
-        send_loan_notification.delay(loan.id)
+            circulation.checkout_book(book_id=pk, member_id=request.data.get('member_id'))
+        except ValidationError as e:
+            return Response({'error': e.detail}, status=status.HTTP_400_BAD_REQUEST)
         return Response({'status': 'Book loaned successfully.'}, status=status.HTTP_201_CREATED)
 
     @action(detail=True, methods=['post'])
     def return_book(self, request, pk=None):
-        book = self.get_object()
-        member_id = request.data.get('member_id')
         try:
-            loan = Loan.objects.get(book=book, member__id=member_id, is_returned=False)
-        except Loan.DoesNotExist:
-            return Response({'error': 'Active loan does not exist.'}, status=status.HTTP_400_BAD_REQUEST)
-        loan.is_returned = True
-        loan.return_date = timezone.now().date()
-        loan.save()
-        book.available_copies += 1
-        book.save()
+            circulation.return_book(book_id=pk, member_id=request.data.get('member_id'))
+        except ValidationError as e:
+            return Response({'error': e.detail}, status=status.HTTP_400_BAD_REQUEST)
         return Response({'status': 'Book returned successfully.'}, status=status.HTTP_200_OK)
 
-class MemberViewSet(viewsets.ModelViewSet):
+class MemberViewSet(ConditionalGetViewSetMixin, EagerLoadingViewSetMixin, ValuesListViewSetMixin,
+                    viewsets.ModelViewSet):
     queryset = Member.objects.all().order_by('id')
     serializer_class = MemberSerializer
+    pagination_class = MemberPagination
 
     @action(detail=False, methods=['get'], url_path='top-active',
             serializer_class=ActiveMemberSerializer)
     def top_active(self, request, pk=None):
+        try:
+            number = min(max(int(request.query_params.get('number', 5)), 1), 50)
+        except ValueError:
+            return Response({'error': 'Number must be integer.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        top_active_members = get_top_active_members(number=5)
+        top_active_members = leaderboard.get_top_active(number=number)
 
         serializer = self.get_serializer(top_active_members, many=True)
 
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class LoanViewSet(viewsets.ModelViewSet):
+class LoanViewSet(ConditionalGetViewSetMixin, ExportViewSetMixin, EagerLoadingViewSetMixin, ValuesListViewSetMixin,
+                  viewsets.ModelViewSet):
     queryset = Loan.objects.all()
     serializer_class = LoanSerializer
+    pagination_class = LoanPagination
+    export_fields = exports.LOAN_FIELDS
+
+    def filter_export_queryset(self, queryset, params):
+        queryset = exports.filter_by_date_range(queryset, params, 'loan_date')
+        return exports.filter_by_genre(queryset, params, 'book__genre')
+
+    # Direct loan edits keep the members' active loan counters in step
+    @transaction.atomic
+    def perform_create(self, serializer):
+        loan = serializer.save()
+        if not loan.is_returned:
+            circulation.adjust_active_loan_count(loan.member_id, 1, [loan.book_id])
+
+    @transaction.atomic
+    def perform_update(self, serializer):
+        old = serializer.instance
+        was_active, old_member_id, old_book_id = not old.is_returned, old.member_id, old.book_id
+        loan = serializer.save()
+        if was_active:
+            circulation.adjust_active_loan_count(old_member_id, -1, [old_book_id])
+        if not loan.is_returned:
+            circulation.adjust_active_loan_count(loan.member_id, 1, [loan.book_id])
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        if not instance.is_returned:
+            circulation.adjust_active_loan_count(instance.member_id, -1, [instance.book_id])
+        instance.delete()
 
     @action(detail=True, methods=['post'])
     def extend_due_date(self, request, pk=None):
@@ -91,3 +448,48 @@ class LoanViewSet(viewsets.ModelViewSet):
 
         except ValueError:
             return Response({'error': 'Additional Days must be integer.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=False, methods=['post'], url_path='bulk-checkout',
+            serializer_class=BulkCirculationSerializer)
+    def bulk_checkout(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        results = circulation.bulk_checkout(
+            member_id=serializer.validated_data['member'].id,
+            book_ids=serializer.validated_data['book_ids']
+        )
+
+        return Response({'results': results}, status=bulk_status(results, status.HTTP_201_CREATED))
+
+    @action(detail=False, methods=['post'], url_path='bulk-return',
+            serializer_class=BulkCirculationSerializer)
+    def bulk_return(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        results = circulation.bulk_return(
+            member_id=serializer.validated_data['member'].id,
+            book_ids=serializer.validated_data['book_ids']
+        )
+
+        return Response({'results': results}, status=bulk_status(results, status.HTTP_200_OK))
+
+
+class CatalogImportViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.ListModelMixin,
+                           viewsets.GenericViewSet):
+    """
+    Upload a catalog file for import in the background, then poll it.
+    """
+    queryset = CatalogImport.objects.all()
+    serializer_class = CatalogImportSerializer
+
+    @transaction.atomic
+    def perform_create(self, serializer):
+        catalog_import = serializer.save()
+        outbox.publish(outbox.CATALOG_IMPORT_UPLOADED, import_id=catalog_import.id)
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return response
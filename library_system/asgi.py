@@ -2,6 +2,7 @@
 ASGI config for library_system project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+It serves the ``/api/async/`` endpoints only, see ``library_system.urls_asgi``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
@@ -11,6 +12,6 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'library_system.settings.base')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'library_system.settings.asgi')
 
 application = get_asgi_application()
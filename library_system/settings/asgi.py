@@ -0,0 +1,4 @@
+from .base import *
+
+# Async endpoints only, see library_system.urls_asgi
+ROOT_URLCONF = 'library_system.urls_asgi'
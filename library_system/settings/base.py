@@ -23,6 +23,8 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    # Search and trigram lookups, see library.search
+    'django.contrib.postgres',
     # Third-party apps
     'rest_framework',
     'corsheaders',
@@ -39,6 +41,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'library.middleware.QueryPlanSamplingMiddleware',
+    'library.middleware.QueryMetricsMiddleware',
 ]
 
 # CORS
@@ -76,6 +80,26 @@ DATABASES = {
     }
 }
 
+# Cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDIS_CACHE_URL', 'redis://redis:6379/1'),
+    }
+}
+
+# Top-active members leaderboard, see library.leaderboard
+LEADERBOARD_CACHE_TIMEOUT = int(os.getenv('LEADERBOARD_CACHE_TIMEOUT', 60))
+LEADERBOARD_REBUILD_WAIT = float(os.getenv('LEADERBOARD_REBUILD_WAIT', 1))
+# Seconds book and author responses are cached, 0 to disable, see library.caching
+CATALOG_CACHE_TIMEOUT = int(os.getenv('CATALOG_CACHE_TIMEOUT', 300))
+# Catalog import records written per transaction, see library.importers
+CATALOG_IMPORT_CHUNK_SIZE = int(os.getenv('CATALOG_IMPORT_CHUNK_SIZE', 2000))
+# Seconds without progress after which a running catalog import is presumed dead and restarted
+CATALOG_IMPORT_STALE_SECONDS = int(os.getenv('CATALOG_IMPORT_STALE_SECONDS', 600))
+# Rows fetched and written per chunk by the export endpoints, see library.exports
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 2000))
+
 # Password Validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -97,6 +121,10 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 
+# Uploaded files, e.g. catalog imports; shared with the Celery workers
+MEDIA_URL = '/media/'
+MEDIA_ROOT = os.getenv('MEDIA_ROOT', BASE_DIR / 'media')
+
 # Default Primary Key Field Type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -115,16 +143,52 @@ CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://redis:6379/0
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+# Checkout confirmations get their own queue and worker, see library.notifications
+CELERY_TASK_ROUTES = {
+    'library.tasks.send_loan_notification': {'queue': 'notifications'},
+    'library.tasks.send_bulk_loan_notification': {'queue': 'notifications'},
+    'library.tasks.send_loan_digest': {'queue': 'notifications'},
+    'library.tasks.send_batch_overdue_notification': {'queue': 'schedule'},
+    'library.tasks.sweep_overdue_shard': {'queue': 'schedule'},
+    'library.tasks.summarize_overdue_sweep': {'queue': 'schedule'},
+}
 CELERY_BEAT_SCHEDULE =  {
     'send-overdue-reminder': {
         'task': 'library.tasks.check_overdue_loans',
-        'schedule': crontab(minute=0,hour=0),
+        # Hourly so an interrupted sweep resumes; a completed day is a no-op
+        'schedule': crontab(minute=0),
     }
 }
 
+# Outbox relay retries, see library.outbox: seconds before the first retry,
+# doubled on each failure up to the maximum, and failures before an event is dead
+OUTBOX_RETRY_SECONDS = float(os.getenv('OUTBOX_RETRY_SECONDS', 5))
+OUTBOX_RETRY_MAX_SECONDS = float(os.getenv('OUTBOX_RETRY_MAX_SECONDS', 600))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 10))
+
+# Overdue sweep fan-out, see library.tasks.check_overdue_loans
+OVERDUE_SWEEP_SHARDS = int(os.getenv('OVERDUE_SWEEP_SHARDS', 8))
+OVERDUE_SWEEP_BATCH_SIZE = int(os.getenv('OVERDUE_SWEEP_BATCH_SIZE', 50))
+
 # Email Configuration
-EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'  # For development
+EMAIL_BACKEND = os.getenv('EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')  # Console for development
+EMAIL_HOST = os.getenv('EMAIL_HOST', 'localhost')
+EMAIL_PORT = int(os.getenv('EMAIL_PORT', 25))
 DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'admin@library.com')
+# Messages sent over one SMTP connection before it is recycled
+NOTIFICATION_MAX_MESSAGES_PER_CONNECTION = int(os.getenv('NOTIFICATION_MAX_MESSAGES_PER_CONNECTION', 100))
+# Messages per second allowed through the mail backend across all workers, 0 for no limit
+NOTIFICATION_RATE_LIMIT = float(os.getenv('NOTIFICATION_RATE_LIMIT', 0))
+NOTIFICATION_RATE_BURST = float(os.getenv('NOTIFICATION_RATE_BURST', 0))
+# Seconds to buffer a member's loan confirmations into one digest, 0 to send each at once
+NOTIFICATION_COALESCE_SECONDS = float(os.getenv('NOTIFICATION_COALESCE_SECONDS', 0))
+# Share of the rate limit bucket that overdue reminders may not use
+NOTIFICATION_HIGH_PRIORITY_RESERVE = float(os.getenv('NOTIFICATION_HIGH_PRIORITY_RESERVE', 0.2))
+
+# Query plan sampling, see library.middleware.QueryPlanSamplingMiddleware
+QUERY_PLAN_SAMPLE_RATE = float(os.getenv('QUERY_PLAN_SAMPLE_RATE', 0))
+QUERY_PLAN_SLOW_MS = float(os.getenv('QUERY_PLAN_SLOW_MS', 100))
+QUERY_PLAN_ANALYZE = int(os.getenv('QUERY_PLAN_ANALYZE', 0))
 
 LOGGING = {
     'version': 1,
@@ -146,7 +210,12 @@ LOGGING = {
     'loggers': {
         'django.db.backends': {
             'handlers': ['console'],
-            'level': 'DEBUG',
+            'level': os.getenv('DB_LOG_LEVEL', 'INFO'),
+        },
+        'library.query_plans': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
         },
         'root': {
             'handlers': ['console'],
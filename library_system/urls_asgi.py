@@ -0,0 +1,13 @@
+"""
+URLconf of the ASGI deployment (``library_system.settings.asgi``).
+
+Only the async endpoints are routed. Under ASGI, Django 4.2 buffers a
+``StreamingHttpResponse`` over a sync iterator in full before sending it,
+so the exports and every other sync view stay on the WSGI deployment.
+"""
+from django.urls import path, include
+
+
+urlpatterns = [
+    path('api/async/', include(('library.async_urls', 'api'))),
+]